@@ -0,0 +1,27 @@
+"""
+Benchmarks of the backend's hot paths.
+
+They run offline, against the in-memory bucket (see
+``cbdjango.db.backends.couchbase.memory``), and cover:
+
+- ``compiler.select.*``: SelectCommand construction, per query shape
+- ``rows.*``: dict_to_row, convert_row and convert_values throughput
+- ``docid.*``: DocID encoding and decoding
+- ``insert.*``: InsertCommand.get_params and bulk_create, per number of objects
+- ``cursor.*``, ``queryset.*``: fetching rows end to end
+
+Run them with::
+
+    python -m cbdjango.benchmarks -o results.json
+
+Results are written as JSON, keyed by case name. To check for regressions,
+compare a run with the results of another commit, or two results files with
+each other. The exit status is 1 if any case got slower by more than the
+threshold::
+
+    python -m cbdjango.benchmarks --compare baseline.json
+    python -m cbdjango.benchmarks --compare baseline.json results.json
+
+Times of the end-to-end cases include evaluating queries in memory, and are
+only comparable with results of the same version of the in-memory bucket.
+"""
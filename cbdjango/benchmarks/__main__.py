@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import sys
+
+from .runner import run, environment, compare, print_comparison, FORMAT_VERSION, \
+    DEFAULT_THRESHOLD
+
+
+def _sizes(value):
+    return [int(x) for x in value.split(',') if x]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m cbdjango.benchmarks', description='Benchmark the Couchbase backend')
+    parser.add_argument('results', nargs='?',
+                        help='Compare this results file with --compare, instead of running')
+    parser.add_argument('-o', '--output', help='Write the results to this file, not stdout')
+    parser.add_argument('-k', '--case', action='append', dest='patterns', default=[],
+                        help='Only run the cases matching this shell-style pattern. May be repeated')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='Compare the results with those of this file')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Relative slowdown reported as a regression (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed runs of each case, the best is kept '
+                             '(default: %(default)s)')
+    parser.add_argument('--ops', type=int, default=10000,
+                        help='Number of operations of the micro-benchmarks (default: %(default)s)')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='Number of stored documents read by the row and cursor cases '
+                             '(default: %(default)s)')
+    parser.add_argument('--sizes', type=_sizes, default=[10000, 100000],
+                        help='Comma-separated numbers of objects written by the bulk '
+                             'write cases, e.g. 10000,100000,1000000 (default: 10000,100000)')
+    parser.add_argument('--using', default='default', help='The database alias to use')
+    return parser
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _setup():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cbdjango.benchmarks.settings')
+    import django
+    django.setup()
+
+
+def main(argv=None):
+    options = get_parser().parse_args(argv)
+    if options.results:
+        if not options.compare:
+            get_parser().error('A results file can only be given with --compare')
+        current = _load(options.results)
+    else:
+        _setup()
+        from django.db import connections
+        from cbdjango.db.backends.couchbase import memory
+        from .cases import BENCHMARKS
+
+        connection = connections[options.using]
+        if connection.settings_dict['CONNECTION_STRING'].startswith(memory.SCHEME):
+            memory.reset()
+
+        current = {
+            'version': FORMAT_VERSION,
+            'environment': environment(),
+            'options': {'repeat': options.repeat, 'ops': options.ops, 'rows': options.rows,
+                        'sizes': options.sizes},
+            'results': run(BENCHMARKS, options, options.patterns),
+        }
+        if options.output:
+            with open(options.output, 'w') as f:
+                json.dump(current, f, indent=2, sort_keys=True)
+        else:
+            json.dump(current, sys.stdout, indent=2, sort_keys=True)
+            print
+
+    if options.compare:
+        rows, regressions = compare(_load(options.compare), current, options.threshold)
+        print_comparison(rows, regressions)
+        if regressions:
+            print >> sys.stderr, len(regressions), "case(s) regressed by more than", \
+                '{0:.0%}'.format(options.threshold)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
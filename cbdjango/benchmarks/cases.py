@@ -0,0 +1,220 @@
+"""
+The benchmarked hot paths.
+
+Each function registered with :func:`benchmark` is a generator of
+:class:`Case` objects. Whatever a case needs (objects, documents, compiled
+queries) is prepared before it is yielded, and is not timed.
+"""
+import sys
+from datetime import datetime, timedelta
+from uuid import UUID
+
+from django.db import connections
+
+from cbdjango.db.backends.couchbase.compiler import SelectCommand, InsertCommand, \
+    remove_documents
+from cbdjango.db.backends.couchbase.utils import DocID
+
+from .models import Author, Entry
+
+BENCHMARKS = []
+
+AUTHORS = 100
+
+# IDs of the entries written by the bulk write cases, clear of the stored ones
+WRITE_ID_BASE = 10 ** 9
+
+_BODY = u'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 4
+_EPOCH = datetime(2016, 1, 1)
+
+_populated = {}
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+class Case(object):
+    def __init__(self, name, fn, ops, teardown=None):
+        """
+        :param name: Dotted name of the case, under which its results are stored
+        :param fn: Runs the measured operations once
+        :param ops: Number of operations per call of `fn`
+        :param teardown: Undoes the effects of `fn`, if any. Not timed
+        """
+        self.name = name
+        self.fn = fn
+        self.ops = ops
+        self.teardown = teardown
+
+
+def make_entries(count, first_id=1):
+    """
+    Build unsaved entries with their IDs set
+    """
+    rv = []
+    for ix in xrange(first_id, first_id + count):
+        created = _EPOCH + timedelta(minutes=ix % 500000)
+        rv.append(Entry(id=ix, title=u'Entry {0}'.format(ix), body=_BODY, rating=ix % 5,
+                        published=bool(ix % 2), created=created, day=created.date(),
+                        author_id=ix % AUTHORS + 1))
+    return rv
+
+
+def populate(options):
+    """
+    Store the authors and `options.rows` entries read by the row and cursor
+    cases, unless already stored
+    """
+    if _populated.get(options.using) == options.rows:
+        return
+    print >> sys.stderr, "Storing", options.rows, "entries"
+    Author.objects.using(options.using).bulk_create(
+        [Author(id=ix, name=u'Author {0}'.format(ix)) for ix in xrange(1, AUTHORS + 1)])
+    Entry.objects.using(options.using).bulk_create(make_entries(options.rows))
+    _populated[options.using] = options.rows
+
+
+def compiled_query(queryset, using):
+    """
+    Get the query of a QuerySet, set up as SQLCompiler.as_sql() would before
+    building its SelectCommand
+    """
+    compiler = queryset.query.get_compiler(using=using)
+    compiler.pre_sql_setup()
+    return compiler.query
+
+
+def _times(fn, count):
+    def run():
+        for _ in xrange(count):
+            fn()
+    return run
+
+
+def query_shapes():
+    return [
+        ('all', Entry.objects.all()),
+        ('pk_get', Entry.objects.filter(pk=1)),
+        ('pk_in', Entry.objects.filter(pk__in=range(1, 101))),
+        ('filter', Entry.objects.filter(rating__gte=3, published=True).exclude(
+            title__startswith=u'x')),
+        ('order_slice', Entry.objects.order_by('-created', 'title')[10:30]),
+        ('values_list', Entry.objects.values_list('title', 'rating')),
+        ('fk', Entry.objects.filter(author=1)),
+        ('subquery', Entry.objects.filter(author__in=Author.objects.filter(name=u'Author 1'))),
+        ('dates', Entry.objects.dates('day', 'month')),
+    ]
+
+
+@benchmark
+def select_construction(options):
+    """ SelectCommand construction, per query shape """
+    connection = connections[options.using]
+    count = max(options.ops // 10, 1)
+    for shape, queryset in query_shapes():
+        query = compiled_query(queryset.using(options.using), options.using)
+        fn = (lambda q: lambda: SelectCommand(connection, q))(query)
+        yield Case('compiler.select.' + shape, _times(fn, count), count)
+
+
+@benchmark
+def row_conversion(options):
+    """ dict_to_row, convert_row and convert_values over stored documents """
+    connection = connections[options.using]
+    populate(options)
+    query = compiled_query(Entry.objects.using(options.using).all(), options.using)
+
+    cmd = SelectCommand(connection, query, raw_rows=False)
+    docs = list(cmd.execute(connection.get_bucket(cmd.bucket_name)))
+    yield Case('rows.dict_to_row', lambda: [cmd.dict_to_row(x) for x in docs], len(docs))
+
+    array_cmd = SelectCommand(connection, query)
+    rows = list(array_cmd.execute(connection.get_bucket(array_cmd.bucket_name)))
+    yield Case('rows.convert_row', lambda: [array_cmd.convert_row(x) for x in rows], len(rows))
+
+    convert_values = connection.ops.convert_values
+    seen = set()
+    for ix, (_, field) in enumerate(array_cmd.queried_fields):
+        if field is None:
+            continue
+        name = field.get_internal_type()
+        if field.primary_key:
+            name = 'pk'
+        if name in seen:
+            continue
+        seen.add(name)
+        values = [row[ix] for row in rows if row[ix] is not None]
+        fn = (lambda f, v: lambda: [convert_values(x, f) for x in v])(field, values)
+        yield Case('rows.convert_values.' + name, fn, len(values))
+
+
+@benchmark
+def docid_codec(options):
+    """ DocID.encode/decode """
+    count = options.ops
+    table = connections[options.using].table_name(Entry)
+    ints = range(1, count + 1)
+    uuids = [UUID(int=x) for x in ints]
+    strings = [u'key-{0}'.format(x) for x in ints]
+
+    yield Case('docid.encode.int', lambda: [DocID.encode(table, x) for x in ints], count)
+    yield Case('docid.encode.uuid', lambda: [DocID.encode(table, x) for x in uuids], count)
+    yield Case('docid.encode.str', lambda: [DocID.encode(table, x) for x in strings], count)
+    yield Case('docid.generate', lambda: [DocID.generate(table) for _ in ints], count)
+
+    encoded_ints = [DocID.encode(table, x) for x in ints]
+    encoded_strings = [DocID.encode(table, x) for x in strings]
+    yield Case('docid.decode.int', lambda: [DocID.decode(x).to_int() for x in encoded_ints],
+               count)
+    yield Case('docid.decode.str',
+               lambda: [DocID.decode(x).to_string() for x in encoded_strings], count)
+
+
+@benchmark
+def bulk_writes(options):
+    """ InsertCommand.get_params and bulk_create, per number of objects """
+    connection = connections[options.using]
+    fields = Entry._meta.local_concrete_fields
+    table = connection.table_name(Entry)
+    bucket = connection.get_bucket(connection.get_bucket_name_for(Entry))
+
+    for size in options.sizes:
+        objs = make_entries(size, WRITE_ID_BASE)
+        cmd = InsertCommand(connection, Entry)
+        fn = (lambda o: lambda: cmd.get_params(o, fields))(objs)
+        yield Case('insert.get_params.{0}'.format(size), fn, size)
+
+        keys = [DocID.encode(table, obj.pk) for obj in objs]
+        fn = (lambda o: lambda: Entry.objects.using(options.using).bulk_create(o))(objs)
+        teardown = (lambda k: lambda: remove_documents(connection, bucket, Entry, k))(keys)
+        yield Case('insert.bulk_create.{0}'.format(size), fn, size, teardown)
+
+
+@benchmark
+def cursor_iteration(options):
+    """ Fetching all stored entries through the cursor, and through a QuerySet """
+    connection = connections[options.using]
+    populate(options)
+    query = compiled_query(Entry.objects.using(options.using).all(), options.using)
+
+    def fetch(size):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(SelectCommand(connection, query))
+            if size is None:
+                while cursor.fetchone() is not None:
+                    pass
+            else:
+                while cursor.fetchmany(size):
+                    pass
+        finally:
+            cursor.close()
+
+    yield Case('cursor.fetchone', lambda: fetch(None), options.rows)
+    for size in (100, 1000):
+        yield Case('cursor.fetchmany.{0}'.format(size),
+                   (lambda s: lambda: fetch(s))(size), options.rows)
+    yield Case('queryset.iterate', lambda: list(Entry.objects.using(options.using).all()),
+               options.rows)
@@ -0,0 +1,15 @@
+from django.db import models
+
+
+class Author(models.Model):
+    name = models.CharField(max_length=100)
+
+
+class Entry(models.Model):
+    title = models.CharField(max_length=200)
+    body = models.TextField()
+    rating = models.IntegerField()
+    published = models.BooleanField(default=False)
+    created = models.DateTimeField()
+    day = models.DateField()
+    author = models.ForeignKey(Author)
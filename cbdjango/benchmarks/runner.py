@@ -0,0 +1,160 @@
+"""
+Timing of benchmark cases, and comparison of results between runs
+"""
+import fnmatch
+import gc
+import os
+import platform
+import subprocess
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+from timeit import default_timer
+
+FORMAT_VERSION = 1
+
+DEFAULT_THRESHOLD = 0.10
+
+
+@contextmanager
+def quiet():
+    """
+    Discard what the backend prints while a case runs. Printing still costs
+    what it does outside of the benchmarks
+    """
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def time_case(case, repeat):
+    """
+    Run a case `repeat` times, with the garbage collector disabled as timeit
+    does
+    :return: The results of the case
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        with quiet():
+            gc.disable()
+            try:
+                start = default_timer()
+                case.fn()
+                times.append(default_timer() - start)
+            finally:
+                gc.enable()
+            if case.teardown:
+                case.teardown()
+
+    times.sort()
+    best = times[0]
+    return {
+        'ops': case.ops,
+        'repeat': repeat,
+        'best': best,
+        'median': times[len(times) // 2],
+        'per_op_us': best / case.ops * 1e6,
+        'ops_per_sec': case.ops / best if best else None,
+    }
+
+
+def selected(name, patterns):
+    return not patterns or any(fnmatch.fnmatch(name, x) for x in patterns)
+
+
+def run(benchmarks, options, patterns=()):
+    """
+    Run the cases of the given benchmarks
+    :param benchmarks: Functions yielding Case objects
+    :param options: Passed to the benchmarks
+    :param patterns: If given, only the cases whose name matches any of these
+        shell-style patterns are run
+    :return: A dict of case name -> results
+    """
+    results = {}
+    for benchmark in benchmarks:
+        cases = benchmark(options)
+        while True:
+            # Cases are prepared lazily, so that the objects of large ones
+            # are only kept while they run
+            with quiet():
+                case = next(cases, None)
+            if case is None:
+                break
+            if not selected(case.name, patterns):
+                continue
+            if not case.ops:
+                print >> sys.stderr, "Skipping", case.name, "(nothing to do)"
+                continue
+            results[case.name] = rv = time_case(case, options.repeat)
+            print >> sys.stderr, '{0:<40} {1:>12.3f} us/op {2:>14.0f} ops/s'.format(
+                case.name, rv['per_op_us'], rv['ops_per_sec'] or 0)
+    return results
+
+
+def environment():
+    """
+    Describe where results were measured, so that comparisons between
+    different machines or interpreters can be spotted
+    """
+    import django
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'django': django.get_version(),
+        'commit': commit,
+        'created': datetime.utcnow().isoformat() + 'Z',
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare the per-operation times of two sets of results
+    :param baseline: The results document of the reference run
+    :param current: The results document of the run being checked
+    :param threshold: Relative slowdown above which a case has regressed
+    :return: A tuple of (rows, regressions). `rows` is a list of
+        (name, baseline us/op, current us/op, relative change) for all the
+        cases, with None for the values of a case missing from either run.
+        `regressions` lists the names of the cases which regressed
+    """
+    old, new = baseline['results'], current['results']
+    rows = []
+    regressions = []
+    for name in sorted(set(old) | set(new)):
+        before = old[name]['per_op_us'] if name in old else None
+        after = new[name]['per_op_us'] if name in new else None
+        change = None
+        if before and after is not None:
+            change = after / before - 1
+            if change > threshold:
+                regressions.append(name)
+        rows.append((name, before, after, change))
+    return rows, regressions
+
+
+def print_comparison(rows, regressions, out=sys.stderr):
+    def us(value):
+        return '-' if value is None else '{0:.3f}'.format(value)
+
+    print >> out, '{0:<40} {1:>12} {2:>12} {3:>9}'.format('case', 'before us', 'after us', 'change')
+    for name, before, after, change in rows:
+        flag = ' REGRESSION' if name in regressions else ''
+        change = '-' if change is None else '{0:+.1%}'.format(change)
+        print >> out, '{0:<40} {1:>12} {2:>12} {3:>9}{4}'.format(
+            name, us(before), us(after), change, flag)
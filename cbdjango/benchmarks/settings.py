@@ -0,0 +1,17 @@
+"""
+Settings for running the benchmarks against the in-memory bucket
+"""
+DATABASES = {
+    'default': {
+        'ENGINE': 'cbdjango.db.backends.couchbase',
+        'NAME': 'benchmarks',
+        'CONNECTION_STRING': 'memory://',
+    }
+}
+
+INSTALLED_APPS = ['cbdjango.benchmarks']
+
+SECRET_KEY = "cbdjango_benchmarks_secret_key"
+
+DEBUG = False
+USE_TZ = False
@@ -0,0 +1,162 @@
+"""
+Online, batched backfills for schema changes.
+
+Documents have no schema, so adding, renaming or removing a field leaves the
+existing documents as they were. The schema editor brings them up to date
+with a :class:`Backfill`, which runs entirely on the server and never loads
+documents into Python. It works in batches:
+
+1. ``SELECT RAW META().id ... WHERE META().id > $last AND <predicate>
+   ORDER BY META().id LIMIT n`` finds the next documents to change, walking
+   the bucket in key order so each document is only scanned once
+2. ``UPDATE ... USE KEYS $1 SET/UNSET ... WHERE <predicate>`` changes them,
+   checking the predicate again in case they were written in between
+
+Nothing is locked: the application keeps running while a backfill proceeds.
+After each batch, the progress is recorded in a checkpoint document, so an
+interrupted backfill resumes where it stopped when the migration is run
+again. Batches may be throttled to limit the load on the cluster::
+
+    'OPTIONS': {'BACKFILL': {'BATCH_SIZE': 5000, 'THROTTLE_MS': 100}}
+"""
+import logging
+import time
+
+from django.utils import timezone
+
+from couchbase.exceptions import NotFoundError
+from couchbase.n1ql import N1QLQuery, CONSISTENCY_REQUEST
+
+from .compiler import TYPEFIELD
+from .transcoder import NATIVE_TYPES, encode_default
+from .utils import n1ql_escape, DocID
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+CHECKPOINT_PREFIX = '__cbbackfill::'
+
+
+def checkpoint_key(table, name):
+    return '{0}{1}::{2}'.format(CHECKPOINT_PREFIX, table, name)
+
+
+def default_for_db(schema_editor, field):
+    """
+    Get the value documents lacking a field should be given, as stored
+    :return: The value, or None if the field may be missing
+    """
+    connection = schema_editor.connection
+    value = schema_editor.effective_default(field)
+    if value is None:
+        return None
+    if field.rel:
+        return DocID.encode(connection.table_name(field.rel.to), value)
+
+    value = connection.ops.value_for_db(value, field)
+    if isinstance(value, NATIVE_TYPES):
+        # Left to the codec when storing documents; parameters are plain JSON,
+        # encoded the same way
+        value = encode_default(value)
+    return value
+
+
+class Backfill(object):
+    def __init__(self, connection, model, batch_size=DEFAULT_BATCH_SIZE, throttle_ms=0):
+        """
+        :param connection: The DatabaseWrapper
+        :param model: The model whose documents are changed
+        :param batch_size: Number of documents changed per UPDATE
+        :param throttle_ms: How long to pause between batches, in milliseconds
+        """
+        self.connection = connection
+        self.model = model
+        self.batch_size = batch_size
+        self.throttle = throttle_ms / 1000.0
+        self.bucket = connection.get_bucket(connection.get_bucket_name_for(model))
+
+    @classmethod
+    def from_settings(cls, connection, model):
+        options = connection.settings_dict.get('OPTIONS', {}).get('BACKFILL', {})
+        return cls(connection, model, options.get('BATCH_SIZE', DEFAULT_BATCH_SIZE),
+                   options.get('THROTTLE_MS', 0))
+
+    def set_default(self, column, value):
+        """ Give documents lacking a column its default value """
+        return self.run('set:' + column, '{c} IS MISSING'.format(c=n1ql_escape(column)),
+                        'SET {c} = $2'.format(c=n1ql_escape(column)), [value])
+
+    def fill_nulls(self, column, value):
+        """ Replace null (or missing) values of a column that no longer allows them """
+        return self.run('fill:' + column, '{c} IS NOT VALUED'.format(c=n1ql_escape(column)),
+                        'SET {c} = $2'.format(c=n1ql_escape(column)), [value])
+
+    def rename(self, old_column, new_column):
+        old, new = n1ql_escape(old_column), n1ql_escape(new_column)
+        return self.run('rename:{0}:{1}'.format(old_column, new_column),
+                        '{0} IS NOT MISSING'.format(old),
+                        'SET {1} = {0} UNSET {0}'.format(old, new))
+
+    def unset(self, column):
+        """ Remove a column from the documents """
+        return self.run('unset:' + column, '{c} IS NOT MISSING'.format(c=n1ql_escape(column)),
+                        'UNSET {c}'.format(c=n1ql_escape(column)))
+
+    def _load_checkpoint(self, key):
+        try:
+            checkpoint = self.bucket.get(key).value
+        except NotFoundError:
+            checkpoint = None
+        if checkpoint is None or checkpoint['complete']:
+            # Start over
+            checkpoint = {'last_key': '', 'processed': 0, 'complete': False,
+                          'started': timezone.now().isoformat()}
+        return checkpoint
+
+    def run(self, name, predicate, mutation, params=()):
+        """
+        Apply a mutation to all the documents of the model matching a
+        predicate, resuming from the checkpoint of an interrupted run
+        :param name: Identifies the backfill, for its checkpoint
+        :param predicate: A N1QL condition on the documents to change
+        :param mutation: The SET and/or UNSET clauses. Their parameters start at $2
+        :param params: The values of these parameters
+        :return: The number of documents changed
+        """
+        table = self.connection.table_name(self.model)
+        key = checkpoint_key(table, name)
+        checkpoint = self._load_checkpoint(key)
+
+        b = n1ql_escape(self.bucket.bucket)
+        select = 'SELECT RAW META({b}).id FROM {b} WHERE {tf} = $1 AND META({b}).id > $2 ' \
+                 'AND {pred} ORDER BY META({b}).id LIMIT {limit}'.format(
+                     b=b, tf=TYPEFIELD, pred=predicate, limit=int(self.batch_size))
+        update = 'UPDATE {b} USE KEYS $1 {mutation} WHERE {pred} RETURNING RAW META({b}).id'.format(
+            b=b, mutation=mutation, pred=predicate)
+
+        cache = self.connection.doc_cache
+        while True:
+            nq = N1QLQuery(select, table, checkpoint['last_key'])
+            nq.consistency = CONSISTENCY_REQUEST
+            ids = list(self.bucket.n1ql_query(nq))
+            if not ids:
+                break
+
+            changed = list(self.bucket.n1ql_query(N1QLQuery(update, ids, *params)))
+            if cache:
+                cache.invalidate_multi(changed)
+
+            checkpoint['last_key'] = ids[-1]
+            checkpoint['processed'] += len(changed)
+            checkpoint['updated'] = timezone.now().isoformat()
+            self.bucket.upsert(key, checkpoint)
+            logger.info("Backfill %s of %s: %d documents", name, table, checkpoint['processed'])
+
+            if self.throttle:
+                time.sleep(self.throttle)
+
+        checkpoint['complete'] = True
+        checkpoint['updated'] = timezone.now().isoformat()
+        self.bucket.upsert(key, checkpoint)
+        return checkpoint['processed']
@@ -1,4 +1,6 @@
+from itertools import islice
 from pprint import pprint
+from uuid import uuid4
 
 from django.db import DatabaseError
 from django.db.backends.base.operations import BaseDatabaseOperations
@@ -10,18 +12,32 @@ from django.db.backends.base.validation import BaseDatabaseValidation
 from django.db.backends.base.creation import BaseDatabaseCreation
 from django.db.backends.base.schema import BaseDatabaseSchemaEditor
 
+from django.apps import apps
+from django.conf import settings
 from django.utils.dateparse import parse_datetime, parse_date
 
 
 from couchbase.bucket import Bucket
 from couchbase.connstr import ConnectionString
+from couchbase.n1ql import N1QLQuery, CONSISTENCY_REQUEST
 
 import cbdjango.db.backends.couchbase.dbapi as Database
-from .utils import n1ql_escape, DocID
+from .utils import n1ql_escape, DocID, model_label, prefix_range
 from .compiler import SelectCommand, InsertCommand, UpdateCommand, FlushCommand,\
-    DeleteCommand, CreateIndexCommand
-
-from .operators import DateTransformField
+    DeleteCommand, CreateIndexCommand, BUCKET_PLACEHOLDER
+
+from .operators import DateTransformField, Transforms
+from .scan import BucketPool
+from .cache import get_document_cache
+from .replica import ReplicaReads
+from .offload import OffloadPolicy
+from .indexes import functional_index_specs
+from .fts import FullTextSearch
+from .coalescing import current_loader
+from .counters import ModelCounters, KEY_PREFIX as COUNTER_PREFIX
+from .transcoder import CodecTranscoder, NATIVE_TYPES, get_codec
+from .backfill import Backfill, default_for_db, CHECKPOINT_PREFIX
+from . import datetimes, catalog, memory
 
 class Connection(object):
     """ Dummy connection class """
@@ -50,26 +66,55 @@ class Cursor(object):
         self.bucket = connection.bucket
         self._iter = None
         self._cmd = None
+        self._bucket = None
         self._results = None
         self._lastid = None
         self.rowcount = 0
 
+    def _get_bucket(self, sql):
+        # Commands carry the name of the bucket their model is routed to
+        name = getattr(sql, 'bucket_name', None)
+        if name is None:
+            return self.bucket
+        return self.connection.wrapper.get_bucket(name)
+
     def execute(self, sql, *args):
         self._cmd = sql
+        self._bucket = bucket = self._get_bucket(sql)
+
+        if not isinstance(sql, SelectCommand):
+            # Documents loaded by the read scope may be modified
+            loader = current_loader(self.connection.wrapper.alias)
+            if loader is not None:
+                loader.clear()
+
+        uow = self.connection.wrapper.unit_of_work
+        if uow is not None:
+            buffered, result = uow.buffer(sql, *args)
+            if buffered:
+                if isinstance(sql, InsertCommand):
+                    self._results = result
+                    self._iter = iter(result)
+                else:
+                    self.rowcount = result
+                return
+            # Anything else must see the pending writes
+            uow.flush()
+
         if isinstance(sql, SelectCommand):
-            self._iter = iter(sql.execute(self.bucket))
+            self._iter = iter(sql.execute(bucket))
             self._results = None
         elif isinstance(sql, InsertCommand):
-            self._results = sql.execute(self.bucket, *args).values()
+            self._results = sql.execute(bucket, *args).values()
             self._iter = iter(self._results)
         elif isinstance(sql, UpdateCommand):
-            self.rowcount = sql.execute(self.bucket)
+            self.rowcount = sql.execute(bucket)
         elif isinstance(sql, FlushCommand):
-            sql.execute(self.bucket)
+            sql.execute(bucket)
         elif isinstance(sql, DeleteCommand):
-            self.rowcount = sql.execute(self.bucket)
+            self.rowcount = sql.execute(bucket)
         elif isinstance(sql, CreateIndexCommand):
-            sql.execute(self.bucket)
+            sql.execute(bucket)
 
     # def next(self):
     #     return self._fetchone()
@@ -81,11 +126,15 @@ class Cursor(object):
 
         else:
             # Results is a column. Unpack the query
-            rv = self._cmd.dict_to_row(rv)
+            rv = self._convert_rows([rv])[0]
 
         print "Returning:", rv
         return rv
 
+    def _convert_rows(self, rows):
+        self._cmd.resolve_offloaded(self._bucket, rows)
+        return [self._cmd.convert_row(x) for x in rows]
+
     def fetchone(self, delete_flag=False):
         try:
             return self._fetchone(delete_flag)
@@ -93,14 +142,27 @@ class Cursor(object):
             return None
 
     def fetchmany(self, size, delete_flag=False):
-        rv = []
-        for x in range(size):
-            row = self.fetchone(delete_flag)
-            if not row:
-                break
-            rv.append(row)
+        if self._results:
+            rv = []
+            for x in range(size):
+                row = self.fetchone(delete_flag)
+                if not row:
+                    break
+                rv.append(row)
 
-        return rv
+            return rv
+
+        # Convert the whole batch at once, so that offloaded values of all
+        # its rows are fetched together
+        return self._convert_rows(list(islice(self._iter, size)))
+
+    @property
+    def may_be_stale(self):
+        """
+        Whether any of the rows of the last query were read from a replica,
+        and so may not reflect the latest writes
+        """
+        return bool(getattr(self._cmd, 'stale_keys', None))
 
     @property
     def lastrowid(self):
@@ -173,8 +235,79 @@ class DatabaseCreation(BaseDatabaseCreation):
         #     return [CreateIndexCommand(s)]
         return []
 
+    def _set_namespace(self, settings_dict, namespace):
+        # OPTIONS may be shared with the settings of other connections
+        options = dict(settings_dict.get('OPTIONS', {}))
+        options['NAMESPACE'] = namespace
+        settings_dict['OPTIONS'] = options
+
     def create_test_db(self, verbosity=1, autoclobber=False, serialize=True, keepdb=False):
-        return 'test_'
+        """
+        Rather than creating a database, isolate the test run in a namespace
+        of the buckets: the types and document IDs it writes are prefixed by
+        it, so it only sees its own documents. The namespace is random unless
+        set with the ``NAMESPACE`` entry of the ``TEST`` settings
+        """
+        self._old_namespace = self.connection.namespace
+        namespace = self.connection.settings_dict.get('TEST', {}).get('NAMESPACE') or \
+            'test_{0}_'.format(uuid4().hex[:8])
+
+        if verbosity >= 1:
+            print "Using test namespace", namespace, "for alias", self.connection.alias
+        self._set_namespace(self.connection.settings_dict, namespace)
+        self._set_namespace(settings.DATABASES[self.connection.alias], namespace)
+        return self.connection.settings_dict['NAME']
+
+    def get_test_db_clone_settings(self, number):
+        """ Each parallel test process gets its own namespace """
+        settings_dict = self.connection.settings_dict.copy()
+        self._set_namespace(settings_dict, '{0}{1}_'.format(self.connection.namespace, number))
+        return settings_dict
+
+    def _clone_test_db(self, number, verbosity, keepdb=False):
+        # Namespaces start out empty; there is nothing to copy
+        pass
+
+    def _destroy_namespace(self, namespace):
+        """
+        Remove every document of a namespace, with a single DELETE per bucket.
+        The key ranges of the namespace are those of its documents (and their
+        side documents), counters and backfill checkpoints
+        """
+        ranges = []
+        params = []
+        for prefix in (namespace, COUNTER_PREFIX + namespace, CHECKPOINT_PREFIX + namespace):
+            # Keys starting with the prefix
+            ranges.append('(META().id >= ${0} AND META().id < ${1})'.format(
+                len(params) + 1, len(params) + 2))
+            params += prefix_range(prefix)
+
+        for name in self.connection.get_bucket_names():
+            bucket = self.connection.get_bucket(name)
+            nq = N1QLQuery('DELETE FROM {0} WHERE {1}'.format(
+                n1ql_escape(bucket.bucket), ' OR '.join(ranges)), *params)
+            nq.consistency = CONSISTENCY_REQUEST
+            bucket.n1ql_query(nq).execute()
+            catalog.unregister_namespace(bucket, namespace)
+
+        if self.connection.doc_cache:
+            self.connection.doc_cache.clear()
+
+    def destroy_test_db(self, old_database_name=None, verbosity=1, keepdb=False, number=None):
+        if number is not None:
+            namespace = self.get_test_db_clone_settings(number)['OPTIONS']['NAMESPACE']
+        else:
+            namespace = self.connection.namespace
+
+        if not keepdb and namespace:
+            if verbosity >= 1:
+                print "Destroying test namespace", namespace, "for alias", self.connection.alias
+            self._destroy_namespace(namespace)
+
+        if number is None:
+            old_namespace = getattr(self, '_old_namespace', '')
+            self._set_namespace(self.connection.settings_dict, old_namespace)
+            self._set_namespace(settings.DATABASES[self.connection.alias], old_namespace)
 
 
 class DatabaseFeatures(BaseDatabaseFeatures):
@@ -209,6 +342,16 @@ class DatabaseOperations(BaseDatabaseOperations):
     def fetch_returned_insert_id(self, cursor):
         return cursor.lastrowid
 
+    def date_trunc_sql(self, lookup_type, field_name):
+        # Django compiles the Date() of dates() with this, but the
+        # SelectCommand projects it itself
+        return Transforms.transform(lookup_type, field_name)[0]
+
+    def datetime_trunc_sql(self, lookup_type, field_name, tzname):
+        sql, _ = Transforms.transform(lookup_type, field_name,
+                                      self.connection.datetime_storage, tzname)
+        return sql, []
+
     def convert_values(self, value, field):
         # Normalize the DocID back
         if field.primary_key:
@@ -227,17 +370,34 @@ class DatabaseOperations(BaseDatabaseOperations):
             return DocID.decode(value).to_int()
         elif field.get_internal_type() == 'DateTimeField':
             # print "Converting DateTimeField..", value
-            value = parse_datetime(value)
             if isinstance(field, DateTransformField):
-                value = field.convert(value)
+                # Truncated server-side, and not in the storage format
+                return field.convert(value)
+            if self.connection.datetime_storage == datetimes.STRING:
+                value = parse_datetime(value)
+            else:
+                value = datetimes.from_storage(value)
             return value
         elif field.get_internal_type() == 'DateField':
             return parse_date(value)
         else:
             return value
 
+    def value_to_db_datetime(self, value):
+        mode = self.connection.datetime_storage
+        if mode == datetimes.STRING:
+            return super(DatabaseOperations, self).value_to_db_datetime(value)
+        return datetimes.to_storage(value, mode)
+
     def sql_flush(self, style, tables, seqs, allow_cascade=False):
-        return [FlushCommand(tables)]
+        namespace = self.connection.namespace
+        if not namespace:
+            return [FlushCommand(self.connection, tables)]
+        if not tables:
+            # An empty list would flush every bucket entirely
+            return []
+        # Only the key ranges of the namespace's documents can be removed
+        return [FlushCommand(self.connection, [namespace + x for x in tables], by_key=True)]
 
     def value_for_db(self, value, field):
         if value is None:
@@ -245,6 +405,13 @@ class DatabaseOperations(BaseDatabaseOperations):
 
         db_type = field.db_type(self.connection)
 
+        native = ('date', 'time')
+        if self.connection.datetime_storage == datetimes.STRING:
+            native += ('datetime',)
+        if self.connection.json_codec and db_type in native and isinstance(value, NATIVE_TYPES):
+            # The codec stores these in the same format as below
+            return value
+
         if db_type == 'string' or db_type == 'text':
             value = coerce_unicode(value)
         elif db_type == 'bytes':
@@ -276,11 +443,23 @@ class DatabaseValidation(BaseDatabaseValidation):
 
 
 class DatabaseIntrospection(BaseDatabaseIntrospection):
+    def _scan_tables(self, bucket):
+        qstr = 'SELECT DISTINCT RAW __CBTP FROM {0} WHERE __CBTP IS VALUED'.format(
+            n1ql_escape(bucket.bucket))
+        nq = N1QLQuery(qstr)
+        nq.consistency = CONSISTENCY_REQUEST
+        return list(bucket.n1ql_query(nq))
+
     def get_table_list(self, cursor):
-        cb = self.connection.get_new_connection({})
-        bucket = cb.bucket
-        qstr = 'SELECT DISTINCT __CBTP FROM {0}'.format(n1ql_escape(bucket.bucket))
-        return [TableInfo(x, "t") for x in bucket.n1ql_query(qstr)]
+        tables = []
+        for name in self.connection.get_bucket_names():
+            bucket = self.connection.get_bucket(name)
+            types = catalog.get_types(bucket, lambda: self._scan_tables(bucket))
+            # Only the types of the current namespace, as named by their models
+            namespace = self.connection.namespace
+            tables += [TableInfo(x[len(namespace):], "t") for x in sorted(types)
+                       if x.startswith(namespace)]
+        return tables
 
 
 class DatabaseSchemaEditor(BaseDatabaseSchemaEditor):
@@ -288,20 +467,87 @@ class DatabaseSchemaEditor(BaseDatabaseSchemaEditor):
         return "", {}
 
     def create_model(self, model):
-        """ Don't do anything when creating tables """
-        pass
+        """
+        Documents need no table; only create the functional indexes configured
+        for the model
+        """
+        bucket_name = self.connection.get_bucket_name_for(model)
+        specs = functional_index_specs(self.connection, model)
+        cmd = CreateIndexCommand(specs, bucket_name)
+        if specs:
+            with self.connection.cursor() as cursor:
+                cursor.execute(cmd)
+
+        indexes = dict((name, stmt.replace(BUCKET_PLACEHOLDER, bucket_name))
+                       for name, stmt in cmd.specs.items())
+        bucket = self.connection.get_bucket(bucket_name)
+        catalog.register_type(bucket, model, self.connection.table_name(model), indexes,
+                              self._scan(bucket))
+
+    def delete_model(self, model):
+        """ Documents are not removed, but the type is no longer listed """
+        bucket = self.connection.get_bucket(self.connection.get_bucket_name_for(model))
+        catalog.unregister_type(bucket, self.connection.table_name(model))
 
     def alter_unique_together(self, *args, **kwargs):
         pass
 
-    def alter_field(self, from_model, from_field, to_field):
-        pass
+    def _get_bucket(self, model):
+        return self.connection.get_bucket(self.connection.get_bucket_name_for(model))
+
+    def _scan(self, bucket):
+        # Creates the catalog of a bucket lacking one with all its types
+        return lambda: self.connection.introspection._scan_tables(bucket)
+
+    def _update_fields(self, model, added=(), removed=()):
+        bucket = self._get_bucket(model)
+        catalog.update_fields(bucket, self.connection.table_name(model), added, removed,
+                              self._scan(bucket))
+
+    def add_field(self, model, field):
+        """ Give existing documents the default value of the new field """
+        if field.get_internal_type() == 'ManyToManyField':
+            if field.rel.through._meta.auto_created:
+                self.create_model(field.rel.through)
+            return
+
+        value = default_for_db(self, field)
+        if value is not None:
+            Backfill.from_settings(self.connection, model).set_default(field.column, value)
+        self._update_fields(model, added=[field.column])
+
+    def alter_field(self, from_model, from_field, to_field, strict=False):
+        """
+        Rename the field in existing documents, and fill its null values if
+        it no longer allows them. Values are not converted between types
+        """
+        if to_field.get_internal_type() == 'ManyToManyField':
+            return
+
+        backfill = Backfill.from_settings(self.connection, from_model)
+        if from_field.column != to_field.column:
+            backfill.rename(from_field.column, to_field.column)
+            self._update_fields(from_model, added=[to_field.column],
+                                removed=[from_field.column])
+
+        if from_field.null and not to_field.null:
+            value = default_for_db(self, to_field)
+            if value is not None:
+                backfill.fill_nulls(to_field.column, value)
 
     def remove_field(self, from_model, field):
-        pass
+        """ Remove the field from existing documents """
+        if field.get_internal_type() == 'ManyToManyField':
+            if field.rel.through._meta.auto_created:
+                self.delete_model(field.rel.through)
+            return
+
+        Backfill.from_settings(self.connection, from_model).unset(field.column)
+        self._update_fields(from_model, removed=[field.column])
 
 
 class DatabaseWrapper(BaseDatabaseWrapper):
+    vendor = 'couchbase'
     Database = Database
 
     def __init__(self, *args, **kwds):
@@ -313,6 +559,15 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         self.validation = DatabaseValidation(self)
         self.introspection = DatabaseIntrospection(self)
         self._buckets = {}
+        self._bucket_pools = {}
+        self.doc_cache = get_document_cache(self.alias, self.settings_dict)
+        self.replica_reads = ReplicaReads.from_settings(self, self.settings_dict)
+        self.offload = OffloadPolicy.from_settings(self.settings_dict)
+        self.fts = FullTextSearch.from_settings(self, self.settings_dict)
+        self.counters = ModelCounters.from_settings(self, self.settings_dict)
+        self.unit_of_work = None
+        self.json_codec = get_codec(self.settings_dict)
+        self.datetime_storage = datetimes.get_mode(self.settings_dict)
 
     def schema_editor(self, *args, **kwargs):
         return DatabaseSchemaEditor(self, *args, **kwargs)
@@ -320,21 +575,90 @@ class DatabaseWrapper(BaseDatabaseWrapper):
     def get_connection_params(self):
         return {}
 
-    def get_new_connection(self, conn_params):
-        name = self.settings_dict['NAME']
-        if not name:
-            name = 'default'
+    def _open_bucket(self, name):
+        print "Connecting to bucket", name
+        if self.settings_dict['CONNECTION_STRING'].startswith(memory.SCHEME):
+            return memory.MemoryBucket(name, self.json_codec)
+        cstr = ConnectionString.parse(self.settings_dict['CONNECTION_STRING'])
+        cstr.options['fetch_mutation_tokens'] = '1'
+
+        cstr.bucket = name
+        if self.json_codec:
+            return Bucket(str(cstr), transcoder=CodecTranscoder(self.json_codec))
+        return Bucket(str(cstr))
+
+    def get_bucket_pool(self, name):
+        """
+        Get a pool of additional handles to the given bucket, for use by
+        concurrent operations
+        """
         try:
-            bucket = self._buckets[name]
+            return self._bucket_pools[name]
         except KeyError:
-            print "Connecting to bucket", name
-            cstr = ConnectionString.parse(self.settings_dict['CONNECTION_STRING'])
-            cstr.options['fetch_mutation_tokens'] = '1'
+            pool = BucketPool(lambda: self._open_bucket(name))
+            self._bucket_pools[name] = pool
+            return pool
 
-            cstr.bucket = name
-            bucket = Bucket(str(cstr))
+    def get_bucket(self, name):
+        try:
+            return self._buckets[name]
+        except KeyError:
+            bucket = self._open_bucket(name)
             self._buckets[name] = bucket
+            return bucket
+
+    def get_default_bucket_name(self):
+        return self.settings_dict['NAME'] or 'default'
+
+    def get_bucket_names(self):
+        """
+        Get the names of all buckets used by this database, default first
+        """
+        names = [self.get_default_bucket_name()]
+        routing = self.settings_dict.get('OPTIONS', {}).get('BUCKET_ROUTING', {})
+        for name in routing.values():
+            if name not in names:
+                names.append(name)
+        return names
+
+    def get_bucket_name_for(self, model):
+        """
+        Get the name of the bucket holding the documents of a model.
+
+        Models are routed with the ``BUCKET_ROUTING`` entry of the database
+        ``OPTIONS``, which maps either ``app_label.model_name`` or ``app_label``
+        to a bucket name. Unrouted models use the bucket named by ``NAME``.
+        """
+        routing = self.settings_dict.get('OPTIONS', {}).get('BUCKET_ROUTING')
+        if routing:
+            for label in (model_label(model), model._meta.app_label):
+                if label in routing:
+                    return routing[label]
+        return self.get_default_bucket_name()
+
+    @property
+    def namespace(self):
+        """
+        The prefix of the types, and so of the document IDs, of this database.
+        Set for test runs, to isolate them
+        """
+        return self.settings_dict.get('OPTIONS', {}).get('NAMESPACE', '')
+
+    def table_name(self, model):
+        """
+        Get the type of the documents of a model, as stored in ``__CBTP``
+        and at the start of their IDs
+        """
+        return self.namespace + model._meta.db_table
+
+    def get_bucket_name_for_table(self, table):
+        for model in apps.get_models(include_auto_created=True):
+            if self.table_name(model) == table:
+                return self.get_bucket_name_for(model)
+        return self.get_default_bucket_name()
 
+    def get_new_connection(self, conn_params):
+        bucket = self.get_bucket(self.get_default_bucket_name())
         return Connection(self, {}, bucket)
 
     def _set_autocommit(self, autocommit):
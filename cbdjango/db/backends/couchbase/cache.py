@@ -0,0 +1,177 @@
+"""
+In-process (L1) document cache.
+
+Documents fetched by primary key are kept in a per-process LRU cache keyed by
+their DocID, bounded both by an (approximate) memory budget and by a TTL.
+Writes made through InsertCommand, UpdateCommand and DeleteCommand in the same
+process update or invalidate the affected entries, so that only changes made by
+other processes may be observed late, for at most TTL seconds.
+
+The cache is disabled unless configured in the database ``OPTIONS``::
+
+    'OPTIONS': {
+        'DOCUMENT_CACHE': {
+            'MAX_BYTES': 64 * 1024 * 1024,
+            'TTL': 30,
+        }
+    }
+
+Statistics are available through ``connection.doc_cache.stats()``.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 30
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_document_cache(alias, settings_dict):
+    """
+    Get the document cache for a database. Django keeps one DatabaseWrapper
+    per thread, so the cache is shared between all wrappers of an alias.
+    :param alias: The database alias
+    :param settings_dict: The database settings
+    :return: A DocumentCache, or None if caching is disabled
+    """
+    options = settings_dict.get('OPTIONS', {}).get('DOCUMENT_CACHE')
+    if not options:
+        return None
+
+    with _caches_lock:
+        try:
+            return _caches[alias]
+        except KeyError:
+            cache = DocumentCache(max_bytes=options.get('MAX_BYTES', DEFAULT_MAX_BYTES),
+                                  ttl=options.get('TTL', DEFAULT_TTL))
+            _caches[alias] = cache
+            return cache
+
+
+def _docsize(value):
+    # Approximation: the size of the document as stored on the server
+    return len(json.dumps(value, separators=(',', ':'), default=str))
+
+
+class DocumentCache(object):
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        """
+        Create a document cache
+        :param max_bytes: The approximate memory budget, in bytes of encoded JSON
+        :param ttl: Maximum age of an entry, in seconds
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, cas, expiry, size)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._stats = dict.fromkeys(
+            ('hits', 'misses', 'evictions', 'expirations', 'invalidations'), 0)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry[3]
+        return entry
+
+    def get(self, key):
+        """
+        Look up a document
+        :param key: The document ID
+        :return: A tuple of (value, cas), or None if the document is not cached.
+            The value is a shallow copy which the caller may modify.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            value, cas, expiry, size = entry
+            if expiry <= now:
+                self._bytes -= size
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+
+            # Re-insert to mark as most recently used
+            self._entries[key] = entry
+            self._stats['hits'] += 1
+            return dict(value), cas
+
+    def get_multi(self, keys):
+        """
+        Look up multiple documents
+        :param keys: The document IDs
+        :return: A tuple of (hits, misses). `hits` is a dict of key -> (value, cas)
+            and `misses` a list of keys which must be fetched from the server.
+        """
+        hits = {}
+        misses = []
+        for key in keys:
+            entry = self.get(key)
+            if entry is None:
+                misses.append(key)
+            else:
+                hits[key] = entry
+        return hits, misses
+
+    def put(self, key, value, cas):
+        """
+        Store (or replace) a document
+        :param key: The document ID
+        :param value: The document, as stored on the server
+        :param cas: The CAS of the stored document
+        """
+        size = _docsize(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (dict(value), cas, time.time() + self.ttl, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, entry = self._entries.popitem(last=False)
+                self._bytes -= entry[3]
+                self._stats['evictions'] += 1
+
+    def put_multi(self, items):
+        """
+        Store multiple documents
+        :param items: An iterable of (key, value, cas)
+        """
+        for key, value, cas in items:
+            self.put(key, value, cas)
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._remove(key):
+                self._stats['invalidations'] += 1
+
+    def invalidate_multi(self, keys):
+        for key in keys:
+            self.invalidate(key)
+
+    def clear(self):
+        with self._lock:
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Get cache statistics
+        :return: A dict with the hit, miss, eviction, expiration and
+            invalidation counters, and the current number of entries and bytes
+        """
+        with self._lock:
+            rv = dict(self._stats)
+            rv['entries'] = len(self._entries)
+            rv['bytes'] = self._bytes
+            return rv
@@ -0,0 +1,183 @@
+"""
+Catalog of the types (tables) stored in a bucket.
+
+Listing the tables of a bucket otherwise requires a ``SELECT DISTINCT`` over
+every document. Instead, each bucket holds a catalog document listing the
+types it contains, with their fields and the indexes created for them::
+
+    {
+        "types": {
+            "blog_entry": {
+                "fields": ["title", "body", "pub_date"],
+                "indexes": {"ix_blog_entry_title_iexact": "CREATE INDEX ..."}
+            }
+        }
+    }
+
+It is updated by the schema editor, and by inserts the first time a process
+writes a type which is not listed yet. Introspection reads it with a single KV
+get, and only scans the bucket (and records what it found) if the catalog does
+not exist yet. The catalog of a bucket written before catalogs existed must
+list all its types, so it is only ever created from such a scan: inserts
+leave a missing catalog missing.
+"""
+import threading
+
+from couchbase.exceptions import KeyExistsError, NotFoundError
+
+CATALOG_KEY = '__cbcatalog'
+
+# Number of attempts to update a catalog modified concurrently
+CAS_RETRIES = 10
+
+# (bucket name, table) pairs known to be listed, to skip the catalog on inserts
+_known = set()
+_lock = threading.Lock()
+
+
+def _update(bucket, fn, scan=None):
+    """
+    Apply a change to the catalog of a bucket, with CAS
+    :param fn: A callable modifying the `types` dict in place. It returns
+        False if there was nothing to change
+    :param scan: A callable returning the types found in the bucket, to
+        create the catalog with if it does not exist. Without it, a missing
+        catalog is left missing
+    :return: Whether the catalog exists
+    """
+    for _ in range(CAS_RETRIES):
+        try:
+            res = bucket.get(CATALOG_KEY)
+            catalog, cas = res.value, res.cas
+        except NotFoundError:
+            if scan is None:
+                return False
+            types = dict((x, {'fields': [], 'indexes': {}}) for x in scan())
+            catalog, cas = {'types': types}, None
+
+        if fn(catalog['types']) is False and cas is not None:
+            return True
+
+        try:
+            if cas is None:
+                bucket.insert(CATALOG_KEY, catalog)
+            else:
+                bucket.replace(CATALOG_KEY, catalog, cas=cas)
+            return True
+        except (KeyExistsError, NotFoundError):
+            continue
+
+    raise KeyExistsError({'key': CATALOG_KEY, 'message': 'Catalog modified concurrently'})
+
+
+def _remember(bucket, tables):
+    with _lock:
+        _known.update((bucket.bucket, x) for x in tables)
+
+
+def _forget(bucket, table):
+    with _lock:
+        _known.discard((bucket.bucket, table))
+
+
+def model_fields(model):
+    return [f.column for f in model._meta.concrete_fields if not f.primary_key]
+
+
+def ensure_type(bucket, model, table):
+    """
+    Make sure the type of a model is listed, e.g. before its documents are
+    written. This only touches the catalog once per process and type. A
+    missing catalog is not created: it will list the type once created
+    :param table: The type of the documents, as namespaced by the connection
+    """
+    if (bucket.bucket, table) in _known:
+        return
+
+    def add(types):
+        if table in types:
+            return False
+        types[table] = {'fields': model_fields(model), 'indexes': {}}
+
+    _update(bucket, add)
+    _remember(bucket, [table])
+
+
+def register_type(bucket, model, table, indexes=None, scan=None):
+    """
+    List the type of a model, with its current fields
+    :param table: The type of the documents, as namespaced by the connection
+    :param indexes: A dict of index name -> definition to record
+    :param scan: Finds the types of the bucket, if the catalog must be created
+    """
+
+    def register(types):
+        entry = types.setdefault(table, {'fields': [], 'indexes': {}})
+        entry['fields'] = model_fields(model)
+        entry['indexes'].update(indexes or {})
+
+    _update(bucket, register, scan)
+    _remember(bucket, [table])
+
+
+def update_fields(bucket, table, added=(), removed=(), scan=None):
+    """
+    Record fields added to or removed from a type, e.g. by migrations
+    :param scan: Finds the types of the bucket, if the catalog must be created
+    """
+    def update(types):
+        entry = types.setdefault(table, {'fields': [], 'indexes': {}})
+        fields = [x for x in entry['fields'] if x not in removed]
+        fields += [x for x in added if x not in fields]
+        if fields == entry['fields']:
+            return False
+        entry['fields'] = fields
+
+    _update(bucket, update, scan)
+    _remember(bucket, [table])
+
+
+def unregister_type(bucket, table):
+    def unregister(types):
+        if types.pop(table, None) is None:
+            return False
+
+    _update(bucket, unregister)
+    _forget(bucket, table)
+
+
+def unregister_namespace(bucket, namespace):
+    """
+    Remove all the types of a namespace, e.g. when a test database is destroyed
+    """
+    def unregister(types):
+        tables = [x for x in types if x.startswith(namespace)]
+        if not tables:
+            return False
+        for table in tables:
+            del types[table]
+
+    _update(bucket, unregister)
+    with _lock:
+        _known.difference_update(
+            x for x in list(_known) if x[0] == bucket.bucket and x[1].startswith(namespace))
+
+
+def get_types(bucket, scan=None):
+    """
+    Get the types listed in the catalog of a bucket
+    :param scan: A callable returning the types found in the bucket, used to
+        create the catalog if it does not exist
+    :return: A dict of type -> {'fields': [...], 'indexes': {...}}
+    """
+    try:
+        types = bucket.get(CATALOG_KEY).value['types']
+    except NotFoundError:
+        if scan is None:
+            return {}
+        found = scan()
+        types = dict((x, {'fields': [], 'indexes': {}}) for x in found)
+        _update(bucket, lambda types_: False, lambda: found)
+
+    _remember(bucket, types)
+    return types
@@ -0,0 +1,240 @@
+"""
+Request-scoped coalescing of primary key reads.
+
+Templates, serializers and GraphQL resolvers often fetch related objects one
+at a time (``Model.objects.get(pk=...)``, ``entry.author``), each in its own
+round trip. Within a ``coalesced_reads()`` scope, such primary key lookups
+are served by a shared loader:
+
+- Each document is fetched at most once per scope, and then served from
+  memory. Any write through the database clears what was loaded
+- Keys can be loaded up front, in a single multi-get, with ``prime()``
+- With a ``window_ms``, lookups issued concurrently by other threads joining
+  scope with ``coalesced_reads(loader=...)`` are dispatched together as one
+  multi-get. The first lookup waits, for at most that window, until each of
+  those threads is also waiting for a lookup. Without such threads, lookups
+  are dispatched at once
+
+::
+
+    with coalesced_reads() as loader:
+        loader.prime(Author, [e.author_id for e in entries])
+        for entry in entries:
+            render(entry.author)  # no round trip
+
+    # Concurrent resolvers
+    with coalesced_reads(window_ms=2) as loader:
+        def resolve(author_id):
+            with coalesced_reads(loader=loader):
+                return Author.objects.get(pk=author_id)
+        pool.map(resolve, ids)
+
+Documents are still read according to the replica read policy of the model,
+and every caller receives its own copy of each document.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from .utils import DocID
+
+_state = threading.local()
+
+
+class _Batch(object):
+    """ Keys waiting to be fetched together """
+    def __init__(self):
+        self.keys = set()
+        self.done = threading.Event()
+        self.found = {}
+        self.stale = set()
+        self.error = None
+
+
+class ReadLoader(object):
+    def __init__(self, window_ms=0):
+        """
+        :param window_ms: How long the first lookup of a batch waits for
+            the lookups of other threads to join it, in milliseconds
+        """
+        self.window = window_ms / 1000.0
+        self._lock = threading.Lock()
+        # Notified when a thread joins or leaves, and when a lookup starts or ends
+        self._changed = threading.Condition(self._lock)
+        # Threads which joined the loader from another thread's scope
+        self._members = set()
+        # Threads running a lookup
+        self._busy = set()
+        # Key -> (value, cas, stale), or None if the document does not exist
+        self._memo = {}
+        # (bucket name, model) -> open _Batch
+        self._batches = {}
+        self.stats = {'requested': 0, 'fetched': 0, 'batches': 0}
+
+    def _join(self):
+        with self._lock:
+            self._members.add(threading.current_thread())
+            self._changed.notify_all()
+
+    def _leave(self):
+        with self._lock:
+            self._members.discard(threading.current_thread())
+            self._changed.notify_all()
+
+    def clear(self):
+        """
+        Forget all loaded documents
+        """
+        with self._lock:
+            self._memo.clear()
+
+    def get_multi(self, bucket_name, model, keys, fetch):
+        """
+        Get documents, fetching those not loaded yet in a shared batch
+        :param bucket_name: The bucket of the documents
+        :param model: The model being queried
+        :param keys: The document IDs
+        :param fetch: A callable taking a list of keys and returning a tuple of
+            (found, stale) as `ReplicaReads.get_multi` does. It is called by
+            the thread which opened the batch
+        :return: A tuple of (found, stale), as returned by `fetch`
+        """
+        thread = threading.current_thread()
+        with self._lock:
+            self._busy.add(thread)
+            self._changed.notify_all()
+        try:
+            return self._get_multi(bucket_name, model, keys, fetch)
+        finally:
+            with self._lock:
+                self._busy.discard(thread)
+                self._changed.notify_all()
+
+    def _get_multi(self, bucket_name, model, keys, fetch):
+        found = {}
+        stale = set()
+        missing = []
+        with self._lock:
+            self.stats['requested'] += len(keys)
+            for key in keys:
+                if key not in self._memo:
+                    missing.append(key)
+                elif self._memo[key] is not None:
+                    value, cas, is_stale = self._memo[key]
+                    found[key] = (dict(value), cas)
+                    if is_stale:
+                        stale.add(key)
+
+            if missing:
+                group = (bucket_name, model)
+                batch = self._batches.get(group)
+                leader = batch is None
+                if leader:
+                    batch = self._batches[group] = _Batch()
+                batch.keys.update(missing)
+
+        if not missing:
+            return found, stale
+
+        if leader:
+            self._dispatch(group, batch, fetch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+
+        for key in missing:
+            if key in batch.found:
+                value, cas = batch.found[key]
+                found[key] = (dict(value), cas)
+                if key in batch.stale:
+                    stale.add(key)
+        return found, stale
+
+    def _dispatch(self, group, batch, fetch):
+        with self._lock:
+            # Only wait while other threads may still issue a lookup
+            deadline = time.time() + self.window
+            while self._members - self._busy:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+
+            # Later lookups open a new batch
+            del self._batches[group]
+            keys = list(batch.keys)
+            self.stats['fetched'] += len(keys)
+            self.stats['batches'] += 1
+
+        try:
+            batch.found, batch.stale = fetch(keys)
+            with self._lock:
+                for key in keys:
+                    if key in batch.found:
+                        value, cas = batch.found[key]
+                        self._memo[key] = (value, cas, key in batch.stale)
+                    else:
+                        self._memo[key] = None
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def prime(self, model, pks, using=None):
+        """
+        Load the documents of a model in a single multi-get
+        :param model: The model
+        :param pks: Primary key values
+        :param using: The database alias
+        """
+        connection = connections[using or DEFAULT_DB_ALIAS]
+        table = connection.table_name(model)
+        if model._meta.pk.get_internal_type() in ('IntegerField', 'AutoField'):
+            pks = [int(x) for x in pks]
+        keys = set(DocID.encode(table, pk) for pk in pks if pk is not None)
+        if not keys:
+            return
+
+        bucket = connection.get_bucket(connection.get_bucket_name_for(model))
+        self.get_multi(bucket.bucket, model, list(keys),
+                       lambda keys_: connection.replica_reads.get_multi(bucket, keys_, model))
+
+
+def current_loader(alias):
+    """
+    Get the loader in effect for a database in this thread, if any
+    """
+    return getattr(_state, 'loaders', {}).get(alias)
+
+
+@contextmanager
+def coalesced_reads(using=None, window_ms=0, loader=None):
+    """
+    Coalesce the primary key reads of a database issued in this block.
+    :param using: The database alias
+    :param window_ms: See ReadLoader
+    :param loader: A loader to join, e.g. that of the scope of another thread
+    """
+    alias = using or DEFAULT_DB_ALIAS
+    if not hasattr(_state, 'loaders'):
+        _state.loaders = {}
+
+    prev = _state.loaders.get(alias)
+    member = loader is not None and loader is not prev
+    loader = loader or prev or ReadLoader(window_ms)
+    _state.loaders[alias] = loader
+    if member:
+        loader._join()
+    try:
+        yield loader
+    finally:
+        if member:
+            loader._leave()
+        if prev is None:
+            del _state.loaders[alias]
+        else:
+            _state.loaders[alias] = prev
@@ -1,10 +1,13 @@
+import json
 from pprint import pprint, pformat
-from couchbase.exceptions import KeyExistsError
+from couchbase.exceptions import KeyExistsError, NotFoundError
+import couchbase.subdocument as SD
 from django.db.models.expressions import Col
 import django.db
 
 from django.db.models.sql import compiler
 from django.db.models.sql.datastructures import EmptyResultSet
+from django.db.models.sql.query import Query
 from django.db.models.sql.where import EmptyWhere, WhereNode
 
 try:
@@ -20,9 +23,10 @@ except ImportError:
 
 from couchbase.n1ql import N1QLQuery, CONSISTENCY_REQUEST
 
-from .utils import n1ql_escape, DocID
+from .utils import n1ql_escape, DocID, prefix_range
 from .operators import Operators, Transforms
-from .dbapi import IntegrityError, NotSupportedError
+from .dbapi import DocumentExistsError, NotSupportedError
+from . import scan, offload, replica, datetimes, coalescing, catalog
 
 
 class Placeholders(object):
@@ -51,9 +55,14 @@ class Placeholders(object):
 TYPEFIELD = '__CBTP'
 BUCKET_PLACEHOLDER = '__BUCKET__'
 
+# Maximum number of paths in a single sub-document operation
+SUBDOC_MAX_PATHS = 16
+
+# Default maximum number of keys in the USE KEYS clause of a single statement
+USE_KEYS_CHUNK_SIZE = 1000
+
 
 def _ensure_json(val):
-    import json
     try:
         json.dumps(val)
     except TypeError:
@@ -65,18 +74,34 @@ def _quote_fields(alias, field):
 
 
 class SelectCommand(object):
-    def __init__(self, connection, query, keys_only=False, is_aggregate=False):
+    def __init__(self, connection, query, keys_only=False, is_aggregate=False, raw_rows=True,
+                 exists_only=False, params=None, subquery_alias=None):
         """
         Create a SELECT command
         :param query: The query
         :param bucket: The couchbase Bucket object
         :param keys_only: Whether to only return the ID initially
+        :param raw_rows: Whether rows are returned as arrays of values
+            (``SELECT RAW [...]``) rather than as objects keyed by alias.
+            Objects are only needed if the query is used as a subquery.
+        :param exists_only: Whether the query only checks if any row matches.
+            No values are selected, and rows convert to empty lists
+        :param params: The Placeholders to add values to. Given for queries
+            nested in the WHERE clause of another, as they share its placeholders
+        :param subquery_alias: The alias of the keyspace of a nested query.
+            A nested query selects a single value per row (``SELECT RAW x``)
         :return:
         """
         self.top_query = query
         self.connection = connection
         self._keys_only = keys_only
-        self.params = Placeholders()
+        self.raw_rows = raw_rows
+        self.exists_only = exists_only
+        self.params = params if params is not None else Placeholders()
+        self.subquery_alias = subquery_alias
+        # The keyspace documents are selected from, as used in META()
+        self.keyspace = n1ql_escape(subquery_alias or BUCKET_PLACEHOLDER)
+        self._nested_count = 0  # Number of queries nested in this one
         self.statement = []  # List of tokens to join when querying
         self._where = []
         self.is_count = True if query.annotations else False
@@ -89,21 +114,48 @@ class SelectCommand(object):
         # Used for updates, the name of the PK column
         self.pk_col_name = None
 
+        # The type (table) of the documents being queried, and its bucket
+        self.table_name = connection.table_name(query.model)
+        self.bucket_name = connection.get_bucket_name_for(query.model)
+
+        # A list of (alias, descending) for each ORDER BY term, used to merge
+        # the results of a parallel scan. None if the ordering cannot be
+        # expressed in terms of the selected fields.
+        self.order_keys = []
+
         # This is for backend-side aliases which have no equivalent in the actual
         # query. May be used for aggregates and others
         self.anon_alias_ix = 0
 
         self.is_pk_lookup = False  # Is a simple PK lookup (so we can do get/multi-get)
         self.pk_values = set()  # If PK lookup, how many PKs to select..
+        self.use_keys = None  # Keys the query is restricted to with USE KEYS
+        self._use_keys_param = None  # Index of the USE KEYS parameter
+        self._has_transforms = False  # Whether any column is computed server-side
+        self.stale_keys = set()  # Keys of documents read from a replica
+
+        # The document fields to fetch, if the query only needs some of them
+        self.projection = None
 
         # A list of (name, field) for each item added.. This appears in the order that
         # Django expects with respect to "rows".
         self.queried_fields = []
+        # The N1QL expression of each of the queried_fields
+        self.projections = []
         self.unsupported_query_message = ""
 
         self.statement = self.process_query(
             self.top_query, is_aggregate=is_aggregate, keys_only=keys_only)
 
+        # Positions of the PK and of the ORDER BY terms within array rows
+        aliases = [alias for alias, _ in self.queried_fields]
+        self.pk_index = aliases.index(self.pk_col_name) if self.pk_col_name in aliases else None
+        if self.order_keys is None:
+            self.order_positions = None
+        else:
+            self.order_positions = [(aliases.index(alias), descending)
+                                    for alias, descending in self.order_keys]
+
     def process_query(self, query, is_aggregate=False, keys_only=False):
         """
         Processes a Query object
@@ -119,8 +171,6 @@ class SelectCommand(object):
         qstr.append('FROM')
         if hasattr(query, 'subquery') and query.subquery:
             assert isinstance(query.subquery, SelectCommand)
-            pprint(vars(query))
-            pprint(vars(query.subquery))
             self.params.add_subquery_placeholders(query.subquery.params)
             qstr += ['('] + query.subquery.statement + [')', 'subquery']
         else:
@@ -130,6 +180,11 @@ class SelectCommand(object):
         if extra_where:
             where_list.append(extra_where)
 
+        if query is self.top_query and self.use_keys is not None:
+            self._use_keys_param = len(self.params.values)
+            qstr.append('USE KEYS ' + self.params.indexstr())
+            self.params.add(sorted(self.use_keys))
+
         if where_list:
             qstr.append('WHERE')
             qstr.append(' AND '.join(where_list))
@@ -170,6 +225,8 @@ class SelectCommand(object):
 
         if result:
             ordering = []
+            order_keys = []
+            selected = set(alias for alias, _ in self.queried_fields)
             for name in result:
                 if name == '?':
                     ordering.append('RANDOM()')
@@ -182,8 +239,12 @@ class SelectCommand(object):
                         direction = 'ASC'
 
                     # ORDER BY (int) is 1-based. Subtract one for lookup
-                    name = self.queried_fields[name-1][0]
-                    ordering.append(name + ' ' + direction)
+                    if self.raw_rows:
+                        order_str = self.projections[name-1]
+                    else:
+                        order_str = n1ql_escape(self.queried_fields[name-1][0])
+                    ordering.append(order_str + ' ' + direction)
+                    order_keys.append((self.queried_fields[name-1][0], direction == 'DESC'))
 
                 elif '__' not in name:
                     mm = q.model._meta
@@ -193,6 +254,17 @@ class SelectCommand(object):
                     else:
                         direction = 'ASC'
 
+                    if name in q.annotation_select and name in selected:
+                        # e.g. the truncated values of dates()
+                        ix = [alias for alias, _ in self.queried_fields].index(name)
+                        if self.raw_rows:
+                            order_str = self.projections[ix]
+                        else:
+                            order_str = n1ql_escape(name)
+                        ordering.append(order_str + ' ' + direction)
+                        order_keys.append((name, direction == 'DESC'))
+                        continue
+
                     if name == 'pk':
                         field = mm.pk
                     else:
@@ -200,11 +272,19 @@ class SelectCommand(object):
 
                     if field.primary_key:
                         # Determine the alias..
-                        order_str = 'META({}).id'.format(n1ql_escape(BUCKET_PLACEHOLDER))
+                        order_str = self._meta_id()
+                        order_key = self.pk_col_name
                     else:
                         order_str = n1ql_escape(field.column)
+                        order_key = field.column
 
                     ordering.append(order_str + ' ' + direction)
+                    order_keys.append((order_key, direction == 'DESC'))
+
+            if all(alias in selected for alias, _ in order_keys):
+                self.order_keys = order_keys
+            else:
+                self.order_keys = None
 
             result = ordering
 
@@ -215,27 +295,113 @@ class SelectCommand(object):
             # Already invalidated
             return
 
-        if child.lhs.target != self.query.get_meta().pk:
+        if child.lhs.target != self.top_query.get_meta().pk:
             # This is not a PK field
             self._nopk_where = True
             return
 
-        if parent.connector == 'NOT':
+        # Only accept constraints directly under the top-level WHERE (or its
+        # only child, which is where Django places an OR of Q objects), so that
+        # the PK values can simply be unioned.
+        root = self.top_query.where
+        if parent is not root and not (len(root.children) == 1 and root.children[0] is parent):
+            self._nopk_where = True
+            return
+
+        if parent.negated or root.negated:
             # The query wishes to exclude a given item
             self._nopk_where = True
             return
 
-        if child.lookup_name not in ('exact', 'contains'):
+        if child.lookup_name not in ('exact', 'in'):
             # This is not a direct query
             self._nopk_where = True
             return
 
-        if child.lhs.target == self.query.get_meta().pk and parent.connector != 'NOT':
-            self.is_pk_lookup = True
-            if isinstance(rhs_value, (tuple, list)):
-                self.pk_values.update(rhs_value)
-            else:
-                self.pk_values.add(rhs_value)
+        if self.is_pk_lookup and parent.connector == 'AND':
+            # pk=x AND pk=y is an intersection, let the server handle it
+            self._nopk_where = True
+            return
+
+        self.is_pk_lookup = True
+        if isinstance(rhs_value, (tuple, list)):
+            self.pk_values.update(rhs_value)
+        else:
+            self.pk_values.add(rhs_value)
+
+    def _is_use_keys_constraint(self, parent, child):
+        """
+        Whether a constraint restricts the query to a set of document IDs
+        which all results must be among, so that it can be expressed with
+        USE KEYS rather than evaluated on every document
+        """
+        root = self.top_query.where
+        if parent is not root or root.negated or root.connector != 'AND':
+            return False
+        if getattr(self.top_query, 'subquery', None):
+            # USE KEYS only applies to a keyspace
+            return False
+        if child.lookup_name not in ('exact', 'in'):
+            return False
+        target = child.lhs.target
+        return target == self.top_query.get_meta().pk and not target.rel
+
+    def _add_use_keys(self, rhs_value):
+        if isinstance(rhs_value, (list, tuple)):
+            keys = set(rhs_value)
+        else:
+            keys = set([rhs_value])
+
+        if self.use_keys is None:
+            self.use_keys = keys
+        else:
+            self.use_keys &= keys
+
+        if not self.use_keys:
+            raise EmptyResultSet()
+
+    def _nested_constraint(self, lhs, lhs_is_key, rhs, target=None):
+        """
+        Compile ``field__in=<QuerySet>`` into ``field IN (SELECT RAW ...)``,
+        so the whole filter runs as a single query
+        :param lhs: The N1QL expression of the outer field
+        :param lhs_is_key: Whether the outer field holds document IDs (the
+            primary key, or a foreign key)
+        :param rhs: The nested QuerySet or Query
+        :param target: The name of the field to select, if not already selected
+        :return: The condition
+        """
+        # Not a key lookup, even if the nested query is
+        self._nopk_where = True
+
+        if hasattr(rhs, 'query'):
+            if target or not rhs._fields:
+                rhs = rhs.values(target or 'pk')
+            rhs = rhs.query
+        inner_query = rhs.clone()
+        if not inner_query.low_mark and inner_query.high_mark is None:
+            # Ordering does not matter for membership
+            inner_query.clear_ordering(True)
+
+        self._nested_count += 1
+        alias = '{0}_{1}'.format(self.subquery_alias or '__sq', self._nested_count)
+        try:
+            inner = SelectCommand(self.connection, inner_query, params=self.params,
+                                  subquery_alias=alias)
+        except EmptyResultSet:
+            return 'FALSE'
+
+        if inner.unsupported_query_message:
+            self.unsupported_query_message = inner.unsupported_query_message
+        elif inner.queried_fields:
+            # Document IDs only compare with document IDs
+            field = inner.queried_fields[0][1]
+            inner_is_key = field is not None and (field.primary_key or bool(field.rel))
+            if inner_is_key != lhs_is_key:
+                self.unsupported_query_message = \
+                    'Cannot compare keys and values in a nested query ({0})'.format(field)
+
+        return '{0} IN ({1})'.format(lhs, ' '.join(inner.statement))
 
     def _process_where_node(self, parent, query):
         """
@@ -253,6 +419,27 @@ class SelectCommand(object):
                 where.append(self._process_where_node(child, query))
                 continue
 
+            if hasattr(child, 'query_object'):
+                # SubqueryConstraint, for foreign keys in a QuerySet
+                if len(child.columns) != 1:
+                    raise NotSupportedError('Multi-column subqueries are not supported')
+                where.append(self._nested_constraint(
+                    n1ql_escape(child.columns[0]), True, child.query_object, child.targets[0]))
+                continue
+
+            if child.lookup_name == 'in' and \
+                    (hasattr(child.rhs, 'query') or isinstance(child.rhs, Query)):
+                real_field = child.lhs.target
+                if real_field.primary_key and not real_field.rel:
+                    lhs = self._meta_id()
+                elif real_field.rel:
+                    lhs = n1ql_escape(real_field.column)
+                else:
+                    lhs = n1ql_escape(child.lhs.output_field.column)
+                where.append(self._nested_constraint(
+                    lhs, bool(real_field.primary_key or real_field.rel), child.rhs))
+                continue
+
             # Field as represented in the query
             query_field = child.lhs.output_field
             # Field of the DB table for the model
@@ -269,11 +456,12 @@ class SelectCommand(object):
                 if real_field.rel:
                     # If we're a related field, use the foreign table,
                     # but also don't use META(id), since it's actually embedded
-                    lhs_table = real_field.related_model._meta.db_table
+                    lhs_table = self.connection.table_name(real_field.related_model)
                     lhs = real_field.column
                 else:
-                    lhs_table = query.alias_map[child.lhs.alias].table_name
-                    lhs = 'META({}).id'.format(n1ql_escape(BUCKET_PLACEHOLDER))
+                    lhs_table = self.connection.namespace + \
+                        query.alias_map[child.lhs.alias].table_name
+                    lhs = self._meta_id()
 
                 if real_field.get_internal_type() in ('IntegerField', 'AutoField'):
                     # This could be cast as a string, so cast it back as an int
@@ -290,8 +478,29 @@ class SelectCommand(object):
                 lhs = n1ql_escape(query_field.column)
                 real_field = query_field
 
+            if query is self.top_query:
+                self._maybe_add_pk_only_lookup(parent, child, rhs_value)
+                if self._is_use_keys_constraint(parent, child):
+                    self._add_use_keys(rhs_value)
+                    continue
+
+            if child.lookup_name == 'isnull':
+                # The value selects the operator rather than being a parameter
+                where.append('{0} IS {1}VALUED'.format(lhs, 'NOT ' if child.rhs else ''))
+                continue
+
+            fts_index = self.connection.fts.index_for(
+                real_field.model, real_field.column, child.lookup_name)
+            if fts_index:
+                where.append(' '.join(self.connection.fts.convert(
+                    self.params, rhs_value, lhs, self.keyspace,
+                    child.lookup_name, real_field.column, fts_index)))
+                continue
+
             placeholder = self.params.indexstr()
-            rhs_value, criteria = Operators.convert(rhs_value, lhs, placeholder, child.lookup_name, real_field)
+            rhs_value, criteria = Operators.convert(
+                rhs_value, lhs, placeholder, child.lookup_name, real_field,
+                datetime_storage=self.connection.datetime_storage)
             self.params.add(rhs_value)
 
             where.append(' '.join(criteria))
@@ -317,17 +526,20 @@ class SelectCommand(object):
         return ss
 
     def handle_extra_select(self, query):
-        # Handles extra select. For N1QL, the extra select must appear at the END
-        # of the query, but for django they must appear at the beginning of the row.
-        columns_str = []
+        # Handles extra select. For django they must appear at the beginning of the row.
         extra_field_info = []
+        extra_projections = []
         for alias, col in query.extra_select.items():
-            columns_str.append('({src}) AS {dst}'.format(src=col[0], dst=n1ql_escape(alias)))
+            extra_projections.append('({0})'.format(col[0]))
             extra_field_info.append((alias, None))
 
         if extra_field_info:
             self.queried_fields = extra_field_info + self.queried_fields
-        return columns_str
+            self.projections = extra_projections + self.projections
+
+    def _add_projection(self, expr, alias, field):
+        self.projections.append(expr)
+        self.queried_fields.append((alias, field))
 
     def get_fields(self, query, keys_only=False):
         """
@@ -335,6 +547,12 @@ class SelectCommand(object):
 
         This will also popular the 'fieldstrs' field
 
+        With only()/defer(), `projection` is set to the columns to load. N1QL
+        queries select just those; a primary key lookup of a single document
+        fetches them with a sub-document lookup. Lookups of several documents
+        (e.g. ``pk__in``) still fetch whole documents with one multi-get,
+        rather than one sub-document lookup per key.
+
         :return: The list of fields to query, properly quoted, as a string
         """
 
@@ -344,17 +562,27 @@ class SelectCommand(object):
         opts = q.get_meta()
         self.pk_col_name = pk_field.column
 
+        if self.exists_only:
+            # Documents are only checked for existence
+            self.projection = []
+            return 'RAW 1'
+
         if q.distinct_fields:
             raise Exception("Can't handle distinct_fields yet")
 
-        columns_str = []
-
         fields = []
         if not self.aggregate_only:
             if q.select:
                 fields = q.select
             elif q.default_cols:
-                fields = [Col('_dummy_', x, x) for x in opts.fields]
+                # Honour only()/defer(). Django builds model instances from
+                # the concrete fields which are loaded, in this order.
+                loaded = q.get_loaded_field_names().get(opts.concrete_model)
+                fields = [Col('_dummy_', x, x) for x in opts.concrete_fields
+                          if not loaded or x.primary_key or x.attname in loaded]
+                if loaded:
+                    self.projection = [x.target.column for x in fields
+                                       if not x.target.primary_key]
 
         # pprint(vars(q))
         for col in fields:
@@ -363,7 +591,7 @@ class SelectCommand(object):
 
             # Get the document field to select.
             if column == pk_field.column:
-                sel_field = 'META({}).id'.format(n1ql_escape(BUCKET_PLACEHOLDER))
+                sel_field = self._meta_id()
             elif keys_only:
                 continue
             else:
@@ -372,50 +600,110 @@ class SelectCommand(object):
             # See if there's a lookup type.
             if hasattr(col, 'lookup_type'):
                 # pprint(vars(q))
-                col_alias = self._gen_alias()
-                selstr, convfld = Transforms.transform(col.lookup_type, sel_field)
-                if q.distinct:
-                    self._nopk_where = True
-                    selstr = 'DISTINCT({0})'.format(selstr)
-                selstr += ' AS ' + col_alias
-                columns_str.append(selstr)
-                self.queried_fields.append((col_alias, convfld))
+                self._add_date_projection(q, col, sel_field, field, self._gen_alias())
             else:
-                if column == pk_field.column:
-                    columns_str.append(sel_field + ' AS ' + column)
-                else:
-                    columns_str.append(sel_field)
-
-                self.queried_fields.append((column, field))
+                self._add_projection(sel_field, column, field)
 
         for alias, annotation in q.annotation_select.items():
-            colspec = annotation.input_field.value
-
             if not alias:
                 alias = self._gen_alias()
 
+            if hasattr(annotation, 'lookup_type'):
+                # Date() and DateTime() of dates() and datetimes()
+                field = annotation.col.target
+                if field.primary_key:
+                    sel_field = self._meta_id()
+                else:
+                    sel_field = n1ql_escape(field.column)
+                self._add_date_projection(q, annotation, sel_field, field, alias)
+                continue
+
+            colspec = annotation.input_field.value
             fn = annotation.function
-            agstr = '{0}({1}) AS {2}'.format(fn, colspec, n1ql_escape(alias))
-            self.queried_fields.append((alias, None))
-            columns_str.append(agstr)
+            self._add_projection('{0}({1})'.format(fn, colspec), alias, None)
 
-        columns_str += self.handle_extra_select(query)
-        return ','.join(columns_str)
+        self.handle_extra_select(query)
+
+        distinct = 'DISTINCT ' if q.distinct else ''
+        if self.subquery_alias:
+            if len(self.projections) != 1:
+                self.unsupported_query_message = 'Nested queries must select a single field'
+            return distinct + 'RAW ' + ','.join(self.projections)
+        if self.raw_rows:
+            return distinct + 'RAW [' + ','.join(self.projections) + ']'
+
+        columns_str = []
+        for expr, (alias, _) in zip(self.projections, self.queried_fields):
+            columns_str.append('{0} AS {1}'.format(expr, n1ql_escape(alias)))
+        return distinct + ','.join(columns_str)
+
+    def _add_date_projection(self, q, expr, sel_field, field, alias):
+        """
+        Select a date or datetime column truncated server-side, so that
+        ``SELECT DISTINCT`` yields each truncated value once
+        :param expr: The Date or DateTime expression
+        :param sel_field: The N1QL expression of the column
+        :param field: The field of the column
+        """
+        if field.get_internal_type() == 'DateTimeField':
+            storage = self.connection.datetime_storage
+        else:
+            storage = datetimes.STRING
+        selstr, convfld = Transforms.transform(
+            expr.lookup_type, sel_field, storage, getattr(expr, 'tzname', None))
+        self._has_transforms = True
+        if q.distinct:
+            self._nopk_where = True
+        self._add_projection(selstr, alias, convfld)
 
     def get_from(self, query, where_list):
         model = query.model
-        table_name = model._meta.db_table
+        table_name = self.connection.table_name(model)
         where_list.append('({}=="{}")'.format(TYPEFIELD, table_name))
+        if self.subquery_alias:
+            # Not necessarily the bucket of the outer query
+            return '{0} AS {1}'.format(n1ql_escape(self.bucket_name), self.keyspace)
         return BUCKET_PLACEHOLDER
 
+    def _meta_id(self):
+        return 'META({}).id'.format(self.keyspace)
+
+    def convert_row(self, raw):
+        """
+        Convert a row returned by `execute` into the list of values Django expects
+        :param raw: The row, either as an array of values or as a document
+        """
+        if self.exists_only:
+            return []
+        if not isinstance(raw, list):
+            return self.dict_to_row(raw)
+
+        convert_values = self.connection.ops.convert_values
+        rv = []
+        for value, (_, field) in zip(raw, self.queried_fields):
+            if field is None or value is None:
+                rv.append(value)
+            else:
+                rv.append(convert_values(value, field))
+        return rv
+
+    def get_row_id(self, raw):
+        """
+        Get the document ID of a row returned by `execute`
+        """
+        if isinstance(raw, list):
+            return raw[self.pk_index]
+        return raw[self.pk_col_name]
+
     def dict_to_row(self, obj):
         rv = []
         for alias, field in self.queried_fields:
             try:
-                if field is None:
-                    rv.append(obj[alias])
+                value = obj[alias]
+                if field is None or value is None:
+                    rv.append(value)
                 else:
-                    rv.append(self.connection.ops.convert_values(obj[alias], field))
+                    rv.append(self.connection.ops.convert_values(value, field))
             except KeyError:
                 if field and field.null:
                     # NULL values allowed
@@ -428,55 +716,272 @@ class SelectCommand(object):
 
         return rv
 
-    def _execute_n1ql(self, bucket):
-        s = ' '.join(self.statement).replace(BUCKET_PLACEHOLDER, bucket.bucket)
+    def resolve_offloaded(self, bucket, rows):
+        """
+        Fetch the offloaded values of the selected fields of a batch of rows
+        :param bucket: The bucket
+        :param rows: A list of raw rows, as returned by `execute`
+        """
+        if rows:
+            aliases = [alias for alias, _ in self.queried_fields]
+            self.connection.offload.resolve(bucket, self.top_query.model, rows, aliases)
+
+    def _execute_n1ql(self, bucket, statement=None, params=None):
+        if statement is None:
+            statement = self.statement
+        if params is None:
+            params = self.params.values
+
+        s = ' '.join(statement).replace(BUCKET_PLACEHOLDER, bucket.bucket)
 
         print 'QUERY:', s
-        print 'PARAMS:', self.params.values
+        print 'PARAMS:', params
 
-        nq = N1QLQuery(s, *self.params.values)
+        nq = N1QLQuery(s, *params)
         nq.consistency = CONSISTENCY_REQUEST
         # nq.consistent_with_all(bucket)
 
         # Bug here, PYCBC-290, if we return the iterator
         return bucket.n1ql_query(nq)
 
+    def is_kv_lookup(self):
+        """
+        Whether this query can be served by fetching its PKs directly, without
+        involving the query service
+        """
+        q = self.top_query
+        if not self.is_pk_lookup or self._nopk_where:
+            return False
+        if self.aggregate_only or self.is_count or q.distinct or q.extra_select:
+            return False
+        if self._has_transforms or q.low_mark or getattr(q, 'subquery', None):
+            return False
+        # Multiple documents must be sorted client-side
+        return self.order_keys is not None or len(self.pk_values) <= 1
+
+    def _lookup_projection(self, bucket, key):
+        """
+        Fetch only the projected fields of a document, with a sub-document lookup.
+        Only used for single-key lookups: there is no multi-key variant, and
+        one lookup per key would cost a round trip each
+        :return: A dict of key -> (value, cas), empty if the document does not exist
+        """
+        if not self.projection:
+            specs = [SD.exists(TYPEFIELD)]
+        else:
+            specs = [SD.get(x) for x in self.projection]
+
+        try:
+            rv = bucket.lookup_in(key, *specs)
+        except NotFoundError:
+            return {}
+
+        doc = {}
+        for ix, column in enumerate(self.projection):
+            if rv.exists(ix):
+                doc[column] = rv[ix]
+        return {key: (doc, rv.cas)}
+
     def _execute_kv(self, bucket):
         print 'USING KV. Query:', self.statement
         print 'PARAMS:', self.params.values
 
-        results = bucket.get_multi(self.pk_values, quiet=True)
-        docs = []
-        for res in results.values():
-            if not res.success:
-                continue
+        # Key-only lookups come from updates and deletes, which must see the
+        # current state of the document.
+        cache = None if self._keys_only else self.connection.doc_cache
+
+        found = {}
+        keys = list(self.pk_values)
+        if cache:
+            found, keys = cache.get_multi(keys)
+
+        model = self.top_query.model
+        loader = coalescing.current_loader(self.connection.alias)
+        if keys:
+            if self._keys_only:
+                results = bucket.get_multi(keys, quiet=True)
+                fetched = dict((res.key, (res.value, res.cas))
+                               for res in results.values() if res.success)
+            elif loader is not None:
+                replica_reads = self.connection.replica_reads
+                fetched, stale = loader.get_multi(
+                    bucket.bucket, model, keys,
+                    lambda keys_: replica_reads.get_multi(bucket, keys_, model))
+                self.stale_keys.update(stale)
+            elif self.projection is not None and len(keys) == 1 and \
+                    len(self.projection) <= SUBDOC_MAX_PATHS and \
+                    self.connection.replica_reads.policy_for(model) == replica.NEVER:
+                # Partial documents are never cached
+                cache = None
+                fetched = self._lookup_projection(bucket, keys[0])
+            else:
+                fetched, stale = self.connection.replica_reads.get_multi(
+                    bucket, keys, model)
+                self.stale_keys.update(stale)
+
+            if cache:
+                cache.put_multi((k, v[0], v[1]) for k, v in fetched.items()
+                                if k not in self.stale_keys)
+            found.update(fetched)
 
+        docs = []
+        for key, (value, _) in found.items():
             if self.pk_col_name:
-                res.value[self.pk_col_name] = res.key
-            docs.append(res.value)
+                value[self.pk_col_name] = key
+            docs.append(value)
+
+        if self.order_keys and len(docs) > 1:
+            docs.sort(key=lambda doc: scan.row_sort_key(self.order_keys, doc))
+        if self.top_query.high_mark:
+            docs = docs[:self.top_query.high_mark]
 
         return docs
 
+    def is_partitionable(self):
+        """
+        Whether this query may be split into parallel key-range scans. This is
+        only possible for plain row queries over a single model whose results
+        can be concatenated (or merged, if ordered) without post-processing.
+        """
+        q = self.top_query
+        if self.aggregate_only or self.is_count or q.distinct or q.extra_select:
+            return False
+        if q.low_mark or q.high_mark:
+            return False
+        if getattr(q, 'subquery', None) or self.use_keys is not None:
+            return False
+        if self.order_keys is None or not self.queried_fields:
+            return False
+        return 'WHERE' in self.statement
+
+    def execute_range(self, bucket, low, high):
+        """
+        Execute the query, restricted to the given range of document IDs
+        :param bucket: The bucket to query
+        :param low: The inclusive lower bound, or None
+        :param high: The exclusive upper bound, or None
+        :return: An iterable of rows
+        """
+        meta_id = self._meta_id()
+        params = self.params.values[::]
+        constraints = []
+        if low is not None:
+            params.append(low)
+            constraints.append('{0} >= ${1}'.format(meta_id, len(params)))
+        if high is not None:
+            params.append(high)
+            constraints.append('{0} < ${1}'.format(meta_id, len(params)))
+
+        statement = self.statement[::]
+        if constraints:
+            ix = statement.index('WHERE') + 1
+            statement[ix] = ' AND '.join([statement[ix]] + constraints)
+
+        return self._execute_n1ql(bucket, statement, params)
+
+    @property
+    def row_order_keys(self):
+        """
+        The ORDER BY terms as (key, descending) tuples for `scan.row_sort_key`,
+        or None if rows cannot be ordered client-side
+        """
+        if self.raw_rows:
+            return self.order_positions
+        return self.order_keys
+
+    def _use_keys_chunk_size(self):
+        return self.connection.settings_dict.get('OPTIONS', {}).get(
+            'USE_KEYS_CHUNK_SIZE', USE_KEYS_CHUNK_SIZE)
+
+    def is_chunkable(self):
+        """
+        Whether the USE KEYS clause may be split over several statements, whose
+        results are concatenated (and sorted, if ordered)
+        """
+        q = self.top_query
+        if self.aggregate_only or self.is_count or q.distinct or q.extra_select:
+            return False
+        if q.low_mark or q.high_mark or self.order_keys is None:
+            return False
+        return self.use_keys is not None
+
+    def _execute_chunked(self, bucket, chunk_size):
+        keys = self.params.values[self._use_keys_param]
+        rows = []
+        for ix in range(0, len(keys), chunk_size):
+            params = self.params.values[::]
+            params[self._use_keys_param] = keys[ix:ix + chunk_size]
+            rows.extend(self._execute_n1ql(bucket, params=params))
+
+        if self.order_keys:
+            rows.sort(key=lambda row: scan.row_sort_key(self.row_order_keys, row))
+        return rows
+
+    def is_counter_count(self):
+        """
+        Whether this query counts all the documents of a model whose count is
+        kept in a counter document
+        """
+        q = self.top_query
+        if not self.raw_rows or not self.connection.counters.enabled_for(q.model):
+            return False
+        if q.where or q.distinct or q.extra_select or q.low_mark or q.high_mark:
+            return False
+        if getattr(q, 'subquery', None) or len(self.queried_fields) != 1:
+            return False
+
+        annotations = list(q.annotation_select.values())
+        if len(annotations) != 1:
+            return False
+        annotation = annotations[0]
+        return annotation.function == 'COUNT' and not annotation.extra.get('distinct') and \
+            getattr(annotation.input_field, 'value', None) == '*'
+
+    def _execute_counter_count(self, bucket):
+        def seed():
+            return list(self._execute_n1ql(bucket))[0][0]
+
+        return [[self.connection.counters.get(bucket, self.top_query.model, seed)]]
+
     def execute(self, bucket):
         if self.unsupported_query_message:
             raise NotSupportedError(self.unsupported_query_message)
 
-        # if self._nopk_where or not self.pk_values:
-        if True:
-            return self._execute_n1ql(bucket)
-        else:
+        if self.is_counter_count():
+            return self._execute_counter_count(bucket)
+
+        options = scan.current_options(self.connection)
+        if options and self.is_partitionable():
+            return scan.ParallelScan(self, bucket, *options)
+
+        if self.is_kv_lookup():
             return self._execute_kv(bucket)
 
+        chunk_size = self._use_keys_chunk_size()
+        if len(self.use_keys or ()) > chunk_size and self.is_chunkable():
+            return self._execute_chunked(bucket, chunk_size)
+        return self._execute_n1ql(bucket)
+
 
 class InsertCommand(object):
     def __init__(self, connection, model):
         self.model = model
         self.connection = connection
+        self.bucket_name = connection.get_bucket_name_for(model)
         self._executed = False
 
-    def get_params(self, objs, fields):
+    def get_params(self, objs, fields, add=True):
+        """
+        Convert objects into documents
+        :param objs: The model instances
+        :param fields: The fields to include in the documents
+        :param add: Whether the objects are being added, rather than updated.
+            Passed to `Field.pre_save`. Only added objects have their None
+            values replaced by the field defaults
+        :return: A dict of document ID -> document
+        """
         to_insert = {}
-        table = self.model._meta.db_table
+        table = self.connection.table_name(self.model)
 
         for obj in objs:
             docid = None
@@ -484,9 +989,9 @@ class InsertCommand(object):
 
             for field in fields:
                 # Process field
-                value = field.get_db_prep_save(field.pre_save(obj, True), self.connection)
+                value = field.get_db_prep_save(field.pre_save(obj, add), self.connection)
                 if value is None and field.get_internal_type() != 'AutoField':
-                    if field.has_default():
+                    if add and field.has_default():
                         value = field.get_default()
                     if value is None and not field.null:
                         raise django.db.IntegrityError(
@@ -504,7 +1009,7 @@ class InsertCommand(object):
                 assert not (value is None and field.primary_key)
 
                 if field.get_internal_type() == 'ForeignKey' and value is not None:
-                    tgt_table = field.rel.to._meta.db_table
+                    tgt_table = self.connection.table_name(field.rel.to)
                     value = DocID.encode(tgt_table, value)
 
                 # Only for string DocIDs
@@ -525,16 +1030,86 @@ class InsertCommand(object):
         # print 'Inserting:', pformat(to_insert)
         return to_insert
 
+    def _offload(self, to_insert):
+        policy = self.connection.offload
+        side_docs = {}
+        if policy.columns_for(self.model):
+            for docid, doc in to_insert.items():
+                side_docs.update(policy.split(self.model, docid, doc)[0])
+        return side_docs
+
     def execute(self, bucket, to_insert):
         if self._executed:
             raise Exception('Already executed!')
 
         self._executed = True
+        catalog.ensure_type(bucket, self.model, self.connection.table_name(self.model))
+
+        # Side documents go first. If one exists, so does its owner.
+        side_docs = self._offload(to_insert)
+        if side_docs:
+            try:
+                bucket.insert_multi(side_docs)
+            except KeyExistsError as e:
+                ok, _ = e.split_results()
+                bucket.remove_multi(ok.keys(), quiet=True)
+                raise DocumentExistsError(e)
+
         # Gets the bucket and the params. It's simple!
         try:
-            return bucket.insert_multi(to_insert)
+            results = bucket.insert_multi(to_insert)
         except KeyExistsError as e:
-            raise IntegrityError(e)
+            if side_docs:
+                # Only the side documents written above: those of the
+                # existing documents must be kept
+                _, failed = e.split_results()
+                bucket.remove_multi([k for k in side_docs if offload.owner_of(k) in failed],
+                                    quiet=True)
+            raise DocumentExistsError(e)
+
+        self.connection.counters.add(bucket, self.model, len(results))
+
+        cache = self.connection.doc_cache
+        if cache:
+            cache.put_multi((k, to_insert[k], v.cas) for k, v in results.items())
+        return results
+
+
+def pk_only_keys(select):
+    """
+    Get the document IDs a keys-only SelectCommand is restricted to, if it
+    is a plain PK lookup
+    :return: A list of IDs, or None if the documents must be queried
+    """
+    if select.is_pk_lookup and not select._nopk_where:
+        return list(select.pk_values)
+    return None
+
+
+def remove_documents(connection, bucket, model, keys, chunk_size=None):
+    """
+    Remove documents of a model, along with their side documents, and keep
+    the document counter and cache up to date. Missing documents are skipped
+    :param keys: The document IDs
+    :param chunk_size: Maximum number of documents per multi-operation
+    :return: The number of documents removed
+    """
+    keys = list(keys)
+    chunk_size = chunk_size or len(keys) or 1
+    policy = connection.offload
+    removed = 0
+    for ix in range(0, len(keys), chunk_size):
+        chunk = keys[ix:ix + chunk_size]
+        results = bucket.remove_multi(chunk, quiet=True)
+        removed += sum(1 for res in results.values() if res.success)
+        if policy.columns_for(model):
+            bucket.remove_multi(policy.side_keys(model, chunk), quiet=True)
+
+    connection.counters.add(bucket, model, -removed)
+    cache = connection.doc_cache
+    if cache:
+        cache.invalidate_multi(keys)
+    return removed
 
 
 class UpdateCommand(object):
@@ -542,51 +1117,85 @@ class UpdateCommand(object):
         self.query = query
         self.select = SelectCommand(connection, query, keys_only=True)
         self.connection = connection
+        self.bucket_name = self.select.bucket_name
+
+    def get_merge(self):
+        """
+        Get the values to merge into each updated document
+        :return: A dict of column -> value
+        """
+        merge = {}
+        for field, model, value in self.query.values:
+            if hasattr(value, 'prepare_database_save'):
+                value = value.prepare_database_save(field)
+            else:
+                value = field.get_db_prep_save(value, self.connection)
+
+            print "UPDATE: ", field, model, value, field.db_type(self.connection)
+
+            # Get the actual destination name
+            if field.get_internal_type() == 'ForeignKey':
+                if value is None:
+                    assert field.null
+                    merge[field.column] = None
+                    continue
+
+                value = DocID.encode(self.connection.table_name(field.rel.to), value)
+            else:
+                value = self.connection.ops.value_for_db(value, field)
+
+            merge[field.column] = value
+        return merge
+
+    def is_full_update(self):
+        """
+        Whether the update sets every field of the model, so that the
+        documents are entirely replaced
+        """
+        updated = set(field.column for field, _, _ in self.query.values)
+        return all(f.column in updated for f in self.query.model._meta.concrete_fields
+                   if not f.primary_key)
 
     def execute(self, bucket):
         rows = [x for x in self.select.execute(bucket)]
         # pprint(rows)
 
-        ids = [x[self.select.pk_col_name] for x in rows]
+        ids = [self.select.get_row_id(x) for x in rows]
         if not ids:
             return 0
 
         docs = bucket.get_multi(ids)
-        # pprint(vars(self.query))
+        merge = self.get_merge()
         to_update = {}
 
         for res in docs.values():
-            merge = {}
-            for field, model, value in self.query.values:
-                if hasattr(value, 'prepare_database_save'):
-                    value = value.prepare_database_save(field)
-                else:
-                    value = field.get_db_prep_save(value, self.connection)
-
-                print "UPDATE: ", field, model, value, field.db_type(self.connection)
-
-                # Get the actual destination name
-                if field.get_internal_type() == 'ForeignKey':
-                    if value is None:
-                        assert field.null
-                        merge[field.column] = None
-                        continue
-
-                    # if not isinstance(value, (basestring, int, long)):
-                    #     pprint(value)
-                    #     pprint(vars(field))
-
-                    value = DocID.encode(self.query.model._meta.db_table, value)
-                else:
-                    value = self.connection.ops.value_for_db(value, field)
-
-                merge[field.column] = value
-
             doc = res.value
             doc.update(merge)
             to_update[res.key] = doc
 
-        bucket.replace_multi(to_update)
+        # Large values are written to their side documents before the stubs
+        # pointing to them, and stale side documents are removed after.
+        policy = self.connection.offload
+        side_docs = {}
+        inline = []
+        if policy.columns_for(self.query.model):
+            columns = set(field.column for field, _, _ in self.query.values)
+            for key, doc in to_update.items():
+                side, stale = policy.split(self.query.model, key, doc, columns)
+                side_docs.update(side)
+                inline += stale
+
+        if side_docs:
+            bucket.upsert_multi(side_docs)
+
+        results = bucket.replace_multi(to_update)
+
+        if inline:
+            bucket.remove_multi(inline, quiet=True)
+
+        cache = self.connection.doc_cache
+        if cache:
+            cache.put_multi((k, to_update[k], v.cas) for k, v in results.items())
         return len(docs)
 
 
@@ -594,26 +1203,53 @@ class DeleteCommand(object):
     def __init__(self, connection, query):
         self.select = SelectCommand(connection, query, keys_only=True)
         self.connection = connection
+        self.bucket_name = self.select.bucket_name
 
     def execute(self, bucket):
         rows = [x for x in self.select.execute(bucket)]
-        ids = [x[self.select.pk_col_name] for x in rows]
+        ids = [self.select.get_row_id(x) for x in rows]
         if not ids:
             return 0
-
-        bucket.remove_multi(ids)
-        return len(ids)
+        return remove_documents(self.connection, bucket, self.select.top_query.model, ids)
 
 
 class FlushCommand(object):
-    def __init__(self, tables):
+    def __init__(self, connection, tables, by_key=False):
+        """
+        :param tables: The tables to flush. If empty, all the documents of
+            all the buckets are removed
+        :param by_key: Whether to find the documents of the tables by their
+            keys rather than by their type, so that only keys starting with
+            the tables' names can be removed
+        """
+        self.connection = connection
         self.tables = tables
-
-    def execute(self, bucket):
-        if self.tables:
-            params = self.tables
-            qstr = 'SELECT META({bucket}).id AS id FROM {bucket} WHERE {typefield} IN $1'
-            qstr = qstr.format(bucket=bucket.bucket, typefield=TYPEFIELD)
+        self.by_key = by_key
+
+    def _flush_key_ranges(self, bucket, tables):
+        # Documents, and their side documents, start with "<table>:"
+        ranges = []
+        params = []
+        for table in tables:
+            ranges.append('(META({b}).id >= ${0} AND META({b}).id < ${1})'.format(
+                len(params) + 1, len(params) + 2, b=n1ql_escape(bucket.bucket)))
+            params += prefix_range(table + DocID.DELIMITER)
+
+        nq = N1QLQuery('DELETE FROM {0} WHERE {1}'.format(
+            n1ql_escape(bucket.bucket), ' OR '.join(ranges)), *params)
+        nq.consistency = CONSISTENCY_REQUEST
+        bucket.n1ql_query(nq).execute()
+
+    def _flush_bucket(self, bucket, tables):
+        if tables and self.by_key:
+            return self._flush_key_ranges(bucket, tables)
+
+        if tables:
+            params = [tables]
+            qstr = ('SELECT META({bucket}).id AS id FROM {bucket} '
+                    'WHERE {typefield} IN $1 OR {sidetypefield} IN $1')
+            qstr = qstr.format(bucket=n1ql_escape(bucket.bucket), typefield=TYPEFIELD,
+                               sidetypefield=offload.SIDE_TYPEFIELD)
         else:
             qstr = 'SELECT META(`{0}`).id AS id FROM `{0}`'.format(bucket.bucket)
             params = []
@@ -626,18 +1262,54 @@ class FlushCommand(object):
         # else:
         #     bucket.flush()
 
+    def execute(self, bucket):
+        """
+        Remove the documents of the given tables, from whichever buckets they
+        are routed to
+        :param bucket: The default bucket. Unused
+        """
+        if self.connection.doc_cache:
+            self.connection.doc_cache.clear()
+
+        if self.tables:
+            by_bucket = {}
+            for table in self.tables:
+                name = self.connection.get_bucket_name_for_table(table)
+                by_bucket.setdefault(name, []).append(table)
+        else:
+            by_bucket = dict.fromkeys(self.connection.get_bucket_names())
+
+        for name, tables in by_bucket.items():
+            bucket = self.connection.get_bucket(name)
+            self._flush_bucket(bucket, tables)
+            if tables:
+                self.connection.counters.reset(bucket, tables)
+
 
 class CreateIndexCommand(object):
-    def __init__(self, ix_specs):
+    def __init__(self, ix_specs, bucket_name=None):
+        """
+        :param ix_specs: A list of (name, columns) or (name, keys, condition)
+            tuples. In the former form the keys are column names, in the latter
+            they are N1QL expressions, and the index only covers documents
+            matching the condition.
+        :param bucket_name: The bucket to create the indexes on
+        """
+        self.bucket_name = bucket_name
         specs = {}
-        pprint(ix_specs)
-        for name, cols in ix_specs:
-            s = 'CREATE INDEX {} ON {}({}) USING gsi'
-            s = s.format(
-                n1ql_escape(name),
-                n1ql_escape(BUCKET_PLACEHOLDER),
-                ','.join(n1ql_escape(x) for x in cols))
-            specs[name] = s
+        for spec in ix_specs:
+            if len(spec) == 2:
+                name, cols = spec
+                keys = [n1ql_escape(x) for x in cols]
+                condition = None
+            else:
+                name, keys, condition = spec
+
+            s = 'CREATE INDEX {} ON {}({})'.format(
+                n1ql_escape(name), n1ql_escape(BUCKET_PLACEHOLDER), ','.join(keys))
+            if condition:
+                s += ' WHERE ' + condition
+            specs[name] = s + ' USING gsi'
         self.specs = specs
 
     def execute(self, bucket):
@@ -669,7 +1341,29 @@ class SQLCompiler(compiler.SQLCompiler):
     def as_sql(self, with_limits=True, with_col_aliases=False, subquery=False):
         self.pre_sql_setup()
         self.refcounts_before = self.query.alias_refcount.copy()
-        return SelectCommand(self.connection, self.query, is_aggregate=self._cb_aggregate_only), None
+        cmd = SelectCommand(self.connection, self.query, is_aggregate=self._cb_aggregate_only,
+                            raw_rows=not subquery)
+        if not subquery:
+            # Filled when executed, for CouchbaseQuerySet to mark instances
+            self.query._cb_stale_keys = cmd.stale_keys
+        return cmd, None
+
+    def has_results(self):
+        """
+        Check for a matching row with ``SELECT RAW 1 ... LIMIT 1``, or with a
+        KV existence check for PK lookups
+        """
+        try:
+            cmd = SelectCommand(self.connection, self.query, exists_only=True)
+        except EmptyResultSet:
+            return False
+
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(cmd)
+            return cursor.fetchone() is not None
+        finally:
+            cursor.close()
 
     _cb_aggregate_only = False
 
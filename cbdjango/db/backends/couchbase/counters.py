@@ -0,0 +1,80 @@
+"""
+Document counters for unfiltered counts.
+
+``Model.objects.count()`` is a N1QL query counting every document of the
+model, which must also wait for the index to catch up. For models listed in
+the ``COUNTER_MODELS`` entry of the database ``OPTIONS``, the number of
+documents is instead kept in a counter document, maintained atomically by
+inserts, deletes and flushes::
+
+    'OPTIONS': {'COUNTER_MODELS': ['blog.entry']}
+
+Unfiltered counts of these models read the counter, a single KV get. A
+missing counter is seeded from a N1QL count on first use. Writes made while
+it is missing are not counted, so a counter may drift if it is seeded while
+documents are being written; :meth:`ModelCounters.reset` removes it, so it is
+seeded again.
+
+Upserts (``bulk_upsert()``, or in ``write_behind()`` a full ``save()`` of a new
+instance with a primary key) cannot tell whether they created the document,
+and also reset the counter.
+"""
+from couchbase.exceptions import NotFoundError
+
+from .utils import model_label
+
+KEY_PREFIX = '__cbcount::'
+
+
+def counter_key(table):
+    return KEY_PREFIX + table
+
+
+class ModelCounters(object):
+    def __init__(self, connection, models=()):
+        """
+        :param connection: The DatabaseWrapper
+        :param models: Labels of the models whose documents are counted
+        """
+        self.connection = connection
+        self.models = set(x.lower() for x in models)
+
+    @classmethod
+    def from_settings(cls, connection, settings_dict):
+        return cls(connection, settings_dict.get('OPTIONS', {}).get('COUNTER_MODELS', ()))
+
+    def enabled_for(self, model):
+        return bool(self.models) and model_label(model) in self.models
+
+    def add(self, bucket, model, delta):
+        """
+        Adjust the counter of a model by the number of documents added or
+        removed. Nothing is done if the counter has not been seeded yet
+        """
+        if not delta or not self.enabled_for(model):
+            return
+        try:
+            bucket.counter(counter_key(self.connection.table_name(model)), delta=delta)
+        except NotFoundError:
+            pass
+
+    def reset(self, bucket, tables):
+        """
+        Remove the counters of tables, so they are seeded again when used
+        """
+        if self.models:
+            bucket.remove_multi([counter_key(x) for x in tables], quiet=True)
+
+    def get(self, bucket, model, seed):
+        """
+        Get the number of documents of a model
+        :param seed: A callable returning the number of documents, used if
+            the counter does not exist
+        """
+        key = counter_key(self.connection.table_name(model))
+        try:
+            return bucket.get(key).value
+        except NotFoundError:
+            pass
+        # If seeded concurrently, the existing value wins
+        return bucket.counter(key, delta=0, initial=seed()).value
@@ -0,0 +1,205 @@
+"""
+Storage formats for datetime values.
+
+By default datetimes are stored as Django formats them
+(``YYYY-MM-DD HH:MM:SS[.ffffff]``). The variable width and lack of a time zone
+mean that comparisons must convert the stored value with ``STR_TO_MILLIS()``,
+which prevents any index on the field from being used.
+
+The ``DATETIME_STORAGE`` entry of the database ``OPTIONS`` selects a format
+which can be compared as stored:
+
+- ``'string'``: the default, as above
+- ``'sortable'``: UTC, fixed width ``YYYY-MM-DDTHH:MM:SS.ffffffZ``, which sorts
+  lexicographically in time order
+- ``'millis'``: UTC milliseconds since the epoch. Sub-millisecond precision is lost
+
+Values are read back according to their type, so documents written in any
+format can be loaded. Comparisons, however, are only correct once all the
+documents of a model use the configured format; use
+:func:`migrate_datetime_storage` to convert existing documents.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from couchbase.exceptions import CouchbaseError, KeyExistsError
+from couchbase.n1ql import N1QLQuery, CONSISTENCY_REQUEST
+
+from .utils import n1ql_escape, cas_items
+
+logger = logging.getLogger(__name__)
+
+STRING = 'string'
+SORTABLE = 'sortable'
+MILLIS = 'millis'
+
+MODES = (STRING, SORTABLE, MILLIS)
+
+SORTABLE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+EPOCH = datetime(1970, 1, 1)
+
+
+def get_mode(settings_dict):
+    mode = settings_dict.get('OPTIONS', {}).get('DATETIME_STORAGE', STRING)
+    if mode not in MODES:
+        raise ImproperlyConfigured('Unknown DATETIME_STORAGE: {0}'.format(mode))
+    return mode
+
+
+def _to_naive_utc(value):
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    return value
+
+
+def to_storage(value, mode):
+    """
+    Convert a datetime to its stored form
+    :param value: A datetime. Other values are assumed to be converted already
+    :param mode: The storage mode
+    """
+    if not isinstance(value, datetime):
+        return value
+
+    value = _to_naive_utc(value)
+    if mode == STRING:
+        return unicode(value)
+    elif mode == SORTABLE:
+        return value.strftime(SORTABLE_FORMAT)
+    else:
+        delta = value - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+
+def from_storage(value):
+    """
+    Convert a stored value, in any of the formats, back into a datetime
+    """
+    if isinstance(value, (int, long, float)):
+        value = EPOCH + timedelta(milliseconds=value)
+    else:
+        value = parse_datetime(value)
+        if value is None or not timezone.is_aware(value):
+            # The legacy format carries no time zone; keep it as it was
+            return value
+        value = _to_naive_utc(value)
+
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def string_expression(lhs, mode):
+    """
+    Get a N1QL expression yielding the stored datetime as a date string, for
+    use with the DATE_*_STR functions
+    """
+    if mode == MILLIS:
+        return 'MILLIS_TO_UTC({0})'.format(lhs)
+    return lhs
+
+
+def utc_string_expression(lhs, mode):
+    """
+    Get a N1QL expression yielding the stored datetime as a date string with
+    a UTC offset, for conversion to other time zones
+    """
+    if mode == STRING:
+        # Stored in UTC, without the offset
+        return 'CONCAT({0}, "Z")'.format(lhs)
+    return string_expression(lhs, mode)
+
+
+def _mismatch_predicate(column, mode):
+    # Documents whose value of the column is not in the target format
+    col = n1ql_escape(column)
+    if mode == MILLIS:
+        return '{0} IS STRING'.format(col)
+    elif mode == SORTABLE:
+        return '({0} IS NUMBER OR ({0} IS STRING AND {0} NOT LIKE "%Z"))'.format(col)
+    else:
+        return '({0} IS NUMBER OR ({0} IS STRING AND {0} LIKE "%Z"))'.format(col)
+
+
+def migrate_datetime_storage(model, mode=None, using=DEFAULT_DB_ALIAS, batch_size=500):
+    """
+    Rewrite the datetime fields of existing documents in a storage format.
+    Documents are located in batches with N1QL and rewritten with CAS, so
+    that concurrent writes are never lost. Documents which changed in
+    between are picked up again by a later batch.
+    :param model: The model to migrate
+    :param mode: The target format. Defaults to the configured DATETIME_STORAGE
+    :param using: The database alias
+    :param batch_size: Number of documents to rewrite at a time
+    :return: The number of documents rewritten
+    """
+    from .compiler import TYPEFIELD
+
+    connection = connections[using]
+    mode = mode or connection.datetime_storage
+    columns = [f.column for f in model._meta.concrete_fields
+               if f.get_internal_type() == 'DateTimeField']
+    if not columns:
+        return 0
+
+    bucket = connection.get_bucket(connection.get_bucket_name_for(model))
+    qstr = 'SELECT RAW META({b}).id FROM {b} WHERE {tf} = $1 AND ({cond}) ' \
+           'AND META({b}).id NOT IN $2 LIMIT {limit}'.format(
+               b=n1ql_escape(bucket.bucket), tf=TYPEFIELD, limit=int(batch_size),
+               cond=' OR '.join(_mismatch_predicate(c, mode) for c in columns))
+
+    failed = []
+    migrated = 0
+    while True:
+        nq = N1QLQuery(qstr, connection.table_name(model), failed)
+        nq.consistency = CONSISTENCY_REQUEST
+        ids = list(bucket.n1ql_query(nq))
+        if not ids:
+            break
+
+        docs = bucket.get_multi(ids, quiet=True)
+        to_replace = {}
+        for key, res in docs.items():
+            if not res.success:
+                # Removed in the meantime
+                continue
+
+            doc = res.value
+            try:
+                for column in columns:
+                    if doc.get(column) is not None:
+                        value = from_storage(doc[column])
+                        if value is None:
+                            raise ValueError(doc[column])
+                        doc[column] = to_storage(value, mode)
+            except (ValueError, TypeError):
+                logger.warning("Cannot convert datetime values of %s", key)
+                failed.append(key)
+                continue
+
+            to_replace[key] = (doc, res.cas)
+
+        replaced = []
+        if to_replace:
+            try:
+                bucket.replace_multi(cas_items(to_replace))
+                replaced = to_replace.keys()
+            except CouchbaseError as e:
+                ok, errors = e.split_results()
+                replaced = ok.keys()
+                # Documents modified concurrently are picked up by a later batch
+                failed += [k for k, res in errors.items()
+                           if not issubclass(CouchbaseError.rc_to_exctype(res.rc), KeyExistsError)]
+
+        if connection.doc_cache:
+            connection.doc_cache.invalidate_multi(replaced)
+        migrated += len(replaced)
+        logger.info("Migrated %d documents of %s", migrated, model._meta.db_table)
+
+    return migrated
@@ -6,6 +6,10 @@ class DatabaseError(Exception):
 class IntegrityError(DatabaseError):
     pass
 
+class DocumentExistsError(IntegrityError):
+    """ A document could not be inserted because its key exists """
+    pass
+
 class NotSupportedError(Exception):
     pass
 
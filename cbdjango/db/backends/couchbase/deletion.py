@@ -0,0 +1,211 @@
+"""
+Set-based cascading deletes.
+
+Django's deletion ``Collector`` loads the related objects of each batch of
+deleted objects, relation by relation, and deletes each batch with its own
+query: deleting a parent with many dependents costs many N1QL round trips.
+
+When no deletion signals are connected for the models involved,
+``CouchbaseQuerySet.delete()`` uses :class:`CascadeDeleter` instead, which
+only ever handles document IDs:
+
+- The dependents of each level are found with one
+  ``SELECT RAW META().id ... WHERE fk IN $2`` per relation (and chunk of keys)
+- ``SET_NULL`` relations are cleared with ``UPDATE ... USE KEYS``
+- ``PROTECT`` relations raise ``ProtectedError`` before anything is modified
+- All the documents are then removed, dependents first, in chunked
+  ``remove_multi`` batches
+
+Other ``on_delete`` handlers, multi-table inheritance, generic relations and
+foreign keys to fields other than the primary key fall back to the
+``Collector``.
+"""
+from collections import OrderedDict
+
+from django.db.models import signals
+from django.db.models.deletion import CASCADE, SET_NULL, DO_NOTHING, PROTECT, ProtectedError
+from django.db.models.sql.datastructures import EmptyResultSet
+
+try:
+    from django.db.models.deletion import get_candidate_relations_to_delete
+except ImportError:
+    def get_candidate_relations_to_delete(opts):
+        return opts.get_all_related_objects(include_hidden=True, include_proxy_eq=True)
+
+from couchbase.n1ql import N1QLQuery, CONSISTENCY_REQUEST
+
+from .compiler import SelectCommand, TYPEFIELD, remove_documents
+from .coalescing import current_loader
+from .utils import n1ql_escape
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _has_signals(model):
+    return (signals.pre_delete.has_listeners(model) or
+            signals.post_delete.has_listeners(model) or
+            signals.m2m_changed.has_listeners(model))
+
+
+class CascadeDeleter(object):
+    def __init__(self, connection, using, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param connection: The DatabaseWrapper
+        :param using: The database alias
+        :param chunk_size: Maximum number of keys per query or multi-operation
+        """
+        self.connection = connection
+        self.using = using
+        self.chunk_size = chunk_size
+
+    def can_delete(self, model, _seen=None):
+        """
+        Whether deleting objects of a model, and whatever cascades from them,
+        can be done without the Collector
+        """
+        seen = _seen if _seen is not None else set()
+        model = model._meta.concrete_model
+        if model in seen:
+            return True
+        seen.add(model)
+
+        opts = model._meta
+        if opts.parents or _has_signals(model):
+            return False
+        if any(hasattr(f, 'bulk_related_objects') for f in getattr(opts, 'virtual_fields', ())):
+            # Generic relations
+            return False
+
+        for related in get_candidate_relations_to_delete(opts):
+            field = related.field
+            on_delete = field.rel.on_delete
+            if on_delete is DO_NOTHING:
+                continue
+            if field.primary_key or not field.rel.get_related_field().primary_key:
+                # The foreign key is not stored as the document ID of its target
+                return False
+            if on_delete is CASCADE:
+                if not self.can_delete(field.model, seen):
+                    return False
+            elif on_delete not in (SET_NULL, PROTECT):
+                return False
+        return True
+
+    def _bucket_for(self, model):
+        return self.connection.get_bucket(self.connection.get_bucket_name_for(model))
+
+    def _chunks(self, keys):
+        for ix in range(0, len(keys), self.chunk_size):
+            yield keys[ix:ix + self.chunk_size]
+
+    def _dependents(self, field, keys):
+        """
+        Get the IDs of the documents referring to any of `keys` through a
+        foreign key
+        """
+        model = field.model
+        bucket = self._bucket_for(model)
+        qstr = 'SELECT RAW META({b}).id FROM {b} WHERE {tf} = $1 AND {col} IN $2'.format(
+            b=n1ql_escape(bucket.bucket), tf=TYPEFIELD, col=n1ql_escape(field.column))
+
+        found = []
+        for chunk in self._chunks(keys):
+            nq = N1QLQuery(qstr, self.connection.table_name(model), chunk)
+            nq.consistency = CONSISTENCY_REQUEST
+            found.extend(bucket.n1ql_query(nq))
+        return found
+
+    def _protected(self, model, field, keys):
+        pk = field.model._meta.pk
+        pks = [self.connection.ops.convert_values(key, pk) for key in keys]
+        objs = field.model._base_manager.using(self.using).filter(pk__in=pks)
+        return ProtectedError(
+            "Cannot delete some instances of model '{0}' because they are "
+            "referenced through a protected foreign key: '{1}.{2}'".format(
+                model.__name__, field.model.__name__, field.name), objs)
+
+    def collect(self, model, keys):
+        """
+        Find the documents to remove and the foreign keys to clear
+        :param model: The model of the documents being deleted
+        :param keys: Their IDs
+        :return: A tuple of (to_remove, to_clear). `to_remove` is an OrderedDict
+            of model -> IDs, in the order they were found. `to_clear` is a list
+            of (field, IDs) of the documents whose field must be set to null
+        """
+        to_remove = OrderedDict()
+        to_clear = []
+        level = [(model._meta.concrete_model, keys)]
+        while level:
+            next_level = []
+            for model, keys in level:
+                seen = to_remove.setdefault(model, OrderedDict())
+                keys = [k for k in keys if k not in seen]
+                if not keys:
+                    continue
+                seen.update((k, None) for k in keys)
+
+                for related in get_candidate_relations_to_delete(model._meta):
+                    field = related.field
+                    on_delete = field.rel.on_delete
+                    if on_delete is DO_NOTHING:
+                        continue
+                    found = self._dependents(field, keys)
+                    if not found:
+                        continue
+                    if on_delete is PROTECT:
+                        raise self._protected(model, field, found)
+                    elif on_delete is SET_NULL:
+                        to_clear.append((field, found))
+                    else:
+                        next_level.append((field.model._meta.concrete_model, found))
+            level = next_level
+
+        return OrderedDict((m, list(keys)) for m, keys in to_remove.items() if keys), to_clear
+
+    def _clear(self, field, keys):
+        bucket = self._bucket_for(field.model)
+        qstr = 'UPDATE {0} USE KEYS $1 SET {1} = NULL'.format(
+            n1ql_escape(bucket.bucket), n1ql_escape(field.column))
+        for chunk in self._chunks(keys):
+            bucket.n1ql_query(N1QLQuery(qstr, chunk)).execute()
+
+        cache = self.connection.doc_cache
+        if cache:
+            cache.invalidate_multi(keys)
+
+    def delete(self, queryset):
+        """
+        Delete the objects of a QuerySet, and cascade
+        :return: A tuple of (total, {model label: count}) of the documents removed
+        """
+        connection = self.connection
+        if connection.unit_of_work is not None:
+            # Pending writes may add dependents
+            connection.unit_of_work.flush()
+        loader = current_loader(connection.alias)
+        if loader is not None:
+            loader.clear()
+
+        try:
+            select = SelectCommand(connection, queryset.query, keys_only=True)
+        except EmptyResultSet:
+            return 0, {}
+        bucket = connection.get_bucket(select.bucket_name)
+        keys = [select.get_row_id(x) for x in select.execute(bucket)]
+
+        to_remove, to_clear = self.collect(queryset.model, keys)
+        for field, keys in to_clear:
+            removed = set(to_remove.get(field.model._meta.concrete_model, ()))
+            keys = [k for k in keys if k not in removed]
+            if keys:
+                self._clear(field, keys)
+
+        counts = {}
+        # Dependents first, so that nothing is left dangling if interrupted
+        for model, keys in reversed(list(to_remove.items())):
+            opts = model._meta
+            label = '{0}.{1}'.format(opts.app_label, opts.object_name)
+            counts[label] = remove_documents(
+                connection, self._bucket_for(model), model, keys, self.chunk_size)
+        return sum(counts.values()), counts
@@ -0,0 +1,141 @@
+"""
+Full-text search for text lookups.
+
+``contains`` filters compile to ``LIKE "%x%"``, which no GSI index can serve,
+so they scan every document of the model. Fields listed in the ``FTS_FIELDS``
+entry of the database ``OPTIONS`` are instead filtered with the N1QL
+``SEARCH()`` predicate, using a Full Text Search index::
+
+    'OPTIONS': {
+        'FTS_FIELDS': {
+            'blog.entry': {'INDEX': 'entry_fts', 'FIELDS': ['title', 'body']},
+        }
+    }
+
+For these fields:
+
+- ``search`` matches the analyzed terms of the value (``match`` query)
+- ``icontains`` matches the value as a phrase (``match_phrase`` query)
+- ``contains`` matches the phrase, and is then rechecked with ``LIKE`` so
+  that it remains case sensitive
+
+The predicate is combined with the rest of the WHERE clause as usual. Note
+that text is matched by terms: a value which is only a part of a word (e.g.
+``"ump"`` in ``"jumped"``) does not match, as it would with ``LIKE``.
+
+The FTS index itself must exist on the cluster; :meth:`FullTextSearch.index_definition`
+returns a definition for it which can be used with the FTS REST API.
+"""
+import json
+
+from .compiler import TYPEFIELD
+from .utils import model_label
+
+LOOKUPS = ('contains', 'icontains', 'search')
+
+_QUERY_TYPES = {
+    'contains': 'match_phrase',
+    'icontains': 'match_phrase',
+    'search': 'match',
+}
+
+
+class FullTextSearch(object):
+    def __init__(self, connection, fields=None):
+        """
+        :param connection: The DatabaseWrapper
+        :param fields: A dict of model label -> {'INDEX': name, 'FIELDS': [field names]}
+        """
+        self.connection = connection
+        self.fields = dict((k.lower(), v) for k, v in (fields or {}).items())
+        self._columns = {}
+
+    @classmethod
+    def from_settings(cls, connection, settings_dict):
+        return cls(connection, settings_dict.get('OPTIONS', {}).get('FTS_FIELDS'))
+
+    def _indexed_columns(self, model):
+        # Returns a tuple of (index name, frozenset of columns)
+        try:
+            return self._columns[model]
+        except KeyError:
+            spec = self.fields.get(model_label(model))
+            if spec:
+                columns = frozenset(model._meta.get_field(x).column for x in spec['FIELDS'])
+                rv = spec['INDEX'], columns
+            else:
+                rv = None, frozenset()
+            self._columns[model] = rv
+            return rv
+
+    def index_for(self, model, column, lookup):
+        """
+        Get the FTS index which serves a lookup
+        :return: The index name, or None if the lookup uses N1QL operators
+        """
+        if lookup not in LOOKUPS:
+            return None
+        index, columns = self._indexed_columns(model)
+        if column in columns:
+            return index
+        return None
+
+    def convert(self, params, rhs, lhs, keyspace, lookup, column, index):
+        """
+        Convert a lookup into a SEARCH() predicate.
+        :param params: The Placeholders of the query. Values are added to it
+        :param rhs: The value to search for
+        :param lhs: The column expression, for the LIKE recheck of `contains`
+        :param keyspace: The keyspace (alias) expression of the query
+        :param lookup: The lookup type
+        :param column: The name of the column in the document
+        :param index: The FTS index
+        :return: A list of tokens to concatenate with ' '
+        """
+        tokens = ['SEARCH({0}, {1}, {2})'.format(
+            keyspace, params.indexstr(), json.dumps({'index': index}))]
+        params.add({_QUERY_TYPES[lookup]: rhs, 'field': column})
+
+        if lookup == 'contains':
+            tokens += ['AND', lhs, 'LIKE', params.indexstr()]
+            params.add('%{0}%'.format(rhs))
+            tokens = ['(' + ' '.join(tokens) + ')']
+
+        return tokens
+
+    def index_definition(self, model, bucket_name, typefield=TYPEFIELD):
+        """
+        Get the definition of the FTS index for a model, for the FTS REST API
+        (``PUT /api/index/<name>``). Only the documents of the model are
+        indexed, with the configured fields.
+        """
+        index, columns = self._indexed_columns(model)
+        if index is None:
+            return None
+
+        properties = dict((column, {
+            'enabled': True,
+            'dynamic': False,
+            'fields': [{'name': column, 'type': 'text', 'index': True,
+                        'include_term_vectors': True}],
+        }) for column in sorted(columns))
+
+        return {
+            'type': 'fulltext-index',
+            'name': index,
+            'sourceType': 'couchbase',
+            'sourceName': bucket_name,
+            'params': {
+                'doc_config': {'mode': 'type_field', 'type_field': typefield},
+                'mapping': {
+                    'default_mapping': {'enabled': False},
+                    'types': {
+                        self.connection.table_name(model): {
+                            'enabled': True,
+                            'dynamic': False,
+                            'properties': properties,
+                        }
+                    },
+                },
+            },
+        }
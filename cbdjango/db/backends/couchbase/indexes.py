@@ -0,0 +1,69 @@
+"""
+Functional indexes for lookups.
+
+Some lookups compare an expression of a column rather than the column itself
+(e.g. ``iexact`` compares ``LOWER(col)`` and ``year`` compares
+``DATE_PART_STR(col, "year")``), so a plain index on the column cannot be used
+for them. The ``FUNCTIONAL_INDEXES`` entry of the database ``OPTIONS`` lists
+the lookups to index, per model and field::
+
+    'OPTIONS': {
+        'FUNCTIONAL_INDEXES': {
+            'auth.user': {'email': ['iexact'], 'date_joined': ['year', 'gte']},
+        }
+    }
+
+The schema editor creates a GSI index for each of them when the model is
+created. Its key is built by :meth:`~.operators.Operators.index_key`, i.e. by
+the same code which generates the queries, and it only covers the documents of
+the model, like the type predicate of those queries.
+"""
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .compiler import TYPEFIELD
+from .operators import Operators
+from .utils import model_label, n1ql_escape
+
+
+def _index_name(table, column, key):
+    name = 'ix_{0}_{1}_{2}'.format(table, column, key)
+    return re.sub(r'[^A-Za-z0-9_]+', '_', name).strip('_').lower()
+
+
+def functional_index_specs(connection, model):
+    """
+    Get the functional indexes configured for a model
+    :param connection: The DatabaseWrapper
+    :param model: The model
+    :return: A list of (name, keys, condition) index specs, as accepted by
+        CreateIndexCommand. Lookups comparing the same expression share an index.
+    """
+    options = connection.settings_dict.get('OPTIONS', {}).get('FUNCTIONAL_INDEXES', {})
+    options = dict((k.lower(), v) for k, v in options.items())
+    fields = options.get(model_label(model))
+    if not fields:
+        return []
+
+    table = connection.table_name(model)
+    condition = '{0} = "{1}"'.format(n1ql_escape(TYPEFIELD), table)
+    specs = []
+    seen = set()
+    for name, lookups in sorted(fields.items()):
+        field = model._meta.get_field(name)
+        lhs = n1ql_escape(field.column)
+        for lookup in lookups:
+            try:
+                key = Operators.index_key(lhs, lookup, field, connection.datetime_storage)
+            except KeyError:
+                raise ImproperlyConfigured(
+                    'Unknown lookup {0} for the functional index of {1}.{2}'.format(
+                        lookup, model_label(model), name))
+
+            if key in seen:
+                continue
+            seen.add(key)
+            specs.append((_index_name(table, field.column, lookup), [key], condition))
+
+    return specs
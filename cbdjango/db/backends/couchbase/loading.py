@@ -0,0 +1,51 @@
+"""
+Batched loading of deferred fields.
+
+Accessing a field deferred with ``defer()``/``only()`` makes Django load it
+for that one instance. When the field is needed for many instances, load it
+for all of them at once instead::
+
+    entries = list(Entry.objects.only('id', 'title'))
+    load_deferred(entries, ['body'])
+
+The values are fetched with a single primary key lookup per model, which is
+served by a multi-get.
+"""
+from collections import defaultdict
+
+
+def load_deferred(instances, fields=None, using=None):
+    """
+    Load deferred fields of many instances
+    :param instances: The model instances
+    :param fields: Names of the fields to load. By default, every deferred field
+    :param using: The database alias. Defaults to the database each instance
+        was loaded from
+    """
+    groups = defaultdict(list)
+    for obj in instances:
+        groups[(obj._meta.concrete_model, using or obj._state.db)].append(obj)
+
+    for (model, db), objs in groups.items():
+        opts = model._meta
+        if fields:
+            to_load = [opts.get_field(name) for name in fields]
+        else:
+            attnames = set()
+            for obj in objs:
+                attnames.update(obj.get_deferred_fields())
+            to_load = [f for f in opts.concrete_fields if f.attname in attnames]
+
+        if not to_load:
+            continue
+
+        names = [f.name for f in to_load]
+        qs = model._base_manager.using(db).filter(pk__in=[obj.pk for obj in objs])
+        values = dict((row[0], row[1:]) for row in qs.values_list('pk', *names))
+
+        for obj in objs:
+            row = values.get(obj.pk)
+            if row is None:
+                continue
+            for field, value in zip(to_load, row):
+                setattr(obj, field.attname, value)
@@ -0,0 +1,1453 @@
+"""
+In-memory stand-in for a Couchbase bucket.
+
+Every code path of the backend otherwise needs a cluster. With a
+``CONNECTION_STRING`` of ``memory://``, buckets are instead held in process
+memory by :class:`MemoryBucket`, which implements the KV operations the
+backend uses (multi-operations, CAS, counters, sub-document lookups and
+replica reads) and evaluates the subset of N1QL it emits::
+
+    DATABASES = {
+        'default': {
+            'ENGINE': 'cbdjango.db.backends.couchbase',
+            'NAME': 'default',
+            'CONNECTION_STRING': 'memory://',
+        }
+    }
+
+Buckets are shared by all the handles of a process, and can be emptied with
+:func:`reset`. Queries see all writes immediately (as with
+``request_plus`` consistency), and need no index. Documents without a time
+zone are taken to be in UTC. Unsupported N1QL raises ``N1QLSyntaxError``.
+
+Values are stored as the transcoder of a Bucket would encode them, with the
+``JSON_CODEC`` of the database if one is configured, and are read back as
+the JSON types they were encoded to.
+"""
+import itertools
+import json
+import random
+import re
+import threading
+from datetime import datetime, timedelta
+
+from couchbase.exceptions import CouchbaseError, KeyExistsError, NotFoundError, \
+    ValueFormatError
+
+SCHEME = 'memory://'
+
+# libcouchbase error codes, as reported by the results of failed operations
+_KEY_EEXISTS = 0x0C
+_KEY_ENOENT = 0x0D
+
+# All buckets share a lock, as queries may span buckets
+_lock = threading.RLock()
+_buckets = {}
+_indexes = []
+_cas = itertools.count(1)
+
+
+def reset(name=None):
+    """
+    Remove all the documents (and indexes) of a bucket, or of all buckets
+    """
+    with _lock:
+        if name is None:
+            _buckets.clear()
+            del _indexes[:]
+        else:
+            _buckets.pop(name, None)
+            _indexes[:] = [x for x in _indexes if x['keyspace_id'] != name]
+
+
+def _store(name):
+    # Key -> [value, cas]
+    return _buckets.setdefault(name, {})
+
+
+def _copy(value):
+    # Stored documents only hold JSON values
+    return json.loads(json.dumps(value))
+
+
+class N1QLSyntaxError(CouchbaseError):
+    """ The statement is not in the supported subset of N1QL """
+
+
+class Result(object):
+    def __init__(self, key, value=None, cas=0, rc=0):
+        self.key = key
+        self.value = value
+        self.cas = cas
+        self.rc = rc
+
+    @property
+    def success(self):
+        return not self.rc
+
+
+class MultiResult(dict):
+    @property
+    def all_ok(self):
+        return all(x.success for x in self.values())
+
+
+class SubdocResult(object):
+    def __init__(self, key, cas, values):
+        self.key = key
+        self.cas = cas
+        self._values = values
+
+    def exists(self, ix):
+        return self._values[ix] is not MISSING
+
+    def __getitem__(self, ix):
+        value = self._values[ix]
+        if value is MISSING:
+            raise NotFoundError({'key': self.key, 'message': 'Path not found'})
+        return value
+
+
+def _error(results, key=None):
+    """ Build the exception of a failed (multi-)operation """
+    if key is None:
+        key = next(k for k, v in results.items() if not v.success)
+    rc = results[key].rc
+    exctype = NotFoundError if rc == _KEY_ENOENT else KeyExistsError
+    return exctype({'rc': rc, 'key': key, 'all_results': results})
+
+
+def _items(kvs):
+    """
+    Iterate over the (key, value, cas) of the argument of a multi-mutation: a
+    dict, or an ItemOptionDict (whose items may carry their CAS)
+    """
+    if hasattr(kvs, 'dict'):
+        for item, options in kvs.dict.items():
+            # Items added without options have None
+            options = options or {}
+            yield item.key, options.get('value', item.value), options.get('cas', item.cas)
+    elif isinstance(kvs, dict):
+        for key, value in kvs.items():
+            yield key, value, 0
+    else:
+        for key in kvs:
+            yield key, None, 0
+
+
+class MemoryBucket(object):
+    def __init__(self, name, codec=None):
+        """
+        :param name: The name of the bucket
+        :param codec: The JSONCodec of the database, if any. As with the
+            transcoder of a Bucket, values are stored as it encodes them
+        """
+        self.bucket = name
+        self.codec = codec
+
+    def _encode(self, value):
+        # Store a value as its JSON form would be read back
+        try:
+            if self.codec:
+                return self.codec.loads(self.codec.dumps(value))
+            return json.loads(json.dumps(value))
+        except (TypeError, ValueError) as e:
+            raise ValueFormatError.pyexc('Cannot encode value', value, e)
+
+    @property
+    def _docs(self):
+        return _store(self.bucket)
+
+    # Single operations run as multi-operations of one key
+
+    def get(self, key, quiet=False, replica=False, **kwargs):
+        return self.get_multi([key], quiet=quiet)[key]
+
+    def insert(self, key, value, **kwargs):
+        return self.insert_multi({key: value})[key]
+
+    def upsert(self, key, value, cas=0, **kwargs):
+        return self._mutate({key: value}, 'upsert', cas)[key]
+
+    def replace(self, key, value, cas=0, **kwargs):
+        return self._mutate({key: value}, 'replace', cas)[key]
+
+    def remove(self, key, cas=0, quiet=False, **kwargs):
+        return self._remove([(key, None, cas)], quiet)[key]
+
+    def get_multi(self, keys, quiet=False, replica=False, **kwargs):
+        results = MultiResult()
+        with _lock:
+            docs = self._docs
+            for key in keys:
+                if key in docs:
+                    value, cas = docs[key]
+                    results[key] = Result(key, _copy(value), cas)
+                else:
+                    results[key] = Result(key, rc=_KEY_ENOENT)
+        if not quiet and not results.all_ok:
+            raise _error(results)
+        return results
+
+    def insert_multi(self, kvs, **kwargs):
+        return self._mutate(kvs, 'insert')
+
+    def upsert_multi(self, kvs, **kwargs):
+        return self._mutate(kvs, 'upsert')
+
+    def replace_multi(self, kvs, **kwargs):
+        return self._mutate(kvs, 'replace')
+
+    def _mutate(self, kvs, mode, cas=0):
+        results = MultiResult()
+        with _lock:
+            docs = self._docs
+            for key, value, item_cas in _items(kvs):
+                item_cas = item_cas or cas
+                current = docs.get(key)
+                if mode == 'insert' and current is not None:
+                    results[key] = Result(key, rc=_KEY_EEXISTS)
+                elif mode == 'replace' and current is None:
+                    results[key] = Result(key, rc=_KEY_ENOENT)
+                elif item_cas and (current is None or current[1] != item_cas):
+                    results[key] = Result(key, rc=_KEY_EEXISTS if current else _KEY_ENOENT)
+                else:
+                    docs[key] = [self._encode(value), next(_cas)]
+                    results[key] = Result(key, cas=docs[key][1])
+        if not results.all_ok:
+            raise _error(results)
+        return results
+
+    def remove_multi(self, keys, quiet=False, **kwargs):
+        return self._remove(_items(keys), quiet)
+
+    def _remove(self, items, quiet):
+        results = MultiResult()
+        with _lock:
+            docs = self._docs
+            for key, _, cas in items:
+                current = docs.get(key)
+                if current is None:
+                    results[key] = Result(key, rc=_KEY_ENOENT)
+                elif cas and current[1] != cas:
+                    results[key] = Result(key, rc=_KEY_EEXISTS)
+                else:
+                    del docs[key]
+                    results[key] = Result(key, cas=next(_cas))
+        if not quiet and not results.all_ok:
+            raise _error(results)
+        return results
+
+    def counter(self, key, delta=1, initial=None, **kwargs):
+        with _lock:
+            docs = self._docs
+            if key not in docs:
+                if initial is None:
+                    raise NotFoundError({'rc': _KEY_ENOENT, 'key': key})
+                value = initial
+            else:
+                value = docs[key][0] + delta
+            docs[key] = [value, next(_cas)]
+            return Result(key, value, docs[key][1])
+
+    def lookup_in(self, key, *specs, **kwargs):
+        """ Sub-document lookups of top-level paths (``SD.get``, ``SD.exists``) """
+        with _lock:
+            try:
+                value, cas = self._docs[key]
+            except KeyError:
+                raise NotFoundError({'rc': _KEY_ENOENT, 'key': key})
+
+            values = []
+            for spec in specs:
+                path = spec[1]
+                found = _path(value, path.split('.'))
+                values.append(_copy(found) if found is not MISSING else MISSING)
+        return SubdocResult(key, cas, values)
+
+    def flush(self):
+        reset(self.bucket)
+
+    def n1ql_query(self, query):
+        return MemoryN1QLRequest(self, query)
+
+
+class MemoryN1QLRequest(object):
+    """
+    The result of a query, evaluated when first iterated (or executed)
+    """
+    def __init__(self, bucket, query):
+        self.bucket = bucket
+        if isinstance(query, basestring):
+            self.statement, self.args, self.named = query, [], {}
+        else:
+            body = query._body
+            self.statement = body['statement']
+            self.args = body.get('args', [])
+            self.named = dict((k[1:], v) for k, v in body.items() if k.startswith('$'))
+        self._rows = None
+        self.metrics = {}
+
+    def _run(self):
+        if self._rows is None:
+            statement = _Parser(self.statement).parse_statement()
+            # Parameters are encoded with the codec installed as the SDK's
+            # JSON converter, which is that of the bucket
+            params = _Params(self.bucket._encode(self.args), self.bucket._encode(self.named))
+            with _lock:
+                rows, mutations = statement.execute(self.bucket.bucket, params)
+            self._rows = [_to_json(x) for x in rows if x is not MISSING]
+            self.metrics = {'resultCount': len(self._rows), 'mutationCount': mutations}
+        return self._rows
+
+    def execute(self):
+        self._run()
+        return self
+
+    def get_single_result(self):
+        rows = self._run()
+        return rows[0] if rows else None
+
+    @property
+    def meta(self):
+        self._run()
+        return {'metrics': self.metrics, 'status': 'success'}
+
+    def __iter__(self):
+        return iter(self._run())
+
+
+# N1QL values. MISSING is distinct from NULL (None)
+
+class _Missing(object):
+    def __repr__(self):
+        return 'MISSING'
+
+    def __nonzero__(self):
+        return False
+
+MISSING = _Missing()
+
+
+def _to_json(value):
+    if isinstance(value, list):
+        return [None if x is MISSING else _to_json(x) for x in value]
+    if isinstance(value, dict):
+        return dict((k, _to_json(v)) for k, v in value.items() if v is not MISSING)
+    return value
+
+
+def _path(value, names):
+    for name in names:
+        if not isinstance(value, dict) or name not in value:
+            return MISSING
+        value = value[name]
+    return value
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def _collate(value):
+    """ Sort key following the N1QL collation of values of all types """
+    if value is MISSING:
+        return (0,)
+    if value is None:
+        return (1,)
+    if isinstance(value, bool):
+        return (2, value)
+    if _is_number(value):
+        return (3, value)
+    if isinstance(value, basestring):
+        return (4, value)
+    if isinstance(value, (list, tuple)):
+        return (5, [_collate(x) for x in value])
+    if isinstance(value, dict):
+        return (6, len(value), sorted((k, _collate(v)) for k, v in value.items()))
+    # Native values of a codec
+    return (4, unicode(value))
+
+
+def _truthy(value):
+    if value is MISSING or value is None:
+        return False
+    if _is_number(value):
+        return value != 0
+    return bool(value)
+
+
+def _unknown(*values):
+    """ MISSING or NULL if any operand is, else None """
+    if any(x is MISSING for x in values):
+        return MISSING
+    if any(x is None for x in values):
+        return None
+    return False
+
+
+def _compare(op, lhs, rhs):
+    unknown = _unknown(lhs, rhs)
+    if unknown is not False:
+        return unknown
+    a, b = _collate(lhs), _collate(rhs)
+    if op in ('=', '=='):
+        return a == b
+    elif op in ('!=', '<>'):
+        return a != b
+    if a[0] != b[0]:
+        # Values of different types are not ordered
+        return None
+    return {'<': a < b, '<=': a <= b, '>': a > b, '>=': a >= b}[op]
+
+
+def _like(value, pattern):
+    unknown = _unknown(value, pattern)
+    if unknown is not False:
+        return unknown
+    if not isinstance(value, basestring) or not isinstance(pattern, basestring):
+        return None
+    regex = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            regex.append(re.escape(char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '%':
+            regex.append('.*')
+        elif char == '_':
+            regex.append('.')
+        else:
+            regex.append(re.escape(char))
+    return re.match(''.join(regex) + r'\Z', value, re.DOTALL) is not None
+
+
+# Dates. Strings without a time zone are taken to be in UTC
+
+_DATE_RE = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})(?:([T ])(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?)?'
+    r'(Z|[+-]\d{2}:?\d{2})?$')
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class _Date(object):
+    """ A parsed date string: its wall clock time, offset and layout """
+    def __init__(self, value, offset, sep, zone):
+        self.value = value  # Naive, in the time zone of the string
+        self.offset = offset  # Minutes east of UTC
+        self.sep = sep  # Separator of the time, None for dates
+        self.zone = zone  # Whether the string has a time zone
+
+    @classmethod
+    def parse(cls, s):
+        if not isinstance(s, basestring):
+            return None
+        m = _DATE_RE.match(s)
+        if m is None:
+            return None
+        year, month, day, sep, hour, minute, second, fraction, zone = m.groups()
+        micro = int((fraction or '0')[:6].ljust(6, '0'))
+        value = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+                         int(second or 0), micro)
+        offset = 0
+        if zone and zone != 'Z':
+            sign = -1 if zone[0] == '-' else 1
+            digits = zone[1:].replace(':', '')
+            offset = sign * (int(digits[:2]) * 60 + int(digits[2:]))
+        return cls(value, offset, sep, zone is not None)
+
+    @classmethod
+    def from_utc(cls, value, offset=0, sep='T'):
+        return cls(value + timedelta(minutes=offset), offset, sep, True)
+
+    @property
+    def utc(self):
+        return self.value - timedelta(minutes=self.offset)
+
+    @property
+    def millis(self):
+        delta = self.utc - _EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+    def format(self):
+        if self.sep is None:
+            return self.value.strftime('%Y-%m-%d')
+        s = self.value.strftime('%Y-%m-%d') + self.sep + self.value.strftime('%H:%M:%S')
+        if self.value.microsecond:
+            s += ('.%06d' % self.value.microsecond)[:4].rstrip('0')
+        if self.zone:
+            if self.offset:
+                sign = '-' if self.offset < 0 else '+'
+                s += '{0}{1:02d}:{2:02d}'.format(sign, abs(self.offset) // 60, abs(self.offset) % 60)
+            else:
+                s += 'Z'
+        return s
+
+
+_TRUNCATE = ['year', 'month', 'day', 'hour', 'minute', 'second', 'millisecond']
+
+
+def _date_part(d, part):
+    v = d.value
+    parts = {
+        'millennium': (v.year - 1) // 1000 + 1,
+        'century': (v.year - 1) // 100 + 1,
+        'decade': v.year // 10,
+        'year': v.year,
+        'quarter': (v.month - 1) // 3 + 1,
+        'month': v.month,
+        'day': v.day,
+        'hour': v.hour,
+        'minute': v.minute,
+        'second': v.second,
+        'millisecond': v.microsecond // 1000,
+        'doy': v.timetuple().tm_yday,
+        'dow': v.isoweekday() % 7,
+        'iso_dow': v.isoweekday(),
+        'iso_week': v.isocalendar()[1],
+        'iso_year': v.isocalendar()[0],
+        'week': (v.timetuple().tm_yday - 1) // 7 + 1,
+        'timezone': d.offset * 60,
+        'timezone_hour': d.offset // 60,
+        'timezone_minute': d.offset % 60,
+    }
+    return parts.get(part.lower())
+
+
+def _date_trunc(d, part):
+    part = part.lower()
+    if part not in _TRUNCATE:
+        return None
+    v = d.value
+    values = [v.year, v.month, v.day, v.hour, v.minute, v.second, v.microsecond]
+    keep = _TRUNCATE.index(part) + 1
+    defaults = [1, 1, 1, 0, 0, 0, 0]
+    if part == 'millisecond':
+        values[6] = values[6] // 1000 * 1000
+    else:
+        values[keep:] = defaults[keep:]
+    return _Date(datetime(*values), d.offset, d.sep, d.zone)
+
+
+def _to_tz(d, tzname):
+    import pytz
+    tz = pytz.timezone(tzname)
+    local = pytz.utc.localize(d.utc).astimezone(tz)
+    offset = local.utcoffset()
+    minutes = offset.days * 1440 + offset.seconds // 60
+    return _Date.from_utc(d.utc, minutes, d.sep or 'T')
+
+
+def _date_fn(fn):
+    # Apply a function to a date string, propagating MISSING and NULL
+    def wrapper(s, *args):
+        unknown = _unknown(s, *args)
+        if unknown is not False:
+            return unknown
+        d = _Date.parse(s)
+        if d is None:
+            return None
+        return fn(d, *args)
+    return wrapper
+
+
+def _millis_fn(fn):
+    def wrapper(ms, *args):
+        unknown = _unknown(ms, *args)
+        if unknown is not False:
+            return unknown
+        if not _is_number(ms):
+            return None
+        return fn(_Date.from_utc(_EPOCH + timedelta(milliseconds=ms)), *args)
+    return wrapper
+
+
+def _string_fn(fn):
+    def wrapper(*args):
+        unknown = _unknown(*args)
+        if unknown is not False:
+            return unknown
+        if not all(isinstance(x, basestring) for x in args):
+            return None
+        return fn(*args)
+    return wrapper
+
+
+def _tostring(value):
+    if value is MISSING or value is None or isinstance(value, basestring):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return json.dumps(value)
+
+
+def _search(doc, query, options=None):
+    """
+    SEARCH() over the field named in a ``match`` or ``match_phrase`` query,
+    comparing lowercased words
+    """
+    if not isinstance(query, dict) or not isinstance(doc, dict):
+        return False
+    value = doc.get(query.get('field'))
+    if not isinstance(value, basestring):
+        return False
+    words = re.findall(r'\w+', value.lower(), re.UNICODE)
+    if 'match_phrase' in query:
+        phrase = re.findall(r'\w+', unicode(query['match_phrase']).lower(), re.UNICODE)
+        n = len(phrase)
+        return bool(phrase) and any(words[i:i + n] == phrase for i in range(len(words) - n + 1))
+    terms = re.findall(r'\w+', unicode(query.get('match', '')).lower(), re.UNICODE)
+    return any(x in words for x in terms)
+
+
+def _numeric(fn):
+    def wrapper(a, b):
+        unknown = _unknown(a, b)
+        if unknown is not False:
+            return unknown
+        if not (_is_number(a) and _is_number(b)):
+            return None
+        try:
+            return fn(a, b)
+        except ZeroDivisionError:
+            return None
+    return wrapper
+
+
+_ARITHMETIC = {
+    '+': _numeric(lambda a, b: a + b),
+    '-': _numeric(lambda a, b: a - b),
+    '*': _numeric(lambda a, b: a * b),
+    '/': _numeric(lambda a, b: float(a) / b),
+    '%': _numeric(lambda a, b: a % b),
+}
+
+_FUNCTIONS = {
+    'LOWER': _string_fn(lambda s: s.lower()),
+    'UPPER': _string_fn(lambda s: s.upper()),
+    'LENGTH': _string_fn(len),
+    'CONCAT': _string_fn(lambda *args: u''.join(args)),
+    'TOSTRING': _tostring,
+    'REGEXP_CONTAINS': _string_fn(lambda s, p: re.search(p, s) is not None),
+    'REGEXP_LIKE': _string_fn(lambda s, p: re.match(p + r'\Z', s) is not None),
+    'STR_TO_MILLIS': _date_fn(lambda d: d.millis),
+    'STR_TO_UTC': _date_fn(lambda d: _Date.from_utc(d.utc, 0, d.sep).format()),
+    'STR_TO_TZ': _date_fn(lambda d, tz: _to_tz(d, tz).format()),
+    'DATE_PART_STR': _date_fn(_date_part),
+    'DATE_TRUNC_STR': _date_fn(lambda d, part: (_date_trunc(d, part) or d).format()),
+    'MILLIS_TO_UTC': _millis_fn(lambda d: d.format()),
+    'MILLIS_TO_STR': _millis_fn(lambda d: d.format()),
+    'MILLIS_TO_TZ': _millis_fn(lambda d, tz: _to_tz(d, tz).format()),
+    'IFMISSING': lambda *args: next((x for x in args if x is not MISSING), None),
+    'IFNULL': lambda *args: next((x for x in args if x is not None), None),
+    'IFMISSINGORNULL': lambda *args: next((x for x in args if x is not MISSING and x is not None), None),
+    'RANDOM': lambda *args: random.random(),
+}
+
+
+def _aggregate(name, values):
+    values = [x for x in values if x is not MISSING and x is not None]
+    if name == 'COUNT':
+        return len(values)
+    if name == 'ARRAY_AGG':
+        return values or None
+    numbers = [x for x in values if _is_number(x)]
+    if name == 'SUM':
+        return sum(numbers) if numbers else None
+    if name == 'AVG':
+        return float(sum(numbers)) / len(numbers) if numbers else None
+    if not values:
+        return None
+    key = lambda x: _collate(x)
+    return min(values, key=key) if name == 'MIN' else max(values, key=key)
+
+_AGGREGATES = ('COUNT', 'SUM', 'AVG', 'MIN', 'MAX', 'ARRAY_AGG')
+
+
+# Evaluation
+
+class _Params(object):
+    def __init__(self, args, named):
+        self.args = args
+        self.named = named
+
+    def get(self, name):
+        if name.isdigit():
+            ix = int(name) - 1
+            if ix >= len(self.args):
+                raise N1QLSyntaxError('No value for parameter $' + name)
+            return self.args[ix]
+        if name not in self.named:
+            raise N1QLSyntaxError('No value for parameter $' + name)
+        return self.named[name]
+
+
+class _Context(object):
+    """ The row an expression is evaluated against """
+    def __init__(self, params, doc=MISSING, key=None, cas=None, aliases=(), bucket=None):
+        self.params = params
+        self.doc = doc
+        self.key = key
+        self.cas = cas
+        self.aliases = aliases
+        self.bucket = bucket
+        self.projected = {}
+        self.group = None
+
+    def lookup(self, name):
+        if name in self.projected:
+            return self.projected[name]
+        if name in self.aliases:
+            return self.doc
+        if isinstance(self.doc, dict):
+            return self.doc.get(name, MISSING)
+        return MISSING
+
+
+# Tokenizer
+
+_TOKEN_RE = re.compile(r'''
+    (?P<ws>\s+)
+  | (?P<string>"(?:[^"\\]|\\.|"")*"|'(?:[^'\\]|\\.|'')*')
+  | (?P<ident>`(?:[^`]|``)*`)
+  | (?P<number>\d+\.\d*(?:[eE][+-]?\d+)?|\d+(?:[eE][+-]?\d+)?|\.\d+)
+  | (?P<param>\$\w+)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>==|!=|<>|>=|<=|\|\||[=<>()\[\]{},.:*+\-/%])
+''', re.VERBOSE)
+
+
+def _unquote(s):
+    quote = s[0]
+    body = s[1:-1].replace(quote * 2, quote)
+    if quote == '"':
+        return json.loads('"' + body.replace('\\' + quote, quote).replace('"', '\\"') + '"')
+    return body.replace('\\\'', '\'')
+
+
+def _tokenize(s):
+    tokens = []
+    pos = 0
+    while pos < len(s):
+        m = _TOKEN_RE.match(s, pos)
+        if m is None:
+            raise N1QLSyntaxError('Cannot parse N1QL at: ' + s[pos:pos + 20])
+        pos = m.end()
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'ws':
+            continue
+        if kind == 'string':
+            tokens.append(('string', _unquote(text)))
+        elif kind == 'ident':
+            tokens.append(('ident', text[1:-1].replace('``', '`')))
+        elif kind == 'number':
+            tokens.append(('number', float(text) if ('.' in text or 'e' in text.lower())
+                           else int(text)))
+        elif kind == 'param':
+            tokens.append(('param', text[1:]))
+        elif kind == 'word':
+            tokens.append(('word', text))
+        else:
+            tokens.append(('op', text))
+    tokens.append(('end', None))
+    return tokens
+
+
+# Words which end an expression or a keyspace alias
+_CLAUSES = frozenset([
+    'FROM', 'WHERE', 'ORDER', 'GROUP', 'LIMIT', 'OFFSET', 'USE', 'SET', 'UNSET', 'RETURNING',
+    'AS', 'ASC', 'DESC', 'AND', 'OR', 'NOT', 'ON', 'JOIN', 'LET', 'HAVING', 'UNION',
+])
+
+
+class _Parser(object):
+    def __init__(self, statement):
+        self.statement = statement
+        self.tokens = _tokenize(statement)
+        self.pos = 0
+        self._aggregates = False
+
+    # Token helpers
+
+    def peek(self, offset=0):
+        return self.tokens[self.pos + offset]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def is_word(self, *words, **kwargs):
+        kind, value = self.peek(kwargs.get('offset', 0))
+        return kind == 'word' and value.upper() in words
+
+    def is_op(self, *ops):
+        kind, value = self.peek()
+        return kind == 'op' and value in ops
+
+    def accept_word(self, *words):
+        if self.is_word(*words):
+            return self.next()[1].upper()
+        return None
+
+    def accept_op(self, *ops):
+        if self.is_op(*ops):
+            return self.next()[1]
+        return None
+
+    def expect_word(self, word):
+        if not self.accept_word(word):
+            self.error('Expected ' + word)
+
+    def expect_op(self, op):
+        if not self.accept_op(op):
+            self.error('Expected ' + op)
+
+    def error(self, message):
+        raise N1QLSyntaxError('{0} at token {1} of: {2}'.format(
+            message, self.pos, self.statement))
+
+    def name(self):
+        kind, value = self.next()
+        if kind not in ('word', 'ident'):
+            self.error('Expected a name')
+        return value
+
+    # Statements
+
+    def parse_statement(self):
+        if self.is_word('SELECT'):
+            stmt = self.parse_select()
+        elif self.accept_word('UPDATE'):
+            stmt = self.parse_update()
+        elif self.accept_word('DELETE'):
+            stmt = self.parse_delete()
+        elif self.accept_word('CREATE'):
+            stmt = self.parse_create_index()
+        elif self.accept_word('DROP', 'BUILD'):
+            # Indexes are not needed
+            stmt = _NoOp()
+            self.pos = len(self.tokens) - 1
+        else:
+            self.error('Unsupported statement')
+        if self.peek()[0] != 'end':
+            self.error('Unexpected token')
+        return stmt
+
+    def parse_keyspace(self, allow_subquery=False):
+        """
+        :return: A tuple of (keyspace name or select, alias)
+        """
+        if allow_subquery and self.accept_op('('):
+            source = self.parse_select()
+            self.expect_op(')')
+        else:
+            source = self.name()
+            if self.accept_op(':'):
+                # namespace:keyspace
+                source = source + ':' + self.name()
+        alias = None
+        if self.accept_word('AS'):
+            alias = self.name()
+        elif self.peek()[0] == 'ident' or (self.peek()[0] == 'word' and
+                                           self.peek()[1].upper() not in _CLAUSES):
+            alias = self.name()
+        return source, alias
+
+    def parse_use_keys(self):
+        if self.accept_word('USE'):
+            self.accept_word('PRIMARY')
+            self.expect_word('KEYS')
+            return self.parse_expr()
+        return None
+
+    def parse_select(self):
+        self.expect_word('SELECT')
+        select = _Select()
+        select.distinct = bool(self.accept_word('DISTINCT'))
+        select.raw = bool(self.accept_word('RAW', 'ELEMENT', 'VALUE'))
+        outer_aggregates, self._aggregates = self._aggregates, False
+        if select.raw:
+            select.projections = [(self.parse_expr(), None, None)]
+        else:
+            while True:
+                if self.accept_op('*'):
+                    select.projections.append((None, None, '*'))
+                else:
+                    expr_start = self.pos
+                    expr = self.parse_expr()
+                    alias = None
+                    if self.accept_word('AS'):
+                        alias = self.name()
+                    else:
+                        alias = self._implicit_alias(expr_start)
+                    select.projections.append((expr, alias, None))
+                if not self.accept_op(','):
+                    break
+        select.aggregate = self._aggregates
+        self._aggregates = outer_aggregates
+        if self.accept_word('FROM'):
+            select.source, select.alias = self.parse_keyspace(allow_subquery=True)
+        select.use_keys = self.parse_use_keys()
+        if self.accept_word('WHERE'):
+            select.where = self.parse_expr()
+        while True:
+            if self.accept_word('ORDER'):
+                self.expect_word('BY')
+                while True:
+                    expr = self.parse_expr()
+                    desc = self.accept_word('ASC', 'DESC') == 'DESC'
+                    select.order.append((expr, desc))
+                    if not self.accept_op(','):
+                        break
+            elif self.accept_word('LIMIT'):
+                select.limit = self.parse_expr()
+            elif self.accept_word('OFFSET'):
+                select.offset = self.parse_expr()
+            else:
+                break
+        return select
+
+    def _implicit_alias(self, start):
+        # The name of a projected field is that of its last path component
+        tokens = self.tokens[start:self.pos]
+        if tokens and tokens[-1][0] in ('word', 'ident') and \
+                (len(tokens) == 1 or tokens[-2] == ('op', '.')):
+            return tokens[-1][1]
+        return None
+
+    def parse_update(self):
+        update = _Update()
+        update.keyspace, update.alias = self.parse_keyspace()
+        update.use_keys = self.parse_use_keys()
+        if self.accept_word('SET'):
+            while True:
+                path = self.parse_path()
+                self.expect_op('=')
+                update.set.append((path, self.parse_expr()))
+                if not self.accept_op(','):
+                    break
+        if self.accept_word('UNSET'):
+            while True:
+                update.unset.append(self.parse_path())
+                if not self.accept_op(','):
+                    break
+        self._parse_dml_tail(update)
+        return update
+
+    def parse_delete(self):
+        self.expect_word('FROM')
+        delete = _Delete()
+        delete.keyspace, delete.alias = self.parse_keyspace()
+        delete.use_keys = self.parse_use_keys()
+        self._parse_dml_tail(delete)
+        return delete
+
+    def _parse_dml_tail(self, stmt):
+        if self.accept_word('WHERE'):
+            stmt.where = self.parse_expr()
+        if self.accept_word('LIMIT'):
+            stmt.limit = self.parse_expr()
+        if self.accept_word('RETURNING'):
+            stmt.raw = bool(self.accept_word('RAW', 'ELEMENT', 'VALUE'))
+            stmt.returning = self.parse_expr()
+
+    def parse_path(self):
+        names = [self.name()]
+        while self.accept_op('.'):
+            names.append(self.name())
+        return names
+
+    def parse_create_index(self):
+        primary = bool(self.accept_word('PRIMARY'))
+        self.expect_word('INDEX')
+        name = '#primary'
+        if not self.is_word('ON'):
+            name = self.name()
+        self.expect_word('ON')
+        keyspace = self.name()
+        # The keys and condition are not needed
+        self.pos = len(self.tokens) - 1
+        return _CreateIndex(name, keyspace, primary)
+
+    # Expressions, by increasing precedence
+
+    def parse_expr(self):
+        return self.parse_or()
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.accept_word('OR'):
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+
+        def fn(ctx):
+            values = [t(ctx) for t in terms]
+            if any(_truthy(x) for x in values):
+                return True
+            if any(x is None for x in values):
+                return None
+            if any(x is MISSING for x in values):
+                return MISSING
+            return False
+        return fn
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.accept_word('AND'):
+            terms.append(self.parse_not())
+        if len(terms) == 1:
+            return terms[0]
+
+        def fn(ctx):
+            values = []
+            for t in terms:
+                value = t(ctx)
+                if value is not MISSING and value is not None and not _truthy(value):
+                    return False
+                values.append(value)
+            if any(x is MISSING for x in values):
+                return MISSING
+            if any(x is None for x in values):
+                return None
+            return True
+        return fn
+
+    def parse_not(self):
+        if self.accept_word('NOT'):
+            operand = self.parse_not()
+
+            def fn(ctx):
+                value = operand(ctx)
+                if value is MISSING or value is None:
+                    return value
+                return not _truthy(value)
+            return fn
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        lhs = self.parse_concat()
+        op = self.accept_op('=', '==', '!=', '<>', '<', '<=', '>', '>=')
+        if op:
+            rhs = self.parse_concat()
+            return lambda ctx: _compare(op, lhs(ctx), rhs(ctx))
+
+        negate = False
+        if self.is_word('NOT') and self.is_word('LIKE', 'IN', 'BETWEEN', offset=1):
+            self.next()
+            negate = True
+
+        if self.accept_word('LIKE'):
+            rhs = self.parse_concat()
+            fn = lambda ctx: _like(lhs(ctx), rhs(ctx))
+        elif self.accept_word('IN'):
+            rhs = self.parse_concat()
+            fn = lambda ctx: _in(lhs(ctx), rhs(ctx))
+        elif self.accept_word('BETWEEN'):
+            low = self.parse_concat()
+            self.expect_word('AND')
+            high = self.parse_concat()
+
+            def fn(ctx):
+                value = lhs(ctx)
+                a, b = _compare('>=', value, low(ctx)), _compare('<=', value, high(ctx))
+                return a and b if a is not MISSING and b is not MISSING else MISSING
+        elif self.accept_word('IS'):
+            return self._parse_is(lhs)
+        else:
+            return lhs
+
+        if not negate:
+            return fn
+
+        def negated(ctx):
+            value = fn(ctx)
+            return value if value is MISSING or value is None else not value
+        return negated
+
+    def _parse_is(self, lhs):
+        negate = bool(self.accept_word('NOT'))
+        kind = self.name().upper()
+        checks = {
+            'NULL': lambda v: MISSING if v is MISSING else v is None,
+            'MISSING': lambda v: v is MISSING,
+            'VALUED': lambda v: v is not MISSING and v is not None,
+            'KNOWN': lambda v: v is not MISSING and v is not None,
+            'NUMBER': _is_number,
+            'STRING': lambda v: isinstance(v, basestring),
+            'BOOLEAN': lambda v: isinstance(v, bool),
+            'ARRAY': lambda v: isinstance(v, list),
+            'OBJECT': lambda v: isinstance(v, dict),
+        }
+        if kind not in checks:
+            self.error('Unsupported IS ' + kind)
+        check = checks[kind]
+
+        def fn(ctx):
+            value = check(lhs(ctx))
+            if value is MISSING:
+                return value
+            return not value if negate else value
+        return fn
+
+    def parse_concat(self):
+        lhs = self.parse_additive()
+        while self.accept_op('||'):
+            rhs = self.parse_additive()
+            lhs = (lambda a, b: lambda ctx: _FUNCTIONS['CONCAT'](a(ctx), b(ctx)))(lhs, rhs)
+        return lhs
+
+    def parse_additive(self):
+        lhs = self.parse_multiplicative()
+        while True:
+            op = self.accept_op('+', '-')
+            if not op:
+                return lhs
+            rhs = self.parse_multiplicative()
+            lhs = (lambda f, a, b: lambda ctx: f(a(ctx), b(ctx)))(_ARITHMETIC[op], lhs, rhs)
+
+    def parse_multiplicative(self):
+        lhs = self.parse_unary()
+        while True:
+            op = self.accept_op('*', '/', '%')
+            if not op:
+                return lhs
+            rhs = self.parse_unary()
+            lhs = (lambda f, a, b: lambda ctx: f(a(ctx), b(ctx)))(_ARITHMETIC[op], lhs, rhs)
+
+    def parse_unary(self):
+        if self.accept_op('-'):
+            operand = self.parse_unary()
+            return lambda ctx: _ARITHMETIC['-'](0, operand(ctx))
+        return self.parse_postfix()
+
+    def parse_postfix(self):
+        expr = self.parse_primary()
+        while True:
+            if self.accept_op('.'):
+                name = self.name()
+                expr = (lambda e, n: lambda ctx: _path(e(ctx), [n]))(expr, name)
+            elif self.is_op('['):
+                self.next()
+                index = self.parse_expr()
+                self.expect_op(']')
+                expr = (lambda e, i: lambda ctx: _index(e(ctx), i(ctx)))(expr, index)
+            else:
+                return expr
+
+    def parse_primary(self):
+        kind, value = self.next()
+        if kind == 'string' or kind == 'number':
+            return lambda ctx: value
+        if kind == 'param':
+            return lambda ctx: ctx.params.get(value)
+        if kind == 'op' and value == '(':
+            if self.is_word('SELECT'):
+                select = self.parse_select()
+                self.expect_op(')')
+                return select.as_expression()
+            expr = self.parse_expr()
+            self.expect_op(')')
+            return expr
+        if kind == 'op' and value == '[':
+            items = []
+            if not self.accept_op(']'):
+                while True:
+                    items.append(self.parse_expr())
+                    if not self.accept_op(','):
+                        break
+                self.expect_op(']')
+            return lambda ctx: [x(ctx) for x in items]
+        if kind == 'op' and value == '{':
+            members = []
+            if not self.accept_op('}'):
+                while True:
+                    key = self.next()[1]
+                    self.expect_op(':')
+                    members.append((key, self.parse_expr()))
+                    if not self.accept_op(','):
+                        break
+                self.expect_op('}')
+            return lambda ctx: dict((k, v(ctx)) for k, v in members)
+        if kind == 'word':
+            upper = value.upper()
+            if upper in ('TRUE', 'FALSE'):
+                return lambda ctx: upper == 'TRUE'
+            if upper == 'NULL':
+                return lambda ctx: None
+            if upper == 'MISSING':
+                return lambda ctx: MISSING
+            if self.is_op('('):
+                return self.parse_call(upper)
+        if kind in ('word', 'ident'):
+            return lambda ctx: ctx.lookup(value)
+        self.pos -= 1
+        self.error('Unexpected token')
+
+    def parse_call(self, name):
+        self.expect_op('(')
+        if name == 'META':
+            # Non-correlated queries only ever refer to their own keyspace
+            if not self.accept_op(')'):
+                self.parse_expr()
+                self.expect_op(')')
+            return lambda ctx: {'id': ctx.key, 'cas': ctx.cas, 'type': 'json'}
+
+        if name in _AGGREGATES:
+            self._aggregates = True
+            distinct = bool(self.accept_word('DISTINCT'))
+            if self.accept_op('*'):
+                arg = lambda ctx: True
+            else:
+                arg = self.parse_expr()
+            self.expect_op(')')
+
+            def aggregate(ctx):
+                group = ctx.group if ctx.group is not None else [ctx]
+                values = [arg(x) for x in group]
+                if distinct:
+                    seen = {}
+                    for x in values:
+                        seen.setdefault(repr(_collate(x)), x)
+                    values = seen.values()
+                return _aggregate(name, values)
+            return aggregate
+
+        args = []
+        if not self.accept_op(')'):
+            while True:
+                args.append(self.parse_expr())
+                if not self.accept_op(','):
+                    break
+            self.expect_op(')')
+
+        if name == 'SEARCH':
+            return lambda ctx: _search(ctx.doc, *[x(ctx) for x in args[1:]])
+        if name not in _FUNCTIONS:
+            self.error('Unsupported function ' + name)
+        fn = _FUNCTIONS[name]
+        return lambda ctx: fn(*[x(ctx) for x in args])
+
+
+def _in(value, values):
+    if value is MISSING or values is MISSING:
+        return MISSING
+    if value is None or values is None:
+        return None
+    if not isinstance(values, list):
+        return None
+    return any(_compare('=', value, x) is True for x in values)
+
+
+def _index(value, ix):
+    if isinstance(value, list) and _is_number(ix):
+        try:
+            return value[int(ix)]
+        except IndexError:
+            return MISSING
+    if isinstance(value, dict) and isinstance(ix, basestring):
+        return value.get(ix, MISSING)
+    return MISSING
+
+
+def _keys(use_keys, ctx):
+    keys = use_keys(ctx)
+    if isinstance(keys, basestring):
+        return [keys]
+    if not isinstance(keys, list):
+        return []
+    return [x for x in keys if isinstance(x, basestring)]
+
+
+def _documents(keyspace, alias, use_keys, params):
+    """ Contexts for the documents of a keyspace, in key order """
+    if keyspace.lower() == 'system:indexes':
+        return [_Context(params, dict(x), None, None, (alias or 'indexes',))
+                for x in _indexes]
+
+    docs = _store(keyspace)
+    if use_keys is not None:
+        keys = sorted(set(k for k in _keys(use_keys, _Context(params)) if k in docs))
+    else:
+        keys = sorted(docs)
+    aliases = (alias or keyspace, keyspace)
+    return [_Context(params, docs[k][0], k, docs[k][1], aliases, keyspace) for k in keys]
+
+
+def _count(expr, params):
+    if expr is None:
+        return None
+    value = expr(_Context(params))
+    if not _is_number(value):
+        raise N1QLSyntaxError('LIMIT and OFFSET must be numbers')
+    return int(value)
+
+
+class _NoOp(object):
+    def execute(self, bucket_name, params):
+        return [], 0
+
+
+class _CreateIndex(object):
+    def __init__(self, name, keyspace, primary):
+        self.name = name
+        self.keyspace = keyspace
+        self.primary = primary
+
+    def execute(self, bucket_name, params):
+        if not any(x['name'] == self.name and x['keyspace_id'] == self.keyspace
+                   for x in _indexes):
+            _indexes.append({'name': self.name, 'keyspace_id': self.keyspace,
+                             'namespace_id': 'default', 'is_primary': self.primary,
+                             'state': 'online', 'using': 'gsi'})
+        return [], 0
+
+
+class _Select(object):
+    def __init__(self):
+        self.distinct = False
+        self.raw = False
+        self.aggregate = False
+        self.projections = []  # (expr, alias, star)
+        self.source = None
+        self.alias = None
+        self.use_keys = None
+        self.where = None
+        self.order = []
+        self.limit = None
+        self.offset = None
+
+    def as_expression(self):
+        # A subquery evaluates to the array of its rows, computed once
+        results = {}
+
+        def fn(ctx):
+            key = id(ctx.params)
+            if key not in results:
+                results[key] = self.execute(None, ctx.params)[0]
+            return results[key]
+        return fn
+
+    def _sources(self, params):
+        if self.source is None:
+            return [_Context(params)]
+        if isinstance(self.source, _Select):
+            rows, _ = self.source.execute(None, params)
+            return [_Context(params, row, aliases=(self.alias,)) for row in rows]
+        return _documents(self.source, self.alias, self.use_keys, params)
+
+    def _project(self, ctx):
+        if self.raw:
+            return self.projections[0][0](ctx)
+        row = {}
+        for ix, (expr, alias, star) in enumerate(self.projections):
+            if star:
+                if isinstance(ctx.doc, dict) and isinstance(self.source, _Select):
+                    row.update(ctx.doc)
+                else:
+                    row[self.alias or self.source] = ctx.doc
+                continue
+            value = expr(ctx)
+            name = alias or '${0}'.format(ix + 1)
+            ctx.projected[name] = value
+            row[name] = value
+        return row
+
+    def execute(self, bucket_name, params):
+        contexts = [x for x in self._sources(params)
+                    if self.where is None or _truthy(self.where(x))]
+
+        if self.aggregate:
+            # A single group, as GROUP BY is not supported
+            group_ctx = contexts[0] if contexts else _Context(params)
+            group_ctx.group = contexts
+            contexts = [group_ctx]
+
+        rows = [(ctx, self._project(ctx)) for ctx in contexts]
+        if self.distinct:
+            seen = set()
+            unique = []
+            for ctx, row in rows:
+                key = repr(_collate(row))
+                if key not in seen:
+                    seen.add(key)
+                    unique.append((ctx, row))
+            rows = unique
+
+        for expr, desc in reversed(self.order):
+            rows.sort(key=lambda x: _collate(expr(x[0])), reverse=desc)
+
+        offset = _count(self.offset, params) or 0
+        limit = _count(self.limit, params)
+        rows = rows[offset:offset + limit if limit is not None else None]
+        return [row for _, row in rows if row is not MISSING], 0
+
+
+class _Update(object):
+    def __init__(self):
+        self.keyspace = None
+        self.alias = None
+        self.use_keys = None
+        self.set = []
+        self.unset = []
+        self.where = None
+        self.limit = None
+        self.raw = False
+        self.returning = None
+
+    def _apply(self, ctx):
+        doc = _copy(ctx.doc)
+        values = [(path, expr(ctx)) for path, expr in self.set]
+        for path, value in values:
+            target = doc
+            for name in path[:-1]:
+                target = target.setdefault(name, {})
+            if value is MISSING:
+                target.pop(path[-1], None)
+            else:
+                target[path[-1]] = _to_json(value)
+        for path in self.unset:
+            target = _path(doc, path[:-1]) if len(path) > 1 else doc
+            if isinstance(target, dict):
+                target.pop(path[-1], None)
+        return doc
+
+    def execute(self, bucket_name, params):
+        docs = _store(self.keyspace)
+        limit = _count(self.limit, params)
+        returned = []
+        count = 0
+        for ctx in _documents(self.keyspace, self.alias, self.use_keys, params):
+            if limit is not None and count >= limit:
+                break
+            if self.where is not None and not _truthy(self.where(ctx)):
+                continue
+            docs[ctx.key] = [self._apply(ctx), next(_cas)]
+            count += 1
+            if self.returning is not None:
+                new = _Context(params, docs[ctx.key][0], ctx.key, docs[ctx.key][1], ctx.aliases)
+                returned.append(self.returning(new))
+        return returned, count
+
+
+class _Delete(_Update):
+    def execute(self, bucket_name, params):
+        docs = _store(self.keyspace)
+        limit = _count(self.limit, params)
+        returned = []
+        count = 0
+        for ctx in _documents(self.keyspace, self.alias, self.use_keys, params):
+            if limit is not None and count >= limit:
+                break
+            if self.where is not None and not _truthy(self.where(ctx)):
+                continue
+            del docs[ctx.key]
+            count += 1
+            if self.returning is not None:
+                returned.append(self.returning(ctx))
+        return returned, count
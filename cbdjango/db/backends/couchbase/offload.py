@@ -0,0 +1,153 @@
+"""
+Large-field offloading.
+
+Large text values make every scan and KV get of a document expensive, even
+when the value itself is not needed. Fields listed in the ``OFFLOAD_FIELDS``
+entry of the database ``OPTIONS`` are stored in a side document when their
+encoded size exceeds ``OFFLOAD_THRESHOLD`` bytes::
+
+    'OPTIONS': {
+        'OFFLOAD_FIELDS': {'blog.entry': ['body']},
+        'OFFLOAD_THRESHOLD': 4096,
+    }
+
+The main document keeps a small stub (``{"__CBOFF": <side key>}``) in place of
+the value. The side document key is derived from the DocID of its owner
+(``<docid>::<column>``), so it can be removed without being looked up.
+
+Offloaded values are only fetched when their column is selected, in one
+multi-get per batch of rows returned by the cursor. Deferring the field with
+``defer()``/``only()`` avoids fetching it at all. Offloaded values cannot be
+filtered on in N1QL queries.
+"""
+from .utils import model_label, DocID
+
+MARKER = '__CBOFF'
+
+# Fields of the side document: the owner's type (for flushes) and the value
+SIDE_TYPEFIELD = '__CBOFT'
+SIDE_VALUE = 'v'
+
+DEFAULT_THRESHOLD = 4096
+
+
+def side_key(docid, column):
+    return '{0}::{1}'.format(docid, column)
+
+
+def owner_of(key):
+    """ Get the DocID of the owner of a side document """
+    return key.rsplit('::', 1)[0]
+
+
+def is_stub(value):
+    return isinstance(value, dict) and MARKER in value
+
+
+def _size(value):
+    if isinstance(value, unicode):
+        return len(value.encode('utf-8'))
+    return len(value)
+
+
+class OffloadPolicy(object):
+    def __init__(self, fields=None, threshold=DEFAULT_THRESHOLD):
+        """
+        :param fields: A dict of model label -> list of field names
+        :param threshold: Size in bytes above which a value is offloaded
+        """
+        self.fields = dict((k.lower(), v) for k, v in (fields or {}).items())
+        self.threshold = threshold
+        self._columns = {}
+
+    @classmethod
+    def from_settings(cls, settings_dict):
+        options = settings_dict.get('OPTIONS', {})
+        return cls(options.get('OFFLOAD_FIELDS'),
+                   options.get('OFFLOAD_THRESHOLD', DEFAULT_THRESHOLD))
+
+    def columns_for(self, model):
+        """
+        Get the document columns of a model which may be offloaded
+        :return: A frozenset of column names
+        """
+        try:
+            return self._columns[model]
+        except KeyError:
+            names = self.fields.get(model_label(model), ())
+            columns = frozenset(model._meta.get_field(x).column for x in names)
+            self._columns[model] = columns
+            return columns
+
+    def split(self, model, docid, doc, columns=None):
+        """
+        Move large values out of a document, replacing them with stubs
+        :param model: The model of the document
+        :param docid: The document ID
+        :param doc: The document. Modified in place
+        :param columns: If set, only consider these columns
+        :return: A tuple of (side_docs, inline). `side_docs` is a dict of the
+            side documents to store, and `inline` a list of the side keys of
+            offloadable values which are stored inline.
+        """
+        side_docs = {}
+        inline = []
+        for column in self.columns_for(model):
+            if columns is not None and column not in columns:
+                continue
+
+            value = doc.get(column)
+            if not isinstance(value, basestring):
+                if value is None and column in doc:
+                    inline.append(side_key(docid, column))
+                continue
+
+            key = side_key(docid, column)
+            if _size(value) > self.threshold:
+                # The type of the owner, as namespaced in its ID
+                owner = docid.split(DocID.DELIMITER)[0]
+                side_docs[key] = {SIDE_TYPEFIELD: owner, SIDE_VALUE: value}
+                doc[column] = {MARKER: key}
+            else:
+                inline.append(key)
+
+        return side_docs, inline
+
+    def side_keys(self, model, docids):
+        """
+        Get all possible side document keys of the given documents
+        """
+        columns = self.columns_for(model)
+        return [side_key(docid, column) for docid in docids for column in columns]
+
+    def resolve(self, bucket, model, rows, aliases):
+        """
+        Replace stubs in rows with their offloaded values
+        :param bucket: The bucket
+        :param model: The model of the rows
+        :param rows: A list of rows, either arrays or documents. Modified in place
+        :param aliases: The aliases of the selected values, in row order
+        """
+        columns = self.columns_for(model)
+        if not columns:
+            return
+
+        if isinstance(rows[0], list):
+            positions = [ix for ix, alias in enumerate(aliases) if alias in columns]
+        else:
+            positions = columns.intersection(aliases)
+
+        stubs = []
+        for row in rows:
+            for ix in positions:
+                value = row[ix] if isinstance(row, list) else row.get(ix)
+                if is_stub(value):
+                    stubs.append((row, ix, value[MARKER]))
+
+        if not stubs:
+            return
+
+        results = bucket.get_multi(set(x[2] for x in stubs), quiet=True)
+        for row, ix, key in stubs:
+            res = results[key]
+            row[ix] = res.value[SIDE_VALUE] if res.success else None
@@ -1,8 +1,23 @@
-from datetime import datetime, date
+from datetime import datetime, date, time
+
+from django.conf import settings
 from django.db.models import DateTimeField
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import datetimes
 
 
 class CustomOperator(object):
+    @classmethod
+    def index_key(cls, lhs):
+        """
+        Gets the expression of the lefthand side which the constraint compares.
+        An index on this expression can satisfy the constraint
+        :param lhs: The lefthand side
+        """
+        return lhs
+
     @classmethod
     def get_constraint(cls, lhs, rhs):
         """
@@ -24,7 +39,7 @@ class CustomOperator(object):
 class LikeOperator(CustomOperator):
     @classmethod
     def get_constraint(cls, lhs, rhs):
-        return lhs, 'LIKE', rhs
+        return cls.index_key(lhs), 'LIKE', rhs
 
     @classmethod
     def process_rhs(cls, rhs):
@@ -37,6 +52,16 @@ class ContainsOperator(LikeOperator):
         return '%{0}%'.format(rhs)
 
 
+class IContainsOperator(LikeOperator):
+    @classmethod
+    def index_key(cls, lhs):
+        return 'LOWER({})'.format(lhs)
+
+    @classmethod
+    def process_rhs(cls, rhs):
+        return '%{0}%'.format(rhs).lower()
+
+
 class StartsWithOperator(LikeOperator):
     @classmethod
     def process_rhs(cls, rhs):
@@ -49,9 +74,13 @@ class EndsWithOperator(LikeOperator):
         return '%{0}'.format(rhs)
 
 class LikeOperatorNC(CustomOperator):
+    @classmethod
+    def index_key(cls, lhs):
+        return 'LOWER({})'.format(lhs)
+
     @classmethod
     def get_constraint(cls, lhs, rhs):
-        return 'LOWER({})'.format(lhs), '=', rhs
+        return cls.index_key(lhs), '=', rhs
 
     @classmethod
     def process_rhs(cls, rhs):
@@ -59,25 +88,35 @@ class LikeOperatorNC(CustomOperator):
 
 
 class RegexOperator(CustomOperator):
+    @classmethod
+    def index_key(cls, lhs):
+        return 'TOSTRING({})'.format(lhs)
+
     @classmethod
     def get_constraint(cls, lhs, rhs):
-        return ['REGEXP_CONTAINS( TOSTRING({}),{} )'.format(lhs, rhs)]
+        return ['REGEXP_CONTAINS( {},{} )'.format(cls.index_key(lhs), rhs)]
 
 
 class RegexOperatorNC(CustomOperator):
+    @classmethod
+    def index_key(cls, lhs):
+        return 'LOWER(TOSTRING({}))'.format(lhs)
+
     @classmethod
     def get_constraint(cls, lhs, rhs):
-        return ['REGEXP_CONTAINS( LOWER(TOSTRING({})), LOWER({}) )'.format(lhs, rhs)]
+        return ['REGEXP_CONTAINS( {}, LOWER({}) )'.format(cls.index_key(lhs), rhs)]
 
 
 class DateParseOperator(CustomOperator):
     date_part = None
-    adj = ''
+
+    @classmethod
+    def index_key(cls, lhs):
+        return 'DATE_PART_STR({lhs}, "{part}")'.format(lhs=lhs, part=cls.date_part)
 
     @classmethod
     def get_constraint(cls, lhs, rhs):
-        return 'DATE_PART_STR({lhs}, "{part}"){adj}'.format(
-            lhs=lhs, part=cls.date_part, adj=cls.adj), '=', rhs
+        return cls.index_key(lhs), '=', rhs
 
     @classmethod
     def process_rhs(cls, rhs):
@@ -93,19 +132,39 @@ class DateParseOperator(CustomOperator):
             return rhs.day
         elif cls.date_part == 'iso_dow':
             return rhs.isoweekday()
+        elif cls.date_part in ('hour', 'minute', 'second'):
+            return getattr(rhs, cls.date_part)
         else:
             raise Exception('Unrecognized year lookup!')
 
 
 class DayOfWeekOperator(DateParseOperator):
-    date_part = 'iso_dow'
-    adj = '+1'
+    # N1QL numbers days from Sunday = 0, Django from Sunday = 1. The
+    # adjustment is made to the parameter so the column expression stays
+    # indexable.
+    date_part = 'dow'
+
+    @classmethod
+    def process_rhs(cls, rhs):
+        if isinstance(rhs, (basestring, int)):
+            return int(rhs) - 1
+
+        assert isinstance(rhs, (datetime, date))
+        return rhs.isoweekday() % 7
 
 
 class DateComparisonOperator(object):
+    """
+    Comparison of values stored in the default datetime format, which must be
+    normalized on both sides. Other storage formats compare as stored.
+    """
+    @classmethod
+    def index_key(cls, lhs):
+        return 'STR_TO_MILLIS({})'.format(lhs)
+
     @classmethod
     def get_constraint(cls, lhs, placeholder, sym):
-        return 'STR_TO_MILLIS({})'.format(lhs), sym, 'STR_TO_MILLIS({})'.format(placeholder)
+        return cls.index_key(lhs), sym, cls.index_key(placeholder)
 
 
 def _mk_dateop(ss):
@@ -129,7 +188,13 @@ OPERATOR_MAP = {
     'month': _mk_dateop("month"),
     'day': _mk_dateop("day"),
     'week_day': DayOfWeekOperator,
+    'hour': _mk_dateop("hour"),
+    'minute': _mk_dateop("minute"),
+    'second': _mk_dateop("second"),
     'contains': ContainsOperator,
+    'icontains': IContainsOperator,
+    # Without a full-text index, match the text case-insensitively
+    'search': IContainsOperator,
     'startswith': StartsWithOperator,
     'endswith': EndsWithOperator,
     'regex': RegexOperator,
@@ -138,7 +203,7 @@ OPERATOR_MAP = {
 
 class Operators(object):
     @staticmethod
-    def convert(rhs, lhs, placeholder, lookup, field):
+    def convert(rhs, lhs, placeholder, lookup, field, datetime_storage=datetimes.STRING):
         """
         Convert a lookup into a set of N1QL tokens
         :param rhs: The value to compare to
@@ -146,13 +211,17 @@ class Operators(object):
         :param placeholder: The placeholder representing the right hand value
         :param lookup: The lookup type
         :param field: The field associated with the left-hand side
+        :param datetime_storage: The format datetime values are stored in
         :return: A tuple of (rhs_value, tokens), where rhs_value is the VALUE to use
             for the placeholder. This may change if the rhs value needs to be modified
             (in Python).
         """
+        if field.get_internal_type() == 'DateTimeField' and lookup in DATE_MAPS:
+            lhs = datetimes.string_expression(lhs, datetime_storage)
+
         if lookup in SIMPLE_CMP_MAP:
             nsym = SIMPLE_CMP_MAP[lookup]
-            if field.get_internal_type() in ('DateField', 'DateTimeField'):
+            if Operators._compare_as_millis(field, datetime_storage):
                 tokens = DateComparisonOperator.get_constraint(lhs, placeholder, nsym)
             else:
                 tokens = lhs, nsym, placeholder
@@ -166,37 +235,99 @@ class Operators(object):
 
         return rhs, tokens
 
+    @staticmethod
+    def _compare_as_millis(field, datetime_storage):
+        return field.get_internal_type() in ('DateField', 'DateTimeField') and \
+            datetime_storage == datetimes.STRING
+
+    @staticmethod
+    def index_key(lhs, lookup, field, datetime_storage=datetimes.STRING):
+        """
+        Get the expression of a column which `convert` compares for a lookup.
+        This is the key of the (functional) index which can satisfy it.
+        :param lhs: The column to compare
+        :param lookup: The lookup type
+        :param field: The field associated with the left-hand side
+        :param datetime_storage: The format datetime values are stored in
+        :return: A N1QL expression
+        """
+        if field.get_internal_type() == 'DateTimeField' and lookup in DATE_MAPS:
+            lhs = datetimes.string_expression(lhs, datetime_storage)
+
+        if lookup in SIMPLE_CMP_MAP:
+            if Operators._compare_as_millis(field, datetime_storage):
+                return DateComparisonOperator.index_key(lhs)
+            return lhs
+
+        opfn = OPERATOR_MAP[lookup]
+        if hasattr(opfn, 'index_key'):
+            return opfn.index_key(lhs)
+        return lhs
+
 
 DATE_MAPS = {
     'year': 'year',
     'month': 'month',
     'day': 'day',
-    'week_day': 'iso_dow'
+    'week_day': 'iso_dow',
+    'hour': 'hour',
+    'minute': 'minute',
+    'second': 'second'
 }
 
 # FFS
 class DateTransformField(DateTimeField):
-    def __init__(self, mode):
+    def __init__(self, mode, tzname=None):
+        """
+        :param mode: The part the values are truncated to
+        :param tzname: The time zone they are truncated in, if not UTC
+        """
         super(DateTransformField, self).__init__()
         self.__mode = mode
+        self.tzname = tzname
 
-    def convert(self, obj):
-        if self.__mode == 'year':
-            return datetime(year=obj.year, month=1, day=1)
-        elif self.__mode == 'month':
-            return datetime(year=obj.year, month=obj.month, day=1)
-        elif self.__mode == 'day':
-            return datetime(year=obj.year, month=obj.month, day=obj.day)
-        else:
-            raise ValueError('Unknown conversion type!')
+    def convert(self, value):
+        """
+        Convert a truncated value, as returned by the query, into a datetime
+        in the time zone it was truncated in
+        """
+        if isinstance(value, basestring):
+            parsed = parse_datetime(value)
+            if parsed is None:
+                # Truncated DateField values
+                parsed = datetime.combine(parse_date(value), time())
+            value = parsed
+
+        if timezone.is_aware(value):
+            # The offset of the truncated value is that of the time zone
+            value = value.replace(tzinfo=None)
+        if settings.USE_TZ:
+            if self.tzname:
+                import pytz
+                value = timezone.make_aware(value, pytz.timezone(self.tzname))
+            else:
+                value = timezone.make_aware(value, timezone.utc)
+        return value
 
 
 class Transforms(object):
     @staticmethod
-    def transform(lookup, column):
-        try:
-            date_part = DATE_MAPS[lookup]
-            return ('STR_TO_UTC(DATE_TRUNC_STR({0}, "{1}"))'.format(column, date_part),
-                    DateTransformField(lookup))
-        except KeyError:
+    def transform(lookup, column, datetime_storage=datetimes.STRING, tzname=None):
+        """
+        Truncate a date or datetime column, as for ``dates()``/``datetimes()``
+        :param lookup: The part to truncate to
+        :param column: The column
+        :param datetime_storage: The format the column is stored in
+        :param tzname: The time zone to truncate in. Stored values are in UTC
+        :return: A tuple of (expression, field to convert values with)
+        """
+        if lookup not in DATE_MAPS or lookup == 'week_day':
             raise ValueError('Invalid lookup type: ' + lookup)
+
+        if tzname:
+            column = 'STR_TO_TZ({0}, "{1}")'.format(
+                datetimes.utc_string_expression(column, datetime_storage), tzname)
+        else:
+            column = datetimes.string_expression(column, datetime_storage)
+        return ('DATE_TRUNC_STR({0}, "{1}")'.format(column, DATE_MAPS[lookup]),
+                DateTransformField(lookup, tzname))
@@ -0,0 +1,306 @@
+"""
+Atomic get_or_create() and update_or_create() for primary key lookups.
+
+Django implements ``get_or_create()`` as a query followed by an insert, which
+costs two round trips (the query also waits for the index) and still races
+with concurrent callers. When the lookup is by primary key, the key of the
+document is known, so the QuerySet of :class:`CouchbaseManager` instead:
+
+- ``get_or_create()``: inserts the document first. Only if it already exists
+  (the insert fails with :class:`~.dbapi.DocumentExistsError`) is it fetched,
+  with a KV get. Creating is thus a single operation
+- ``update_or_create()``: reads the document and replaces it with CAS, or
+  inserts it if it is missing. If the document is modified in between, the
+  columns changed by the update are merged into its current version
+
+It also writes many objects at once, in batches of multi-operations and
+without querying for them first:
+
+- ``bulk_update(objs, fields)``: merges the values of the given fields of
+  each object into its document, with CAS (retrying documents modified in
+  between). Missing documents are reported as failures
+- ``bulk_upsert(objs)``: stores the objects, replacing their documents
+  entirely or creating them
+
+Failures are raised together as a :class:`~.unitofwork.BatchWriteError`. As
+with ``bulk_create()``, no signals are sent. Within ``write_behind()``, the
+writes join the pending ones.
+
+``delete()`` resolves cascades with set-based queries (see :mod:`.deletion`),
+unless deletion signals are connected.
+
+Instances it loads have a ``_state.may_be_stale`` attribute, which tells
+whether their document was read from a replica (see :mod:`.replica`).
+
+Use it as the default manager of a model::
+
+    class Event(models.Model):
+        id = models.CharField(max_length=64, primary_key=True)
+        ...
+        objects = CouchbaseManager()
+
+Other lookups, and other databases, use Django's implementation.
+"""
+from django.db import connections, IntegrityError, OperationalError
+from django.db.models import Manager, QuerySet
+from django.db.models import signals
+
+from couchbase.exceptions import KeyExistsError, NotFoundError
+
+from .compiler import InsertCommand
+from .dbapi import DocumentExistsError, NotSupportedError
+from .deletion import CascadeDeleter
+from .unitofwork import UnitOfWork, UPSERT, MERGE, CAS_RETRIES, DEFAULT_CHUNK_SIZE
+from .utils import DocID
+
+
+def _is_exists_error(exc):
+    return isinstance(getattr(exc, '__cause__', None), DocumentExistsError)
+
+
+class CouchbaseQuerySet(QuerySet):
+    def _pk_value(self, kwargs):
+        """
+        Get the primary key value from the lookup of get_or_create(), if
+        the query can use the atomic implementation
+        :return: The value, or None
+        """
+        if connections[self.db].vendor != 'couchbase':
+            return None
+
+        opts = self.model._meta
+        if opts.parents or self.query.where:
+            # Multi-table models, or a filtered QuerySet
+            return None
+
+        names = ('pk', opts.pk.name, opts.pk.attname)
+        value = None
+        for name in kwargs:
+            base = name[:-len('__exact')] if name.endswith('__exact') else name
+            if base in names:
+                value = kwargs[name]
+        return value
+
+    def _get_document(self, key):
+        connection = connections[self.db]
+        bucket = connection.get_bucket(connection.get_bucket_name_for(self.model))
+        return connection, bucket, bucket.get(key)
+
+    def _from_document(self, connection, bucket, key, doc):
+        # Build an instance from a document, as a SELECT would
+        opts = self.model._meta
+        columns = [f.column for f in opts.concrete_fields]
+        connection.offload.resolve(bucket, self.model, [doc], columns)
+
+        values = []
+        for field in opts.concrete_fields:
+            value = key if field.primary_key else doc.get(field.column)
+            if value is not None:
+                value = connection.ops.convert_values(value, field)
+            values.append(value)
+        return self.model.from_db(self.db, [f.attname for f in opts.concrete_fields], values)
+
+    def iterator(self):
+        stale = None
+        table = None
+        for obj in super(CouchbaseQuerySet, self).iterator():
+            if stale is None:
+                # The query has run by now
+                stale = getattr(self.query, '_cb_stale_keys', ())
+                if stale:
+                    table = connections[self.db].table_name(self.model._meta.concrete_model)
+            obj._state.may_be_stale = bool(stale) and DocID.encode(table, obj.pk) in stale
+            yield obj
+
+    def get_or_create(self, defaults=None, **kwargs):
+        pk = self._pk_value(kwargs)
+        if pk is None or connections[self.db].unit_of_work is not None:
+            # Buffered inserts cannot fail immediately
+            return super(CouchbaseQuerySet, self).get_or_create(defaults, **kwargs)
+
+        lookup, params = self._extract_model_params(defaults, **kwargs)
+        self._for_write = True
+        obj = self.model(**params)
+        try:
+            obj.save(force_insert=True, using=self.db)
+            return obj, True
+        except IntegrityError as e:
+            if not _is_exists_error(e):
+                raise
+            try:
+                return self.get(**lookup), False
+            except self.model.DoesNotExist:
+                # The document exists, but does not match the other lookups
+                raise e
+
+    def update_or_create(self, defaults=None, **kwargs):
+        pk = self._pk_value(kwargs)
+        if pk is None or len(kwargs) != 1 or connections[self.db].unit_of_work is not None:
+            return super(CouchbaseQuerySet, self).update_or_create(defaults, **kwargs)
+
+        defaults = defaults or {}
+        self._for_write = True
+        model = self.model
+        pk = model._meta.pk.to_python(pk)
+        key = DocID.encode(connections[self.db].table_name(model), pk)
+
+        res = None
+        for _ in range(CAS_RETRIES):
+            try:
+                connection, bucket, res = self._get_document(key)
+                break
+            except NotFoundError:
+                obj, created = self.get_or_create(defaults, **kwargs)
+                if created:
+                    return obj, True
+                # Created concurrently; update it
+
+        if res is not None:
+            obj = self._from_document(connection, bucket, key, res.value)
+            for name, value in defaults.items():
+                setattr(obj, name, value)
+            if self._replace(connection, bucket, obj, key, res):
+                return obj, False
+
+        raise OperationalError(
+            'Document {0} was modified concurrently {1} times'.format(key, CAS_RETRIES))
+
+    def _replace(self, connection, bucket, obj, key, res):
+        """
+        Save an existing instance by replacing its document with CAS. If the
+        document is modified in between, the changed columns are merged into
+        its current version
+        :param res: The result of reading the document, which `obj` was built from
+        :return: True if saved, False if the document was removed or kept
+            being modified
+        """
+        model = self.model
+        signals.pre_save.send(sender=model, instance=obj, raw=False, using=self.db,
+                              update_fields=None)
+
+        cmd = InsertCommand(connection, model)
+        doc, = cmd.get_params([obj], model._meta.concrete_fields, add=False).values()
+        original = res.value
+        changed = [c for c in set(doc) | set(original)
+                   if c not in original or c not in doc or doc[c] != original[c]]
+        side_docs, inline = connection.offload.split(model, key, doc)
+
+        cas = res.cas
+        for _ in range(CAS_RETRIES):
+            try:
+                rv = bucket.replace(key, doc, cas=cas)
+                break
+            except KeyExistsError:
+                pass
+            try:
+                current = bucket.get(key)
+            except NotFoundError:
+                return False
+            merged = current.value
+            for column in changed:
+                if column in doc:
+                    merged[column] = doc[column]
+                else:
+                    merged.pop(column, None)
+            doc, cas = merged, current.cas
+        else:
+            return False
+
+        # Side documents are only written once they have an owner
+        if side_docs:
+            bucket.upsert_multi(side_docs)
+        if inline:
+            bucket.remove_multi(inline, quiet=True)
+        if connection.doc_cache:
+            connection.doc_cache.put(key, doc, rv.cas)
+
+        obj._state.db = self.db
+        obj._state.adding = False
+        signals.post_save.send(sender=model, instance=obj, created=False, raw=False,
+                               using=self.db, update_fields=None)
+        return True
+
+    def delete(self):
+        assert self.query.can_filter(), \
+            "Cannot use 'limit' or 'offset' with delete."
+
+        del_query = self._clone()
+        del_query._for_write = True
+        del_query.query.select_for_update = False
+        del_query.query.select_related = False
+        del_query.query.clear_ordering(force_empty=True)
+
+        connection = connections[del_query.db]
+        deleter = CascadeDeleter(connection, del_query.db)
+        if connection.vendor != 'couchbase' or not deleter.can_delete(self.model):
+            return super(CouchbaseQuerySet, self).delete()
+
+        rv = deleter.delete(del_query)
+        self._result_cache = None
+        return rv
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def _bulk_write(self, objs, fields, kind, batch_size):
+        connection = connections[self.db]
+        if connection.vendor != 'couchbase':
+            raise NotSupportedError(
+                "Bulk writes require a Couchbase database, not '{0}'".format(self.db))
+
+        model = self.model
+        opts = model._meta
+        if opts.parents:
+            raise ValueError('Bulk writes are not supported for multi-table models')
+
+        uow = connection.unit_of_work
+        own = uow is None
+        if own:
+            uow = UnitOfWork(connection, batch_size or DEFAULT_CHUNK_SIZE)
+
+        cmd = InsertCommand(connection, model)
+        bucket_name = connection.get_bucket_name_for(model)
+        for obj in objs:
+            (key, doc), = cmd.get_params([obj], fields, add=kind == UPSERT).items()
+            if obj.pk is None:
+                obj.pk = connection.ops.convert_values(key, opts.pk)
+            uow.add(key, kind, doc, model, bucket_name)
+            obj._state.db = self.db
+            obj._state.adding = False
+
+        if own:
+            uow.flush()
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        """
+        Update the given fields of many objects, each with its own values
+        :param objs: The objects. They must have a primary key
+        :param fields: Names of the fields to update
+        :param batch_size: Number of documents per multi-operation
+        :return: The number of objects
+        """
+        opts = self.model._meta
+        fields = [opts.get_field(name) for name in fields]
+        if any(f.primary_key for f in fields):
+            raise ValueError('bulk_update() cannot be used with primary key fields')
+        objs = list(objs)
+        if any(obj.pk is None for obj in objs):
+            raise ValueError('All bulk_update() objects must have a primary key set')
+
+        self._bulk_write(objs, [opts.pk] + fields, MERGE, batch_size)
+        return len(objs)
+
+    def bulk_upsert(self, objs, batch_size=None):
+        """
+        Store many objects, creating or replacing their documents. Objects
+        without a primary key are assigned one
+        :param objs: The objects
+        :param batch_size: Number of documents per multi-operation
+        :return: The objects
+        """
+        objs = list(objs)
+        self._bulk_write(objs, self.model._meta.concrete_fields, UPSERT, batch_size)
+        return objs
+
+
+class CouchbaseManager(Manager.from_queryset(CouchbaseQuerySet)):
+    pass
@@ -0,0 +1,177 @@
+"""
+Replica reads for primary key lookups.
+
+Primary key lookups normally read the active copy of each document. During a
+rebalance or failover, or when a node is hot, those reads may stall until they
+time out. A replica read policy trades freshness for bounded latency by reading
+from a replica copy instead, which may lag behind the active copy.
+
+The policy is configured in the database ``OPTIONS``::
+
+    'OPTIONS': {
+        'REPLICA_READS': {
+            'POLICY': 'hedged',     # 'never', 'on_error', 'hedged' or 'always'
+            'HEDGE_DELAY_MS': 50,   # For 'hedged'
+            'MODELS': ['myapp.country'],  # Always read from replicas
+        }
+    }
+
+- ``on_error``: read the active copy, and retry keys which failed (other than
+  because they do not exist) on a replica
+- ``hedged``: as ``on_error``, but also issue the replica read if the active
+  read has not completed after ``HEDGE_DELAY_MS``; the first to finish wins
+- ``always``: only read replicas
+
+Updates always read the active copy, since they must not write back stale data.
+Documents which were read from a replica are reported by the ``stale_keys``
+attribute of the SelectCommand and the ``may_be_stale`` attribute of the cursor.
+Model instances loaded through a ``CouchbaseManager`` are marked with
+``instance._state.may_be_stale``.
+"""
+import threading
+from Queue import Queue, Empty
+
+from couchbase.exceptions import CouchbaseError, NotFoundError
+
+from .utils import model_label
+
+NEVER = 'never'
+ON_ERROR = 'on_error'
+HEDGED = 'hedged'
+ALWAYS = 'always'
+
+POLICIES = (NEVER, ON_ERROR, HEDGED, ALWAYS)
+
+
+def _collect(results):
+    return dict((res.key, (res.value, res.cas))
+                for res in results.values() if res.success)
+
+
+def _failed_keys(exc):
+    """
+    Get the keys of a multi operation which failed for a reason other than
+    not existing
+    """
+    try:
+        _, failed = exc.split_results()
+    except AttributeError:
+        return None
+
+    return [k for k, res in failed.items()
+            if not issubclass(CouchbaseError.rc_to_exctype(res.rc), NotFoundError)]
+
+
+class ReplicaReads(object):
+    def __init__(self, wrapper, policy=NEVER, hedge_delay_ms=50, models=()):
+        """
+        :param wrapper: The DatabaseWrapper, used to borrow extra bucket handles
+        :param policy: The default policy
+        :param hedge_delay_ms: Delay before a hedged replica read, in milliseconds
+        :param models: Labels of models which are always read from replicas
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown replica read policy: ' + policy)
+
+        self.wrapper = wrapper
+        self.policy = policy
+        self.hedge_delay = hedge_delay_ms / 1000.0
+        self.models = set(x.lower() for x in models)
+
+    @classmethod
+    def from_settings(cls, wrapper, settings_dict):
+        options = settings_dict.get('OPTIONS', {}).get('REPLICA_READS', {})
+        return cls(wrapper,
+                   policy=options.get('POLICY', NEVER),
+                   hedge_delay_ms=options.get('HEDGE_DELAY_MS', 50),
+                   models=options.get('MODELS', ()))
+
+    def policy_for(self, model):
+        if model_label(model) in self.models:
+            return ALWAYS
+        return self.policy
+
+    def get_multi(self, bucket, keys, model):
+        """
+        Fetch documents according to the policy for the model
+        :param bucket: The bucket
+        :param keys: The keys to fetch
+        :param model: The model being queried
+        :return: A tuple of (found, stale). `found` is a dict of key -> (value, cas)
+            for the documents which exist, and `stale` the set of keys which
+            were read from a replica.
+        """
+        policy = self.policy_for(model)
+
+        if policy == ALWAYS:
+            found = _collect(bucket.get_multi(keys, quiet=True, replica=True))
+            return found, set(found)
+
+        elif policy == ON_ERROR:
+            try:
+                return _collect(bucket.get_multi(keys, quiet=True)), set()
+            except CouchbaseError as e:
+                return self._fallback(bucket, keys, e)
+
+        elif policy == HEDGED:
+            return self._hedged(bucket, keys)
+
+        else:
+            return _collect(bucket.get_multi(keys, quiet=True)), set()
+
+    def _fallback(self, bucket, keys, exc):
+        failed = _failed_keys(exc)
+        if failed is None:
+            # Not a multi-operation failure; retry everything
+            found, failed = {}, keys
+        else:
+            ok, _ = exc.split_results()
+            found = _collect(ok)
+
+        if not failed:
+            return found, set()
+
+        replicas = _collect(bucket.get_multi(failed, quiet=True, replica=True))
+        found.update(replicas)
+        return found, set(replicas)
+
+    def _hedged(self, bucket, keys):
+        # Both reads run on borrowed handles: the losing read may still be in
+        # flight when we return, and must not hold on to the caller's bucket.
+        pool = self.wrapper.get_bucket_pool(bucket.bucket)
+        results = Queue()
+
+        def run(replica):
+            handle = pool.acquire()
+            try:
+                rv = handle.get_multi(keys, quiet=True, replica=replica)
+                results.put((replica, rv, None))
+            except CouchbaseError as e:
+                results.put((replica, None, e))
+            finally:
+                pool.release(handle)
+
+        def start(replica):
+            thr = threading.Thread(target=run, args=(replica,))
+            thr.daemon = True
+            thr.start()
+
+        start(False)
+        try:
+            replica, rv, exc = results.get(timeout=self.hedge_delay)
+            if exc is None:
+                return _collect(rv), set()
+            pending = 1
+        except Empty:
+            pending = 2
+
+        start(True)
+        error = None
+        for _ in range(pending):
+            replica, rv, exc = results.get()
+            if exc is None:
+                found = _collect(rv)
+                return found, set(found) if replica else set()
+            error = exc
+
+        raise error
@@ -0,0 +1,281 @@
+"""
+Parallel, range-partitioned scans.
+
+Every document of a model is stored under the ``<table>:<fmt>:<value>`` key
+format produced by :class:`~.utils.DocID`. Generated keys carry a base64
+encoded UUID4, so the key space below the ``<table>:`` prefix is evenly
+distributed and can be split into contiguous ``META().id`` ranges. Each range
+is queried concurrently (on its own bucket handle) and the streams are merged
+back together, either as they arrive or with a k-way merge when the query is
+ordered.
+
+Parallel scans are opt-in, either for the whole database via the
+``PARALLEL_SCAN`` entry in the database ``OPTIONS``::
+
+    'OPTIONS': {'PARALLEL_SCAN': {'PARTITIONS': 8, 'WORKERS': 8}}
+
+or for a block of code (e.g. an export job)::
+
+    with parallel_scans(16):
+        for obj in MyModel.objects.iterator():
+            ...
+"""
+import heapq
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Full
+
+B64_ALPHABET = ''.join(sorted(
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'))
+
+# Number of rows each partition may buffer ahead of the consumer
+PARTITION_BUFFER = 1000
+
+_state = threading.local()
+
+
+@contextmanager
+def parallel_scans(partitions, workers=None):
+    """
+    Run eligible SELECT queries issued in this block as parallel scans.
+    :param partitions: Number of key ranges to split each scan into
+    :param workers: Number of concurrent range queries. Defaults to `partitions`
+    """
+    prev = getattr(_state, 'options', None)
+    _state.options = (partitions, workers or partitions)
+    try:
+        yield
+    finally:
+        _state.options = prev
+
+
+def current_options(connection):
+    """
+    Get the scan options in effect
+    :param connection: The DatabaseWrapper
+    :return: A tuple of (partitions, workers), or None if scans are serial
+    """
+    options = getattr(_state, 'options', None)
+    if options:
+        return options
+
+    settings = connection.settings_dict.get('OPTIONS', {}).get('PARALLEL_SCAN')
+    if settings and settings.get('PARTITIONS', 1) > 1:
+        partitions = settings['PARTITIONS']
+        return partitions, settings.get('WORKERS', partitions)
+    return None
+
+
+def split_keyspace(table, partitions):
+    """
+    Split the key space of a table into ranges.
+    :param table: The table name (DocID prefix)
+    :param partitions: The number of ranges
+    :return: A list of (low, high) tuples. The first range has no lower bound
+        and the last has no upper bound (None), so that keys which are not
+        base64 encoded (string PKs) are still covered.
+    """
+    width = len(B64_ALPHABET)
+    partitions = max(1, min(partitions, width * width))
+    prefix = table + ':U:'
+
+    bounds = []
+    for ix in range(1, partitions):
+        pos = ix * width * width // partitions
+        bounds.append(prefix + B64_ALPHABET[pos // width] + B64_ALPHABET[pos % width])
+
+    lows = [None] + bounds
+    highs = bounds + [None]
+    return zip(lows, highs)
+
+
+def merge_ranges(ranges, count):
+    """
+    Join adjacent ranges, as returned by split_keyspace()
+    :param count: The maximum number of ranges to return
+    :return: A list of (low, high) tuples covering the same keys
+    """
+    if len(ranges) <= count:
+        return list(ranges)
+    rv = []
+    for ix in range(count):
+        group = ranges[ix * len(ranges) // count:(ix + 1) * len(ranges) // count]
+        rv.append((group[0][0], group[-1][1]))
+    return rv
+
+
+class BucketPool(object):
+    """
+    Pool of extra bucket handles. A Bucket may not be used concurrently from
+    multiple threads, so each worker borrows its own handle.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return self._factory()
+
+    def release(self, bucket):
+        with self._lock:
+            self._free.append(bucket)
+
+
+class _Done(object):
+    """ End-of-stream marker for a partition """
+    def __init__(self, error=None):
+        self.error = error
+
+
+class _Descending(object):
+    """ Inverts the ordering of a sort key """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def n1ql_collation_key(value):
+    """
+    Sort key which follows N1QL collation:
+    MISSING/NULL < false < true < numbers < strings < arrays < objects
+    """
+    if value is None:
+        return 0, None
+    elif isinstance(value, bool):
+        return 1, value
+    elif isinstance(value, (int, long, float)):
+        return 2, value
+    elif isinstance(value, basestring):
+        return 3, value
+    elif isinstance(value, list):
+        return 4, [n1ql_collation_key(x) for x in value]
+    else:
+        return 5, sorted(value.items())
+
+
+def row_sort_key(order_keys, row):
+    """
+    Get the sort key of a row
+    :param order_keys: A list of (key, descending) tuples, where key is the
+        position of the value for array rows, or its alias for object rows
+    :param row: The row
+    """
+    key = []
+    for ix, descending in order_keys:
+        value = n1ql_collation_key(row[ix] if isinstance(row, list) else row.get(ix))
+        key.append(_Descending(value) if descending else value)
+    return key
+
+
+class ParallelScan(object):
+    def __init__(self, command, bucket, partitions, workers):
+        """
+        Execute a SelectCommand as a set of concurrent range queries
+        :param command: The SelectCommand. Must be partitionable
+        :param bucket: The bucket the command would have executed on
+        :param partitions: Number of key ranges
+        :param workers: Number of concurrent queries
+        """
+        self.command = command
+        self.bucket_name = bucket.bucket
+        self.ranges = split_keyspace(command.table_name, partitions)
+        self.workers = max(1, min(workers, len(self.ranges)))
+        self.pool = command.connection.get_bucket_pool(self.bucket_name)
+        self._stop = threading.Event()
+
+    def _sort_key(self, row):
+        return row_sort_key(self.command.row_order_keys, row)
+
+    def _put(self, queue, item):
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _scan_range(self, low, high, queue):
+        bucket = self.pool.acquire()
+        try:
+            for row in self.command.execute_range(bucket, low, high):
+                if self._stop.is_set():
+                    break
+                self._put(queue, row)
+            self._put(queue, _Done())
+        except Exception as e:
+            self._put(queue, _Done(e))
+        finally:
+            self.pool.release(bucket)
+
+    def _get(self, queue):
+        item = queue.get()
+        if isinstance(item, _Done) and item.error is not None:
+            raise item.error
+        return item
+
+    def _iter_unordered(self, pool):
+        queue = Queue(PARTITION_BUFFER * self.workers)
+        for low, high in self.ranges:
+            pool.apply_async(self._scan_range, (low, high, queue))
+
+        remaining = len(self.ranges)
+        while remaining:
+            item = self._get(queue)
+            if isinstance(item, _Done):
+                remaining -= 1
+            else:
+                yield item
+
+    def _iter_ordered(self, pool):
+        # The merge needs the next row of every range, so a range waiting for
+        # a worker would block those already running on full buffers. Join
+        # adjacent ranges so that each one gets its own worker.
+        ranges = merge_ranges(self.ranges, self.workers)
+        queues = [Queue(PARTITION_BUFFER) for _ in ranges]
+        for (low, high), queue in zip(ranges, queues):
+            pool.apply_async(self._scan_range, (low, high, queue))
+
+        heap = []
+
+        def push(ix):
+            item = self._get(queues[ix])
+            if not isinstance(item, _Done):
+                heap.append((self._sort_key(item), ix, item))
+
+        for ix in range(len(queues)):
+            push(ix)
+        heapq.heapify(heap)
+
+        while heap:
+            _, ix, row = heap[0]
+            item = self._get(queues[ix])
+            if isinstance(item, _Done):
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (self._sort_key(item), ix, item))
+            yield row
+
+    def __iter__(self):
+        pool = ThreadPool(self.workers)
+        try:
+            if self.command.order_keys:
+                it = self._iter_ordered(pool)
+            else:
+                it = self._iter_unordered(pool)
+            for row in it:
+                yield row
+        finally:
+            self._stop.set()
+            pool.close()
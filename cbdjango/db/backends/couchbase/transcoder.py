@@ -0,0 +1,131 @@
+"""
+Pluggable JSON codec for documents and query rows.
+
+By default the SDK encodes and decodes JSON with the standard library ``json``
+module. A faster module providing ``dumps()`` and ``loads()`` (e.g. ``ujson``,
+``simplejson`` or ``rapidjson``) may be configured in the database ``OPTIONS``::
+
+    'OPTIONS': {'JSON_CODEC': 'ujson'}
+
+The codec is used by the transcoder of every bucket opened by the backend, and
+is also installed as the SDK's JSON converter so that N1QL rows are decoded
+with it. As the latter is process-wide, all Couchbase databases should use the
+same codec.
+
+Datetimes, dates, times and UUIDs are encoded by the codec itself, using the
+same textual representation as Django's database operations, so they do not
+need to be converted to strings before being stored. Decimals are not: their
+text depends on the ``decimal_places`` of their field, so they are always
+formatted by the database operations.
+"""
+import datetime
+import decimal
+import uuid
+from importlib import import_module
+
+import couchbase
+from couchbase import FMT_JSON, FMT_AUTO
+from couchbase.transcoder import Transcoder, get_decode_format
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+# Codecs whose dumps() accepts a `default` hook, and the extra arguments they need
+_DEFAULT_HOOK_KWARGS = {
+    'json': {'separators': (',', ':')},
+    'simplejson': {'separators': (',', ':'), 'use_decimal': False},
+    'rapidjson': {},
+}
+
+NATIVE_TYPES = (datetime.date, datetime.time, uuid.UUID)
+
+# Types encode_default() accepts
+_ENCODED_TYPES = NATIVE_TYPES + (decimal.Decimal,)
+
+
+def encode_default(obj):
+    """
+    Encode the values of types which JSON has no representation for
+    """
+    if isinstance(obj, datetime.datetime):
+        if timezone.is_aware(obj):
+            obj = timezone.make_naive(obj, timezone.utc)
+        return unicode(obj)
+    elif isinstance(obj, (datetime.date, datetime.time, decimal.Decimal)):
+        return unicode(obj)
+    elif isinstance(obj, uuid.UUID):
+        return obj.hex
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+
+def _prepare(obj):
+    # For codecs without a `default` hook, convert values up front
+    if isinstance(obj, dict):
+        return dict((k, _prepare(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        return [_prepare(x) for x in obj]
+    elif isinstance(obj, _ENCODED_TYPES):
+        return encode_default(obj)
+    return obj
+
+
+class JSONCodec(object):
+    def __init__(self, name):
+        """
+        :param name: The name of a module providing `dumps()` and `loads()`
+        """
+        try:
+            module = import_module(name)
+        except ImportError as e:
+            raise ImproperlyConfigured('Cannot load JSON codec {0}: {1}'.format(name, e))
+
+        self.name = name
+        self._dumps = module.dumps
+        self.loads = module.loads
+        self._kwargs = _DEFAULT_HOOK_KWARGS.get(name)
+
+    def dumps(self, value):
+        if self._kwargs is not None:
+            return self._dumps(value, default=encode_default, **self._kwargs)
+        return self._dumps(_prepare(value))
+
+
+class CodecTranscoder(Transcoder):
+    """
+    Transcoder which encodes and decodes JSON values with a JSONCodec
+    """
+    def __init__(self, codec):
+        super(CodecTranscoder, self).__init__()
+        self.codec = codec
+
+    def encode_value(self, value, format):
+        if format == FMT_JSON or (format == FMT_AUTO and isinstance(value, (dict, list))):
+            return self.codec.dumps(value), FMT_JSON
+        return super(CodecTranscoder, self).encode_value(value, format)
+
+    def decode_value(self, value, flags):
+        format, _ = get_decode_format(flags)
+        if format == FMT_JSON:
+            return self.codec.loads(value)
+        return super(CodecTranscoder, self).decode_value(value, flags)
+
+
+_installed = None
+
+
+def get_codec(settings_dict):
+    """
+    Get the JSON codec configured for a database
+    :return: A JSONCodec, or None to use the SDK default
+    """
+    global _installed
+
+    name = settings_dict.get('OPTIONS', {}).get('JSON_CODEC')
+    if not name:
+        return None
+
+    codec = JSONCodec(name)
+    if _installed != name:
+        couchbase.set_json_converters(codec.dumps, codec.loads)
+        _installed = name
+    return codec
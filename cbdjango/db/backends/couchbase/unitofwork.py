@@ -0,0 +1,407 @@
+"""
+Write-behind unit of work.
+
+Every ``save()`` and ``delete()`` is normally executed on its own, paying a
+network round trip per object. Within a unit of work, inserts and updates or
+deletes of objects by primary key are buffered instead, and written on exit in
+batches of multi-operations::
+
+    with write_behind():
+        for row in rows:
+            Entry(title=row[0], body=row[1]).save()
+
+    @write_behind(chunk_size=1000)
+    def import_entries(rows):
+        ...
+
+Operations on the same document are coalesced (e.g. an insert followed by an
+update is a single insert of the updated document). Operations which cannot
+be coalesced, and any other query executed on the database (including
+SELECTs), first flush the pending writes, so the order of operations on each
+document is preserved and queries see earlier writes.
+
+As the writes are deferred, their failures are only known when flushing: they
+are raised together, per document, as a :class:`BatchWriteError`. Note that:
+
+- ``save()`` of an object loaded from the database replaces its document
+  entirely (rather than reading it first), and a missing document is reported
+  as a failure. ``save()`` of a new object with a primary key cannot tell
+  whether its document exists, so it creates or replaces it. With
+  ``update_fields``, the fields are merged into the document when flushing,
+  and a missing document is reported as a failure
+- If the block raises an exception, pending writes are discarded
+"""
+from collections import OrderedDict
+
+from django.db import connections, DEFAULT_DB_ALIAS, IntegrityError
+from django.db.models import signals
+from django.utils.decorators import ContextDecorator
+
+from couchbase.exceptions import CouchbaseError, KeyExistsError, NotFoundError
+
+from .compiler import InsertCommand, UpdateCommand, DeleteCommand, TYPEFIELD, \
+    pk_only_keys, remove_documents
+from . import catalog, offload
+from .coalescing import current_loader
+from .utils import cas_items, DocID
+
+DEFAULT_CHUNK_SIZE = 500
+
+# Number of attempts to merge values into a document modified concurrently
+CAS_RETRIES = 10
+
+INSERT = 'insert'
+UPSERT = 'upsert'
+REPLACE = 'replace'
+MERGE = 'merge'
+REMOVE = 'remove'
+
+
+class BatchWriteError(IntegrityError):
+    """
+    Raised when some of the buffered writes failed
+    """
+    def __init__(self, failures):
+        """
+        :param failures: A dict of document ID -> (operation, exception)
+        """
+        super(BatchWriteError, self).__init__(
+            '{0} buffered write(s) failed: {1}'.format(
+                len(failures), ', '.join(sorted(failures))))
+        self.failures = failures
+
+
+class _PendingResult(object):
+    """ Stands for the result of a buffered insert """
+    def __init__(self, key):
+        self.key = key
+        self.success = True
+
+
+def _coalesce(prev, new):
+    """
+    Combine two operations on the same document
+    :return: The combined (kind, value), or None if they must run in order
+    """
+    pkind, pvalue = prev
+    nkind, nvalue = new
+    if nkind == MERGE and pkind in (INSERT, UPSERT, REPLACE, MERGE):
+        value = dict(pvalue)
+        value.update(nvalue)
+        return pkind, value
+    elif nkind in (UPSERT, REPLACE) and pkind == INSERT:
+        return INSERT, nvalue
+    elif nkind == UPSERT and pkind in (UPSERT, REPLACE, MERGE):
+        return UPSERT, nvalue
+    elif nkind == REPLACE and pkind in (UPSERT, REPLACE, MERGE):
+        # A merge also requires the document to exist
+        return UPSERT if pkind == UPSERT else REPLACE, nvalue
+    elif nkind == REMOVE and pkind in (UPSERT, REPLACE, MERGE, REMOVE):
+        return REMOVE, None
+    return None
+
+
+def _split_failures(exc, kind, failures, retry=None):
+    """
+    Record the keys which failed in a multi operation
+    :param retry: An exception type. Keys failing with it are not recorded,
+        but returned to be retried
+    :return: A tuple of (ok, retry_keys): the results of the keys which
+        succeeded, and the keys to retry
+    """
+    try:
+        ok, failed = exc.split_results()
+    except AttributeError:
+        raise exc
+
+    retry_keys = []
+    for key, res in failed.items():
+        exctype = CouchbaseError.rc_to_exctype(res.rc)
+        if retry is not None and issubclass(exctype, retry):
+            retry_keys.append(key)
+        else:
+            failures[key] = (kind, exctype({'rc': res.rc, 'key': key}))
+    return ok, retry_keys
+
+
+class UnitOfWork(object):
+    def __init__(self, connection, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param connection: The DatabaseWrapper
+        :param chunk_size: Maximum number of documents per multi-operation
+        """
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.depth = 0
+        # Document ID -> (kind, value, model, bucket name), in order of arrival
+        self._ops = OrderedDict()
+        # Documents of the instances being saved which were loaded from the database
+        self._existing = set()
+
+    def __len__(self):
+        return len(self._ops)
+
+    def add(self, key, kind, value, model, bucket_name):
+        """
+        Buffer an operation on a document
+        :param key: The document ID
+        :param kind: INSERT, UPSERT or REPLACE (`value` is the document),
+            MERGE (`value` is a dict of values to merge into the document) or
+            REMOVE
+        :param model: The model of the document
+        :param bucket_name: The bucket of the document
+        """
+        prev = self._ops.get(key)
+        if prev is not None:
+            combined = _coalesce(prev[:2], (kind, value))
+            if combined is None:
+                self.flush()
+            else:
+                kind, value = combined
+        self._ops[key] = (kind, value, model, bucket_name)
+
+    def note_existing(self, model, pk):
+        """
+        Record that the document of an instance about to be saved exists, so
+        that a full update replaces it rather than upserting it
+        """
+        table = self.connection.table_name(model._meta.concrete_model)
+        self._existing.add(DocID.encode(table, pk))
+
+    def buffer(self, cmd, *args):
+        """
+        Buffer the writes of a command, if possible
+        :param cmd: The command
+        :param args: The arguments of its execution
+        :return: A tuple of (buffered, result). The result is that of the
+            cursor: the (pending) insert results, or the row count
+        """
+        if isinstance(cmd, InsertCommand):
+            to_insert, = args
+            results = []
+            for key, doc in to_insert.items():
+                self.add(key, INSERT, doc, cmd.model, cmd.bucket_name)
+                results.append(_PendingResult(key))
+            return True, results
+
+        if isinstance(cmd, (UpdateCommand, DeleteCommand)):
+            keys = pk_only_keys(cmd.select)
+            if keys is None:
+                return False, None
+
+            model = cmd.select.top_query.model
+            if isinstance(cmd, DeleteCommand):
+                op = REMOVE, None
+            elif cmd.is_full_update():
+                doc = cmd.get_merge()
+                doc[TYPEFIELD] = self.connection.table_name(model)
+                op = UPSERT, doc
+            else:
+                op = MERGE, cmd.get_merge()
+
+            for key in keys:
+                kind = op[0]
+                if kind == UPSERT and key in self._existing:
+                    kind = REPLACE
+                self._existing.discard(key)
+                # Documents are modified in place when offloading values
+                value = dict(op[1]) if op[1] is not None else None
+                self.add(key, kind, value, model, cmd.bucket_name)
+            return True, len(keys)
+
+        return False, None
+
+    def discard(self):
+        self._ops.clear()
+        self._existing.clear()
+
+    def flush(self):
+        """
+        Write all pending operations
+        :raise BatchWriteError: if any of them failed
+        """
+        if not self._ops:
+            return
+
+        loader = current_loader(self.connection.alias)
+        if loader is not None:
+            loader.clear()
+
+        groups = OrderedDict()
+        for key, (kind, value, model, bucket_name) in self._ops.items():
+            groups.setdefault((bucket_name, model, kind), []).append((key, value))
+        self._ops.clear()
+
+        failures = {}
+        for (bucket_name, model, kind), items in groups.items():
+            bucket = self.connection.get_bucket(bucket_name)
+            for ix in range(0, len(items), self.chunk_size):
+                chunk = OrderedDict(items[ix:ix + self.chunk_size])
+                if kind == REMOVE:
+                    self._remove(bucket, model, chunk.keys())
+                elif kind == MERGE:
+                    self._merge(bucket, model, chunk, failures)
+                else:
+                    self._store(bucket, model, kind, chunk, failures)
+
+        if failures:
+            raise BatchWriteError(failures)
+
+    def _store(self, bucket, model, kind, docs, failures):
+        catalog.ensure_type(bucket, model, self.connection.table_name(model))
+
+        # Side documents go first. Those of new documents are inserted, so
+        # that the side documents of existing ones are never overwritten
+        policy = self.connection.offload
+        side_docs = {}
+        inline = {}
+        if policy.columns_for(model):
+            for key, doc in docs.items():
+                side, inline[key] = policy.split(model, key, doc)
+                side_docs.update(side)
+
+        created = []
+        if side_docs and kind == INSERT:
+            try:
+                created = bucket.insert_multi(side_docs).keys()
+            except CouchbaseError as e:
+                ok, failed = e.split_results()
+                created = ok.keys()
+                # The owners of existing side documents exist too
+                for owner in set(offload.owner_of(k) for k in failed):
+                    failures[owner] = (kind, KeyExistsError({'key': owner}))
+                    docs.pop(owner, None)
+        elif side_docs:
+            bucket.upsert_multi(side_docs)
+
+        results = {}
+        op = {INSERT: bucket.insert_multi, UPSERT: bucket.upsert_multi,
+              REPLACE: bucket.replace_multi}[kind]
+        try:
+            if docs:
+                results = op(docs)
+        except CouchbaseError as e:
+            results, _ = _split_failures(e, kind, failures)
+        # Only roll back the side documents this batch created, or wrote for
+        # documents which do not exist
+        orphans = [k for k in created if offload.owner_of(k) not in results]
+        if kind == REPLACE:
+            orphans += [k for k in side_docs if isinstance(
+                failures.get(offload.owner_of(k), (None, None))[1], NotFoundError)]
+        if kind != INSERT:
+            # Documents which were written no longer point to their side documents
+            orphans += [x for key in results for x in inline.get(key, ())]
+        if orphans:
+            bucket.remove_multi(orphans, quiet=True)
+
+        counters = self.connection.counters
+        if kind == INSERT:
+            counters.add(bucket, model, len(results))
+        elif kind == UPSERT:
+            # Documents may or may not have been created
+            counters.reset(bucket, [self.connection.table_name(model)])
+
+        cache = self.connection.doc_cache
+        if cache:
+            cache.put_multi((k, docs[k], v.cas) for k, v in results.items())
+
+    def _merge(self, bucket, model, merges, failures):
+        # Documents modified concurrently are merged again
+        pending = merges.keys()
+        for _ in range(CAS_RETRIES):
+            pending = self._merge_once(bucket, model, merges, pending, failures)
+            if not pending:
+                return
+
+        for key in pending:
+            failures[key] = (MERGE, KeyExistsError({'key': key, 'message': 'CAS mismatch'}))
+
+    def _merge_once(self, bucket, model, merges, keys, failures):
+        """
+        Merge values into the current version of documents
+        :return: The keys which were modified since they were read
+        """
+        try:
+            current = bucket.get_multi(keys)
+        except CouchbaseError as e:
+            current, _ = _split_failures(e, MERGE, failures)
+
+        policy = self.connection.offload
+        to_update = {}
+        side_docs = {}
+        inline = {}
+        for key, res in current.items():
+            doc = res.value
+            doc.update(merges[key])
+            to_update[key] = (doc, res.cas)
+            if policy.columns_for(model):
+                side, inline[key] = policy.split(model, key, doc, set(merges[key]))
+                side_docs.update(side)
+
+        if not to_update:
+            return []
+
+        conflicts = []
+        try:
+            results = bucket.replace_multi(cas_items(to_update))
+        except CouchbaseError as e:
+            results, conflicts = _split_failures(e, MERGE, failures, retry=KeyExistsError)
+
+        # Side documents are only written for the documents which were
+        # replaced, so that none is attached to a stale owner
+        side_docs = dict((k, v) for k, v in side_docs.items() if offload.owner_of(k) in results)
+        if side_docs:
+            bucket.upsert_multi(side_docs)
+
+        # Only documents which were replaced no longer point to their side documents
+        stale = [x for key in results for x in inline.get(key, ())]
+        if stale:
+            bucket.remove_multi(stale, quiet=True)
+
+        cache = self.connection.doc_cache
+        if cache:
+            cache.put_multi((k, to_update[k][0], v.cas) for k, v in results.items())
+            cache.invalidate_multi(k for k in to_update if k not in results)
+        return conflicts
+
+    def _remove(self, bucket, model, keys):
+        # As for DELETE queries, removing a missing document is not an error
+        remove_documents(self.connection, bucket, model, keys)
+
+
+def _note_existing(sender, instance, raw, using, **kwargs):
+    uow = getattr(connections[using], 'unit_of_work', None)
+    if uow is not None and not instance._state.adding and instance.pk is not None:
+        uow.note_existing(sender, instance.pk)
+
+signals.pre_save.connect(_note_existing, dispatch_uid='cbdjango.unitofwork')
+
+
+class write_behind(ContextDecorator):
+    """
+    Buffer the writes issued in a block (or function) and flush them in
+    batches on exit. Nested blocks join the outermost one.
+    """
+    def __init__(self, using=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.using = using or DEFAULT_DB_ALIAS
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        connection = connections[self.using]
+        if connection.unit_of_work is None:
+            connection.unit_of_work = UnitOfWork(connection, self.chunk_size)
+        connection.unit_of_work.depth += 1
+        return connection.unit_of_work
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection = connections[self.using]
+        uow = connection.unit_of_work
+        uow.depth -= 1
+        if uow.depth:
+            return
+
+        connection.unit_of_work = None
+        if exc_type is None:
+            uow.flush()
+        else:
+            uow.discard()
@@ -1,18 +1,52 @@
 from uuid import uuid4, UUID
 from base64 import b64decode, b64encode
 
+from couchbase.items import Item, ItemOptionDict
+
 def n1ql_escape(name):
     return '`{0}`'.format(name.replace('`', '``'))
 
 
 def mk_b64(value):
-    return b64encode(value.replace('/', '_'))[:-2]
+    return b64encode(value)[:-2]
 
 
 def extract_b64(raw):
     return b64decode(raw.replace('_', '/') + '==')
 
 
+def model_label(model):
+    """
+    Get the label used to refer to a model in the database OPTIONS
+    :param model: The model class
+    :return: The lowercased ``app_label.model_name``
+    """
+    opts = model._meta
+    return '{0}.{1}'.format(opts.app_label, opts.model_name).lower()
+
+
+def prefix_range(prefix):
+    """
+    Get the bounds of the keys starting with a prefix
+    :return: A tuple of (low, high): matching keys are >= low and < high
+    """
+    return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+def cas_items(docs):
+    """
+    Build the argument of a multi-mutation which checks each document's CAS
+    :param docs: A dict of key -> (value, cas)
+    :return: An ItemOptionDict
+    """
+    items = ItemOptionDict()
+    for key, (value, cas) in docs.items():
+        item = Item(key, value)
+        item.cas = cas
+        items.add(item)
+    return items
+
+
 NO_VALUE = object()
 
 
@@ -0,0 +1,5 @@
+"""
+Tests of the backend, run against the in-memory bucket::
+
+    django-admin test cbdjango.tests --settings=cbdjango.tests.settings
+"""
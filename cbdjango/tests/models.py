@@ -0,0 +1,34 @@
+from django.db import models
+
+from cbdjango.db.backends.couchbase.queryset import CouchbaseManager
+
+
+class Author(models.Model):
+    name = models.CharField(max_length=100)
+
+    objects = CouchbaseManager()
+
+
+class Entry(models.Model):
+    title = models.CharField(max_length=200)
+    body = models.TextField(default=u'')
+    rating = models.IntegerField(default=0)
+    views = models.IntegerField(null=True, default=0)
+    created = models.DateTimeField(null=True)
+    author = models.ForeignKey(Author, null=True)
+
+    objects = CouchbaseManager()
+
+
+class Comment(models.Model):
+    entry = models.ForeignKey(Entry)
+    reply_to = models.ForeignKey('self', null=True, on_delete=models.SET_NULL)
+    text = models.CharField(max_length=200)
+
+    objects = CouchbaseManager()
+
+
+class Highlight(models.Model):
+    entry = models.ForeignKey(Entry, on_delete=models.PROTECT)
+
+    objects = CouchbaseManager()
@@ -0,0 +1,21 @@
+"""
+Settings for running the tests against the in-memory bucket
+"""
+DATABASES = {
+    'default': {
+        'ENGINE': 'cbdjango.db.backends.couchbase',
+        'NAME': 'tests',
+        'CONNECTION_STRING': 'memory://',
+        'OPTIONS': {
+            'OFFLOAD_FIELDS': {'tests.entry': ['body']},
+            'OFFLOAD_THRESHOLD': 64,
+            'COUNTER_MODELS': ['tests.entry'],
+        },
+    }
+}
+
+INSTALLED_APPS = ['cbdjango.tests']
+
+SECRET_KEY = "cbdjango_tests_secret_key"
+
+USE_TZ = False
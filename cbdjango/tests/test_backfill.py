@@ -0,0 +1,87 @@
+from datetime import date
+
+from django.db import connection, models
+from django.test import TestCase
+
+from cbdjango.db.backends.couchbase.backfill import Backfill, checkpoint_key
+from cbdjango.db.backends.couchbase.transcoder import JSONCodec
+from cbdjango.db.backends.couchbase.utils import DocID
+
+from .models import Entry
+
+
+def new_field(cls, name, **kwargs):
+    field = cls(**kwargs)
+    field.set_attributes_from_name(name)
+    return field
+
+
+class BackfillTests(TestCase):
+    def setUp(self):
+        self.bucket = connection.get_bucket(connection.get_bucket_name_for(Entry))
+        self.keys = [DocID.encode(connection.table_name(Entry),
+                                  Entry.objects.create(title=u'e{0}'.format(ix)).pk)
+                     for ix in range(3)]
+
+    def docs(self):
+        return [self.bucket.get(key).value for key in sorted(self.keys)]
+
+    def test_add_field(self):
+        doc = self.bucket.get(self.keys[0]).value
+        doc['stars'] = 1
+        self.bucket.replace(self.keys[0], doc)
+
+        with connection.schema_editor() as editor:
+            editor.add_field(Entry, new_field(models.IntegerField, 'stars', default=5))
+        self.assertEqual(sorted(x['stars'] for x in self.docs()), [1, 5, 5])
+
+    def test_add_field_without_default(self):
+        with connection.schema_editor() as editor:
+            editor.add_field(Entry, new_field(models.IntegerField, 'stars', null=True))
+        self.assertTrue(all('stars' not in x for x in self.docs()))
+
+    def test_native_default(self):
+        codec, connection.json_codec = connection.json_codec, JSONCodec('json')
+        try:
+            with connection.schema_editor() as editor:
+                editor.add_field(Entry, new_field(models.DateField, 'seen', default=date(2016, 1, 2)))
+        finally:
+            connection.json_codec = codec
+        self.assertEqual(set(x['seen'] for x in self.docs()), {u'2016-01-02'})
+
+    def test_rename_and_remove_field(self):
+        old = new_field(models.IntegerField, 'rating', default=0)
+        new = new_field(models.IntegerField, 'score', default=0)
+        with connection.schema_editor() as editor:
+            editor.alter_field(Entry, old, new)
+        self.assertTrue(all('score' in x and 'rating' not in x for x in self.docs()))
+
+        with connection.schema_editor() as editor:
+            editor.remove_field(Entry, new)
+        self.assertTrue(all('score' not in x for x in self.docs()))
+
+    def test_fill_nulls(self):
+        Entry.objects.update(views=None)
+        old = new_field(models.IntegerField, 'views', null=True)
+        new = new_field(models.IntegerField, 'views', default=3)
+        with connection.schema_editor() as editor:
+            editor.alter_field(Entry, old, new)
+        self.assertEqual([x['views'] for x in self.docs()], [3, 3, 3])
+
+    def test_resume_from_checkpoint(self):
+        table = connection.table_name(Entry)
+        first = sorted(self.keys)[0]
+        # A run interrupted after the first document
+        self.bucket.upsert(checkpoint_key(table, 'set:stars'), {
+            'last_key': first, 'processed': 1, 'complete': False, 'started': ''})
+
+        backfill = Backfill(connection, Entry, batch_size=1)
+        self.assertEqual(backfill.set_default('stars', 5), 3)
+        docs = self.docs()
+        self.assertNotIn('stars', docs[0])
+        self.assertEqual([x['stars'] for x in docs[1:]], [5, 5])
+
+        checkpoint = self.bucket.get(checkpoint_key(table, 'set:stars')).value
+        self.assertTrue(checkpoint['complete'])
+        # The next run starts over
+        self.assertEqual(backfill.set_default('stars', 5), 1)
@@ -0,0 +1,72 @@
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from cbdjango.db.backends.couchbase.backfill import Backfill
+from cbdjango.db.backends.couchbase.cache import DocumentCache
+from cbdjango.db.backends.couchbase.utils import DocID
+
+from .models import Entry
+
+
+def docid(pk):
+    return DocID.encode(connection.table_name(Entry), pk)
+
+
+class DocumentCacheTests(SimpleTestCase):
+    def test_lru_eviction(self):
+        cache = DocumentCache(max_bytes=30)
+        cache.put('a', {'v': 'a' * 10}, 1)
+        cache.put('b', {'v': 'b' * 10}, 2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), ({'v': 'b' * 10}, 2))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expiry(self):
+        cache = DocumentCache(ttl=-1)
+        cache.put('a', {}, 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+
+class CachedLookupTests(TestCase):
+    def setUp(self):
+        self.doc_cache, connection.doc_cache = connection.doc_cache, DocumentCache()
+        Entry.objects.create(id=1, title=u'a')
+        self.bucket = connection.get_bucket(connection.get_bucket_name_for(Entry))
+
+    def tearDown(self):
+        connection.doc_cache = self.doc_cache
+
+    def bypass_cache(self, **values):
+        # Change the document without updating the cache
+        doc = self.bucket.get(docid(1)).value
+        doc.update(values)
+        self.bucket.replace(docid(1), doc)
+
+    def test_lookups_are_cached(self):
+        self.assertEqual(Entry.objects.get(pk=1).title, u'a')
+        self.bypass_cache(title=u'b')
+        self.assertEqual(Entry.objects.get(pk=1).title, u'a')
+
+    def test_update_writes_through(self):
+        Entry.objects.get(pk=1)
+        Entry.objects.filter(pk=1).update(title=u'b')
+        self.assertEqual(Entry.objects.get(pk=1).title, u'b')
+
+        entry = Entry.objects.get(pk=1)
+        entry.title = u'c'
+        entry.save()
+        self.assertEqual(Entry.objects.get(pk=1).title, u'c')
+
+    def test_delete_invalidates(self):
+        Entry.objects.get(pk=1)
+        Entry.objects.filter(pk=1).delete()
+        with self.assertRaises(Entry.DoesNotExist):
+            Entry.objects.get(pk=1)
+
+    def test_backfill_invalidates(self):
+        Entry.objects.get(pk=1)
+        self.bypass_cache(views=None)
+        Backfill(connection, Entry).fill_nulls('views', 3)
+        self.assertIsNone(connection.doc_cache.get(docid(1)))
+        self.assertEqual(Entry.objects.get(pk=1).views, 3)
@@ -0,0 +1,68 @@
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from cbdjango.db.backends.couchbase import catalog
+from cbdjango.db.backends.couchbase.memory import MemoryBucket, reset
+
+from .models import Author, Entry
+
+
+class CatalogTests(SimpleTestCase):
+    def setUp(self):
+        self.bucket = MemoryBucket('catalog_tests')
+        self.scans = 0
+
+    def tearDown(self):
+        reset('catalog_tests')
+        catalog.unregister_namespace(self.bucket, '')
+
+    def scan(self):
+        self.scans += 1
+        return ['a', 'b']
+
+    def types(self):
+        return self.bucket.get(catalog.CATALOG_KEY).value['types']
+
+    def test_created_from_scan(self):
+        self.assertEqual(sorted(catalog.get_types(self.bucket, self.scan)), ['a', 'b'])
+        self.assertEqual(sorted(catalog.get_types(self.bucket, self.scan)), ['a', 'b'])
+        self.assertEqual(self.scans, 1)
+        self.assertEqual(sorted(self.types()), ['a', 'b'])
+
+    def test_inserts_do_not_create_catalog(self):
+        catalog.ensure_type(self.bucket, Entry, 'c')
+        self.assertFalse(self.bucket.get(catalog.CATALOG_KEY, quiet=True).success)
+        # A catalog listing only 'c' would miss the scanned types
+        self.assertEqual(sorted(catalog.get_types(self.bucket, self.scan)), ['a', 'b'])
+
+    def test_register_and_update(self):
+        catalog.register_type(self.bucket, Author, 'c', {'ix': 'CREATE INDEX ...'}, self.scan)
+        self.assertEqual(self.types()['c'], {'fields': ['name'], 'indexes': {'ix': 'CREATE INDEX ...'}})
+        self.assertEqual(sorted(self.types()), ['a', 'b', 'c'])
+
+        catalog.update_fields(self.bucket, 'c', added=['email'], removed=['name'])
+        self.assertEqual(self.types()['c']['fields'], ['email'])
+
+        catalog.ensure_type(self.bucket, Entry, 'd')
+        self.assertIn('title', self.types()['d']['fields'])
+
+        catalog.unregister_type(self.bucket, 'c')
+        self.assertEqual(sorted(self.types()), ['a', 'b', 'd'])
+
+
+class IntrospectionTests(TestCase):
+    def test_table_list_from_scan(self):
+        Entry.objects.create(title=u'a')
+        bucket = connection.get_bucket(connection.get_bucket_name_for(Entry))
+        saved = bucket.get(catalog.CATALOG_KEY, quiet=True)
+        bucket.remove(catalog.CATALOG_KEY, quiet=True)
+        try:
+            tables = [x.name for x in connection.introspection.get_table_list(None)]
+            self.assertIn(Entry._meta.db_table, tables)
+            types = bucket.get(catalog.CATALOG_KEY).value['types']
+            self.assertIn(connection.table_name(Entry), types)
+        finally:
+            if saved.success:
+                bucket.upsert(catalog.CATALOG_KEY, saved.value)
+            else:
+                bucket.remove(catalog.CATALOG_KEY, quiet=True)
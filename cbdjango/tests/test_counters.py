@@ -0,0 +1,60 @@
+from django.db import connection, IntegrityError
+from django.test import TestCase
+
+from cbdjango.db.backends.couchbase.counters import counter_key
+
+from .models import Entry
+
+
+class CounterTests(TestCase):
+    def setUp(self):
+        self.bucket = connection.get_bucket(connection.get_bucket_name_for(Entry))
+        self.key = counter_key(connection.table_name(Entry))
+        Entry.objects.create(id=1, title=u'a')
+        Entry.objects.create(id=2, title=u'b')
+        # Seeds the counter
+        self.assertEqual(Entry.objects.count(), 2)
+
+    def counter(self):
+        res = self.bucket.get(self.key, quiet=True)
+        return res.value if res.success else None
+
+    def assertCounted(self):
+        # Filtered counts are always queried
+        self.assertEqual(self.counter(), Entry.objects.filter(rating=0).count())
+
+    def test_count_reads_counter(self):
+        self.bucket.upsert(self.key, 5)
+        self.assertEqual(Entry.objects.count(), 5)
+        self.assertEqual(Entry.objects.filter(rating=0).count(), 2)
+
+    def test_inserts_and_deletes(self):
+        Entry.objects.create(id=3, title=u'c')
+        self.assertEqual(self.counter(), 3)
+        Entry.objects.bulk_create([Entry(id=4, title=u'd'), Entry(id=5, title=u'e')])
+        self.assertEqual(self.counter(), 5)
+        with self.assertRaises(IntegrityError):
+            Entry.objects.create(id=1, title=u'f')
+        self.assertCounted()
+
+        Entry.objects.get(pk=1).delete()
+        self.assertEqual(self.counter(), 4)
+        Entry.objects.filter(pk__in=[2, 3, 42]).delete()
+        self.assertEqual(self.counter(), 2)
+        Entry.objects.filter(title=u'd').delete()
+        self.assertEqual(self.counter(), 1)
+        self.assertCounted()
+
+    def test_bulk_upsert_resets(self):
+        Entry.objects.bulk_upsert([Entry(id=2, title=u'c'), Entry(id=3, title=u'd')])
+        self.assertIsNone(self.counter())
+        self.assertEqual(Entry.objects.count(), 3)
+        self.assertEqual(self.counter(), 3)
+
+    def test_exists(self):
+        self.assertTrue(Entry.objects.exists())
+        self.assertTrue(Entry.objects.filter(pk=1).exists())
+        self.assertFalse(Entry.objects.filter(pk=3).exists())
+        Entry.objects.all().delete()
+        self.assertFalse(Entry.objects.exists())
+        self.assertEqual(self.counter(), 0)
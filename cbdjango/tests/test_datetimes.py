@@ -0,0 +1,61 @@
+from datetime import datetime
+
+from django.db import connection
+from django.test import TestCase
+
+from cbdjango.db.backends.couchbase import datetimes
+from cbdjango.db.backends.couchbase.utils import DocID
+
+from .models import Entry
+
+VALUES = [
+    datetime(2016, 1, 2, 3, 4, 5),
+    datetime(2016, 1, 2, 3, 4, 5, 250000),
+    datetime(2015, 12, 31, 23, 59, 59, 999000),
+    datetime(2016, 10, 1),
+]
+
+
+class DatetimeStorageTests(TestCase):
+    def setUp(self):
+        self.mode = connection.datetime_storage
+
+    def tearDown(self):
+        connection.datetime_storage = self.mode
+
+    def stored(self, pk):
+        bucket = connection.get_bucket(connection.get_bucket_name_for(Entry))
+        return bucket.get(DocID.encode(connection.table_name(Entry), pk)).value['created']
+
+    def check_mode(self, mode):
+        connection.datetime_storage = mode
+        for ix, value in enumerate(VALUES):
+            Entry.objects.create(id=ix + 1, title=unicode(ix), created=value)
+
+        self.assertEqual(self.stored(2), datetimes.to_storage(VALUES[1], mode))
+        self.assertEqual(Entry.objects.get(pk=2).created, VALUES[1])
+        self.assertEqual([x.created for x in Entry.objects.order_by('created')], sorted(VALUES))
+        self.assertEqual(
+            sorted(x.created for x in Entry.objects.filter(created__gt=VALUES[0])),
+            [VALUES[1], VALUES[3]])
+
+    def test_string(self):
+        self.check_mode(datetimes.STRING)
+
+    def test_sortable(self):
+        self.check_mode(datetimes.SORTABLE)
+        self.assertEqual(self.stored(1), u'2016-01-02T03:04:05.000000Z')
+
+    def test_millis(self):
+        self.check_mode(datetimes.MILLIS)
+        self.assertEqual(self.stored(1), 1451703845000)
+
+    def test_migrate(self):
+        connection.datetime_storage = datetimes.STRING
+        for ix, value in enumerate(VALUES):
+            Entry.objects.create(id=ix + 1, title=unicode(ix), created=value)
+
+        connection.datetime_storage = datetimes.MILLIS
+        self.assertEqual(datetimes.migrate_datetime_storage(Entry), len(VALUES))
+        self.assertEqual(self.stored(1), 1451703845000)
+        self.assertEqual([x.created for x in Entry.objects.order_by('created')], sorted(VALUES))
@@ -0,0 +1,66 @@
+from django.db import connection
+from django.db.models import signals
+from django.db.models.deletion import ProtectedError
+from django.test import TestCase
+
+from cbdjango.db.backends.couchbase.utils import DocID
+
+from .models import Author, Entry, Comment, Highlight
+
+LONG = u'x' * 100
+
+
+class CascadeDeleteTests(TestCase):
+    def setUp(self):
+        self.ann = Author.objects.create(name=u'Ann')
+        self.bob = Author.objects.create(name=u'Bob')
+        self.e1 = Entry.objects.create(title=u'e1', body=LONG, author=self.ann)
+        self.e2 = Entry.objects.create(title=u'e2', author=self.ann)
+        self.e3 = Entry.objects.create(title=u'e3', author=self.bob)
+        self.c1 = Comment.objects.create(entry=self.e1, text=u'c1')
+        self.c2 = Comment.objects.create(entry=self.e1, text=u'c2', reply_to=self.c1)
+        self.c3 = Comment.objects.create(entry=self.e3, text=u'c3', reply_to=self.c1)
+
+    def test_cascade(self):
+        total, counts = Author.objects.filter(name=u'Ann').delete()
+        self.assertEqual(counts, {'tests.Author': 1, 'tests.Entry': 2, 'tests.Comment': 2})
+        self.assertEqual(total, 5)
+
+        self.assertEqual([a.name for a in Author.objects.all()], [u'Bob'])
+        self.assertEqual([e.title for e in Entry.objects.all()], [u'e3'])
+        self.assertEqual([c.text for c in Comment.objects.all()], [u'c3'])
+
+    def test_side_documents_are_removed(self):
+        key = DocID.encode(connection.table_name(Entry), self.e1.pk)
+        side_key, = connection.offload.side_keys(Entry, [key])
+        Author.objects.filter(pk=self.ann.pk).delete()
+        bucket = connection.get_bucket(connection.get_bucket_name_for(Entry))
+        self.assertFalse(bucket.get(side_key, quiet=True).success)
+
+    def test_set_null(self):
+        Comment.objects.filter(pk=self.c1.pk).delete()
+        self.assertIsNone(Comment.objects.get(pk=self.c2.pk).reply_to_id)
+        self.assertIsNone(Comment.objects.get(pk=self.c3.pk).reply_to_id)
+
+    def test_protect(self):
+        Highlight.objects.create(entry=self.e2)
+        with self.assertRaises(ProtectedError):
+            Author.objects.filter(pk=self.ann.pk).delete()
+        # Nothing was modified
+        self.assertEqual(Entry.objects.count(), 3)
+        self.assertEqual(Comment.objects.filter(reply_to=self.c1).count(), 2)
+
+    def test_signals_use_the_collector(self):
+        deleted = []
+
+        def on_delete(instance, **kwargs):
+            deleted.append(instance.text)
+        signals.pre_delete.connect(on_delete, sender=Comment)
+        try:
+            Author.objects.filter(pk=self.ann.pk).delete()
+        finally:
+            signals.pre_delete.disconnect(on_delete, sender=Comment)
+
+        self.assertEqual(sorted(deleted), [u'c1', u'c2'])
+        self.assertEqual([e.title for e in Entry.objects.all()], [u'e3'])
+        self.assertIsNone(Comment.objects.get(pk=self.c3.pk).reply_to_id)
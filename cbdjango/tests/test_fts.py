@@ -0,0 +1,14 @@
+from django.db import connection
+from django.test import SimpleTestCase
+
+from cbdjango.db.backends.couchbase.fts import FullTextSearch
+
+from .models import Entry
+
+
+class IndexDefinitionTests(SimpleTestCase):
+    def test_maps_the_type_of_the_documents(self):
+        fts = FullTextSearch(connection, {'tests.entry': {'INDEX': 'entry_fts', 'FIELDS': ['title']}})
+        definition = fts.index_definition(Entry, 'tests')
+        self.assertEqual(list(definition['params']['mapping']['types']),
+                         [connection.table_name(Entry)])
@@ -0,0 +1,203 @@
+from datetime import date, datetime
+
+from django.db.models import Count
+from django.test import SimpleTestCase, TestCase
+
+from couchbase.exceptions import CouchbaseError, KeyExistsError, NotFoundError
+from couchbase.n1ql import N1QLQuery
+
+from cbdjango.db.backends.couchbase import memory
+from cbdjango.db.backends.couchbase.transcoder import JSONCodec
+from cbdjango.db.backends.couchbase.utils import cas_items
+
+from .models import Author, Entry, Comment
+
+BUCKET = 'memory_tests'
+
+
+class MemoryBucketTests(SimpleTestCase):
+    def setUp(self):
+        memory.reset(BUCKET)
+        self.bucket = memory.MemoryBucket(BUCKET)
+
+    def tearDown(self):
+        memory.reset(BUCKET)
+
+    def query(self, statement, *args):
+        return list(self.bucket.n1ql_query(N1QLQuery(statement, *args)))
+
+    def test_insert_existing(self):
+        self.bucket.insert('a', {'x': 1})
+        with self.assertRaises(KeyExistsError) as cm:
+            self.bucket.insert('a', {'x': 2})
+        self.assertEqual(cm.exception.rc, 0x0C)
+        self.assertEqual(self.bucket.get('a').value, {'x': 1})
+
+    def test_replace_missing(self):
+        with self.assertRaises(NotFoundError) as cm:
+            self.bucket.replace('a', {'x': 1})
+        self.assertEqual(cm.exception.rc, 0x0D)
+
+    def test_cas_mismatch(self):
+        cas = self.bucket.upsert('a', {'x': 1}).cas
+        self.bucket.upsert('a', {'x': 2})
+        with self.assertRaises(KeyExistsError):
+            self.bucket.replace('a', {'x': 3}, cas=cas)
+        with self.assertRaises(KeyExistsError):
+            self.bucket.remove('a', cas=cas)
+        self.assertEqual(self.bucket.get('a').value, {'x': 2})
+
+    def test_cas_of_missing_document(self):
+        with self.assertRaises(NotFoundError):
+            self.bucket.upsert('a', {'x': 1}, cas=1)
+
+    def test_multi_partial_failure(self):
+        self.bucket.insert('a', {'x': 1})
+        with self.assertRaises(KeyExistsError) as cm:
+            self.bucket.insert_multi({'a': {'x': 2}, 'b': {'x': 2}})
+        ok, failed = cm.exception.split_results()
+        self.assertEqual(set(ok), {'b'})
+        self.assertEqual(set(failed), {'a'})
+        self.assertIs(CouchbaseError.rc_to_exctype(failed['a'].rc), KeyExistsError)
+        self.assertEqual(self.bucket.get('b').value, {'x': 2})
+
+    def test_cas_items(self):
+        cas = self.bucket.upsert('a', {'x': 1}).cas
+        stale = self.bucket.upsert('b', {'x': 1}).cas
+        self.bucket.upsert('b', {'x': 2})
+        with self.assertRaises(KeyExistsError) as cm:
+            self.bucket.replace_multi(cas_items({'a': ({'x': 3}, cas), 'b': ({'x': 3}, stale)}))
+        ok, failed = cm.exception.split_results()
+        self.assertEqual((set(ok), set(failed)), ({'a'}, {'b'}))
+
+    def test_get_multi(self):
+        self.bucket.upsert('a', {'x': 1})
+        results = self.bucket.get_multi(['a', 'b'], quiet=True)
+        self.assertTrue(results['a'].success)
+        self.assertEqual(results['b'].rc, 0x0D)
+        with self.assertRaises(NotFoundError):
+            self.bucket.get_multi(['a', 'b'])
+
+    def test_remove_quiet(self):
+        results = self.bucket.remove_multi(['a'], quiet=True)
+        self.assertFalse(results['a'].success)
+        with self.assertRaises(NotFoundError):
+            self.bucket.remove('a')
+
+    def test_counter(self):
+        with self.assertRaises(NotFoundError):
+            self.bucket.counter('c')
+        self.assertEqual(self.bucket.counter('c', initial=5).value, 5)
+        self.assertEqual(self.bucket.counter('c', delta=-2).value, 3)
+
+    def test_values_are_copied(self):
+        doc = {'x': [1]}
+        self.bucket.upsert('a', doc)
+        doc['x'].append(2)
+        self.bucket.get('a').value['x'].append(3)
+        self.assertEqual(self.bucket.get('a').value, {'x': [1]})
+
+    def test_native_values_need_a_codec(self):
+        with self.assertRaises(CouchbaseError):
+            self.bucket.upsert('a', {'d': date(2016, 1, 2)})
+
+    def test_native_values_are_encoded_by_the_codec(self):
+        bucket = memory.MemoryBucket(BUCKET, JSONCodec('json'))
+        bucket.upsert('a', {'d': date(2016, 1, 2), 'dt': datetime(2016, 1, 2, 3, 4, 5)})
+        self.assertEqual(bucket.get('a').value, {'d': '2016-01-02', 'dt': '2016-01-02 03:04:05'})
+
+    def test_select(self):
+        self.bucket.upsert_multi({
+            't:1': {'__CBTP': 't', 'n': 2, 's': 'b'},
+            't:2': {'__CBTP': 't', 'n': 1, 's': 'a'},
+            't:3': {'__CBTP': 't', 's': 'c'},
+            'u:1': {'__CBTP': 'u', 'n': 3},
+        })
+        self.assertEqual(
+            self.query('SELECT RAW META(b).id FROM `memory_tests` b WHERE b.__CBTP = $1 '
+                       'ORDER BY b.n DESC', 't'),
+            ['t:1', 't:2', 't:3'])
+        self.assertEqual(
+            self.query('SELECT RAW [s, n] FROM `memory_tests` WHERE __CBTP == "t" '
+                       'AND n IS VALUED ORDER BY s LIMIT 1 OFFSET 1'),
+            [['b', 2]])
+        self.assertEqual(
+            self.query('SELECT COUNT(*) AS c, MAX(n) AS m FROM `memory_tests` '
+                       'WHERE __CBTP = "t"'),
+            [{'c': 3, 'm': 2}])
+
+    def test_update_and_delete(self):
+        self.bucket.upsert_multi({'t:1': {'n': 1}, 't:2': {'n': 2}})
+        self.assertEqual(
+            self.query('UPDATE `memory_tests` USE KEYS $1 SET n = n + 10 '
+                       'RETURNING RAW META(`memory_tests`).id', ['t:1', 't:9']),
+            ['t:1'])
+        self.assertEqual(self.bucket.get('t:1').value, {'n': 11})
+        self.query('DELETE FROM `memory_tests` WHERE META().id >= $1 AND META().id < $2',
+                   't:2', 't:3')
+        self.assertFalse(self.bucket.get('t:2', quiet=True).success)
+
+    def test_unsupported_statement(self):
+        with self.assertRaises(memory.N1QLSyntaxError):
+            self.query('SELECT * FROM `memory_tests` NEST x ON KEYS y')
+
+
+class QueryShapeTests(TestCase):
+    """
+    The statements compiled for QuerySets, evaluated by the in-memory bucket
+    """
+    def setUp(self):
+        self.a1 = Author.objects.create(name=u'Ann')
+        self.a2 = Author.objects.create(name=u'Bob')
+        self.entries = [
+            Entry.objects.create(title=u'e{0}'.format(ix), rating=ix, author=author,
+                                 created=datetime(2016, ix, 10, 12))
+            for ix, author in ((1, self.a1), (2, self.a1), (3, self.a2))]
+
+    def titles(self, qs):
+        return sorted(e.title for e in qs)
+
+    def test_filters(self):
+        self.assertEqual(self.titles(Entry.objects.filter(rating__gte=2)), [u'e2', u'e3'])
+        self.assertEqual(self.titles(Entry.objects.exclude(title__startswith=u'e1')),
+                         [u'e2', u'e3'])
+        self.assertEqual(self.titles(Entry.objects.filter(title__iexact=u'E2')), [u'e2'])
+        self.assertEqual(self.titles(Entry.objects.filter(created__year=2016, rating__in=[1, 3])),
+                         [u'e1', u'e3'])
+
+    def test_pk_lookups(self):
+        e1, e2, _ = self.entries
+        self.assertEqual(Entry.objects.get(pk=e1.pk).title, u'e1')
+        self.assertEqual(self.titles(Entry.objects.filter(pk__in=[e1.pk, e2.pk])), [u'e1', u'e2'])
+
+    def test_ordering_and_slicing(self):
+        qs = Entry.objects.order_by('-rating')
+        self.assertEqual([e.title for e in qs[1:3]], [u'e2', u'e1'])
+
+    def test_values_list(self):
+        self.assertEqual(sorted(Entry.objects.values_list('rating', flat=True)), [1, 2, 3])
+
+    def test_foreign_key_and_subquery(self):
+        self.assertEqual(self.titles(Entry.objects.filter(author=self.a1)), [u'e1', u'e2'])
+        self.assertEqual(
+            self.titles(Entry.objects.filter(author__in=Author.objects.filter(name=u'Bob'))),
+            [u'e3'])
+
+    def test_aggregates(self):
+        self.assertEqual(Entry.objects.count(), 3)
+        self.assertEqual(Entry.objects.filter(rating__lt=3).count(), 2)
+        self.assertEqual(Entry.objects.aggregate(c=Count('*')), {'c': 3})
+
+    def test_dates(self):
+        self.assertEqual(list(Entry.objects.dates('created', 'year')), [date(2016, 1, 1)])
+        self.assertEqual(len(Entry.objects.datetimes('created', 'month')), 3)
+
+    def test_update(self):
+        self.assertEqual(Entry.objects.filter(author=self.a1).update(rating=0), 2)
+        self.assertEqual(self.titles(Entry.objects.filter(rating=0)), [u'e1', u'e2'])
+
+    def test_delete(self):
+        Comment.objects.create(entry=self.entries[0], text=u'c')
+        Entry.objects.filter(rating=1).delete()
+        self.assertEqual(self.titles(Entry.objects.all()), [u'e2', u'e3'])
+        self.assertEqual(Comment.objects.count(), 0)
@@ -0,0 +1,43 @@
+from django.db import connection, IntegrityError
+from django.test import TestCase
+
+from cbdjango.db.backends.couchbase.utils import DocID
+
+from .models import Entry
+
+LONG = u'x' * 100
+OTHER = u'y' * 100
+
+
+def side_key(entry):
+    docid = DocID.encode(connection.table_name(Entry), entry.pk)
+    key, = connection.offload.side_keys(Entry, [docid])
+    return key
+
+
+def bucket():
+    return connection.get_bucket(connection.get_bucket_name_for(Entry))
+
+
+class InsertRollbackTests(TestCase):
+    def test_offloaded_value(self):
+        entry = Entry.objects.create(title=u'a', body=LONG)
+        self.assertTrue(bucket().get(side_key(entry), quiet=True).success)
+        self.assertEqual(Entry.objects.get(pk=entry.pk).body, LONG)
+
+    def test_conflict_keeps_side_documents_of_inserted_documents(self):
+        existing = Entry.objects.create(id=1, title=u'a', body=u'short')
+        new = Entry(id=2, title=u'b', body=LONG)
+        with self.assertRaises(IntegrityError):
+            Entry.objects.bulk_create([new, Entry(id=1, title=u'c', body=OTHER)])
+
+        self.assertEqual(Entry.objects.get(pk=new.pk).body, LONG)
+        self.assertEqual(Entry.objects.get(pk=existing.pk).body, u'short')
+        self.assertFalse(bucket().get(side_key(existing), quiet=True).success)
+
+    def test_conflict_keeps_side_documents_of_existing_documents(self):
+        existing = Entry.objects.create(id=1, title=u'a', body=LONG)
+        with self.assertRaises(IntegrityError):
+            Entry.objects.create(id=1, title=u'b', body=OTHER)
+
+        self.assertEqual(Entry.objects.get(pk=existing.pk).body, LONG)
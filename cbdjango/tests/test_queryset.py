@@ -0,0 +1,144 @@
+from django.db import connection
+from django.db.models import signals
+from django.test import TestCase
+
+from cbdjango.db.backends.couchbase.unitofwork import BatchWriteError
+from cbdjango.db.backends.couchbase.utils import DocID
+
+from .models import Entry
+
+LONG = u'x' * 100
+OTHER = u'y' * 100
+
+
+def docid(pk):
+    return DocID.encode(connection.table_name(Entry), pk)
+
+
+def bucket():
+    return connection.get_bucket(connection.get_bucket_name_for(Entry))
+
+
+class UpdateOrCreateTests(TestCase):
+    def setUp(self):
+        self.saves = []
+        signals.pre_save.connect(self.on_pre_save, sender=Entry)
+
+    def tearDown(self):
+        signals.pre_save.disconnect(self.on_pre_save, sender=Entry)
+
+    def on_pre_save(self, instance, **kwargs):
+        self.saves.append(instance.pk)
+
+    def test_create(self):
+        obj, created = Entry.objects.update_or_create(pk=1, defaults={'title': u'a'})
+        self.assertTrue(created)
+        self.assertEqual(Entry.objects.get(pk=1).title, u'a')
+
+    def test_update(self):
+        Entry.objects.create(id=1, title=u'a', rating=3)
+        del self.saves[:]
+
+        obj, created = Entry.objects.update_or_create(pk=1, defaults={'title': u'b'})
+        self.assertFalse(created)
+        self.assertEqual(self.saves, [1])
+        entry = Entry.objects.get(pk=1)
+        self.assertEqual((entry.title, entry.rating), (u'b', 3))
+
+    def test_concurrent_update_is_merged(self):
+        Entry.objects.create(id=1, title=u'a', rating=3)
+        del self.saves[:]
+
+        def modify(instance, **kwargs):
+            # Another writer, between the read and the replace
+            signals.pre_save.disconnect(modify, sender=Entry)
+            Entry.objects.filter(pk=1).update(rating=5)
+        signals.pre_save.connect(modify, sender=Entry)
+        try:
+            Entry.objects.update_or_create(pk=1, defaults={'title': u'b'})
+        finally:
+            signals.pre_save.disconnect(modify, sender=Entry)
+
+        # Saved once, despite the retry
+        self.assertEqual(self.saves, [1])
+        entry = Entry.objects.get(pk=1)
+        self.assertEqual((entry.title, entry.rating), (u'b', 5))
+
+    def test_offloaded_values(self):
+        Entry.objects.create(id=1, title=u'a')
+        side_key, = connection.offload.side_keys(Entry, [docid(1)])
+
+        Entry.objects.update_or_create(pk=1, defaults={'body': LONG})
+        self.assertEqual(Entry.objects.get(pk=1).body, LONG)
+        self.assertTrue(bucket().get(side_key, quiet=True).success)
+
+        Entry.objects.update_or_create(pk=1, defaults={'body': u'short'})
+        self.assertEqual(Entry.objects.get(pk=1).body, u'short')
+        self.assertFalse(bucket().get(side_key, quiet=True).success)
+
+
+class BulkUpdateTests(TestCase):
+    def setUp(self):
+        self.entries = [Entry.objects.create(id=ix, title=u'e{0}'.format(ix), rating=ix, views=ix)
+                        for ix in (1, 2)]
+
+    def test_update(self):
+        for entry in self.entries:
+            entry.title += u'!'
+            entry.rating = 0
+        self.assertEqual(Entry.objects.bulk_update(self.entries, ['title']), 2)
+
+        for entry in Entry.objects.all():
+            # Only the given fields are written
+            self.assertEqual(entry.title, u'e{0}!'.format(entry.pk))
+            self.assertEqual(entry.rating, entry.pk)
+
+    def test_none_is_not_replaced_by_the_default(self):
+        self.entries[0].views = None
+        Entry.objects.bulk_update(self.entries[:1], ['views'])
+        self.assertIsNone(Entry.objects.get(pk=1).views)
+
+    def test_missing_documents(self):
+        objs = [Entry(id=1, title=u'a', body=LONG), Entry(id=3, title=u'b', body=LONG)]
+        with self.assertRaises(BatchWriteError) as cm:
+            Entry.objects.bulk_update(objs, ['title', 'body'])
+        self.assertEqual(set(cm.exception.failures), {docid(3)})
+
+        self.assertEqual(Entry.objects.get(pk=1).body, LONG)
+        # No side document is left without its owner
+        side_key, = connection.offload.side_keys(Entry, [docid(3)])
+        self.assertFalse(bucket().get(side_key, quiet=True).success)
+
+    def test_offloaded_values(self):
+        side_key, = connection.offload.side_keys(Entry, [docid(1)])
+        entry = self.entries[0]
+        entry.body = LONG
+        Entry.objects.bulk_update([entry], ['body'])
+        self.assertEqual(Entry.objects.get(pk=1).body, LONG)
+
+        entry.body = u'short'
+        Entry.objects.bulk_update([entry], ['body'])
+        self.assertEqual(Entry.objects.get(pk=1).body, u'short')
+        self.assertFalse(bucket().get(side_key, quiet=True).success)
+
+    def test_offloaded_values_of_conflicting_documents(self):
+        entry = self.entries[0]
+        entry.body = LONG
+        Entry.objects.bulk_update([entry], ['body'])
+
+        b = bucket()
+        replace_multi = b.replace_multi
+
+        def conflicting(kvs, **kwargs):
+            # Another writer modifies the document before every attempt
+            b.upsert(docid(1), b.get(docid(1)).value)
+            return replace_multi(kvs, **kwargs)
+        b.replace_multi = conflicting
+        try:
+            entry.body = OTHER
+            with self.assertRaises(BatchWriteError):
+                Entry.objects.bulk_update([entry], ['body'])
+        finally:
+            del b.replace_multi
+
+        self.assertEqual(Entry.objects.get(pk=1).body, LONG)
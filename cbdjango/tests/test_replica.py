@@ -0,0 +1,60 @@
+from django.db import connection
+from django.test import TestCase
+
+from cbdjango.db.backends.couchbase import replica
+from cbdjango.db.backends.couchbase.memory import Result, _error
+from cbdjango.db.backends.couchbase.utils import DocID
+
+from .models import Entry
+
+# LCB_ETMPFAIL
+TMPFAIL = 0x0B
+
+
+def docid(pk):
+    return DocID.encode(connection.table_name(Entry), pk)
+
+
+def bucket():
+    return connection.get_bucket(connection.get_bucket_name_for(Entry))
+
+
+class ReplicaReadTests(TestCase):
+    def setUp(self):
+        Entry.objects.create(id=1, title=u'a')
+        Entry.objects.create(id=2, title=u'b')
+        self.policy = connection.replica_reads.policy
+
+    def tearDown(self):
+        connection.replica_reads.policy = self.policy
+
+    def test_instances_read_from_replicas_may_be_stale(self):
+        connection.replica_reads.policy = replica.ALWAYS
+        self.assertTrue(Entry.objects.get(pk=1)._state.may_be_stale)
+        entries = Entry.objects.filter(pk__in=[1, 2])
+        self.assertEqual([x._state.may_be_stale for x in entries], [True, True])
+
+    def test_instances_read_from_active_copies(self):
+        self.assertFalse(Entry.objects.get(pk=1)._state.may_be_stale)
+        # Queries other than key lookups only read active copies
+        connection.replica_reads.policy = replica.ALWAYS
+        self.assertFalse(Entry.objects.get(title=u'a')._state.may_be_stale)
+
+    def test_on_error_reads_replicas_of_failed_keys(self):
+        connection.replica_reads.policy = replica.ON_ERROR
+        b = bucket()
+        get_multi = b.get_multi
+
+        def failing(keys, quiet=False, replica=False, **kwargs):
+            results = get_multi(keys, quiet=True, replica=replica)
+            if not replica and docid(1) in results:
+                results[docid(1)] = Result(docid(1), rc=TMPFAIL)
+                raise _error(results, docid(1))
+            return results
+        b.get_multi = failing
+        try:
+            entries = Entry.objects.filter(pk__in=[1, 2, 3]).order_by('pk')
+            self.assertEqual([(x.title, x._state.may_be_stale) for x in entries],
+                             [(u'a', True), (u'b', False)])
+        finally:
+            del b.get_multi
@@ -0,0 +1,50 @@
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from cbdjango.db.backends.couchbase.scan import parallel_scans, split_keyspace, merge_ranges
+
+from .models import Entry
+
+
+class KeyRangeTests(SimpleTestCase):
+    def test_split_keyspace(self):
+        ranges = split_keyspace('t', 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertIsNone(ranges[0][0])
+        self.assertIsNone(ranges[-1][1])
+        # Contiguous
+        for (_, high), (low, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(high, low)
+
+    def test_merge_ranges(self):
+        ranges = split_keyspace('t', 8)
+        merged = merge_ranges(ranges, 3)
+        self.assertEqual(len(merged), 3)
+        self.assertEqual(merged[0][0], None)
+        self.assertEqual(merged[-1][1], None)
+        bounds = [high for _, high in ranges]
+        for (_, high), (low, _) in zip(merged, merged[1:]):
+            self.assertIn(high, bounds)
+            self.assertEqual(high, low)
+
+    def test_merge_fewer_ranges(self):
+        ranges = split_keyspace('t', 2)
+        self.assertEqual(merge_ranges(ranges, 4), ranges)
+
+
+class ParallelScanTests(TestCase):
+    def setUp(self):
+        # Generated keys spread across the ranges
+        for ix in range(40):
+            Entry.objects.create(title=u'e{0:02d}'.format(ix), rating=(ix * 7) % 40)
+
+    def test_unordered(self):
+        with parallel_scans(8):
+            titles = [x.title for x in Entry.objects.iterator()]
+        self.assertEqual(sorted(titles), [u'e{0:02d}'.format(ix) for ix in range(40)])
+
+    def test_ordered(self):
+        # More ranges than workers: adjacent ranges are merged
+        with parallel_scans(8, workers=3):
+            ratings = [x.rating for x in Entry.objects.order_by('-rating')]
+        self.assertEqual(ratings, list(reversed(range(40))))
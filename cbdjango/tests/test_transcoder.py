@@ -0,0 +1,70 @@
+from datetime import date, datetime, time
+from decimal import Decimal
+from uuid import UUID
+
+from django.db import connection
+from django.test import SimpleTestCase
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from couchbase import FMT_JSON
+
+from cbdjango.db.backends.couchbase.memory import MemoryBucket, reset
+from cbdjango.db.backends.couchbase.transcoder import JSONCodec, CodecTranscoder
+
+VALUE = datetime(2016, 1, 2, 3, 4, 5, 6)
+
+
+class JSONCodecTests(SimpleTestCase):
+    def setUp(self):
+        self.codec = JSONCodec('json')
+
+    def round_trip(self, value):
+        return self.codec.loads(self.codec.dumps([value]))[0]
+
+    def test_datetime(self):
+        self.assertEqual(self.round_trip(VALUE), u'2016-01-02 03:04:05.000006')
+        self.assertEqual(parse_datetime(self.round_trip(VALUE)), VALUE)
+        # Stored in UTC, as by the database operations
+        aware = timezone.make_aware(VALUE, timezone.get_fixed_timezone(60))
+        self.assertEqual(self.round_trip(aware), u'2016-01-02 02:04:05.000006')
+
+    def test_native_types(self):
+        self.assertEqual(self.round_trip(date(2016, 1, 2)), u'2016-01-02')
+        self.assertEqual(self.round_trip(time(3, 4, 5)), u'03:04:05')
+        self.assertEqual(self.round_trip(UUID(int=1)), UUID(int=1).hex)
+
+    def test_decimal(self):
+        self.assertEqual(self.round_trip(Decimal('1.50')), u'1.50')
+        # Fields format decimals before they reach the codec
+        self.assertEqual(connection.ops.value_to_db_decimal(Decimal('1.5'), 5, 2), u'1.50')
+
+    def test_without_default_hook(self):
+        # Codecs which cannot encode other types convert values up front
+        self.codec._kwargs = None
+        self.assertEqual(self.round_trip({'a': [VALUE, Decimal('1.50')]}),
+                         {'a': [u'2016-01-02 03:04:05.000006', u'1.50']})
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            self.codec.dumps(object())
+
+
+class CodecTranscoderTests(SimpleTestCase):
+    def test_decode(self):
+        transcoder = CodecTranscoder(JSONCodec('json'))
+        self.assertEqual(transcoder.decode_value(b'{"a":1}', FMT_JSON), {u'a': 1})
+
+    def test_encode(self):
+        transcoder = CodecTranscoder(JSONCodec('json'))
+        self.assertEqual(transcoder.encode_value({'d': VALUE}, FMT_JSON),
+                         (b'{"d":"2016-01-02 03:04:05.000006"}', FMT_JSON))
+
+    def test_bucket_stores_values_as_encoded(self):
+        bucket = MemoryBucket('codec_tests', JSONCodec('json'))
+        try:
+            bucket.upsert('a', {'d': VALUE, 'n': Decimal('1.50')})
+            self.assertEqual(bucket.get('a').value,
+                             {u'd': u'2016-01-02 03:04:05.000006', u'n': u'1.50'})
+        finally:
+            reset('codec_tests')
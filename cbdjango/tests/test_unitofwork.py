@@ -0,0 +1,108 @@
+from django.db import connection
+from django.test import TestCase
+
+from couchbase.exceptions import KeyExistsError, NotFoundError
+
+from cbdjango.db.backends.couchbase.counters import counter_key
+from cbdjango.db.backends.couchbase.unitofwork import write_behind, BatchWriteError, \
+    INSERT, REPLACE
+from cbdjango.db.backends.couchbase.utils import DocID
+
+from .models import Entry
+
+LONG = u'x' * 100
+OTHER = u'y' * 100
+
+
+def docid(pk):
+    return DocID.encode(connection.table_name(Entry), pk)
+
+
+class WriteBehindTests(TestCase):
+    def test_writes_are_buffered(self):
+        with write_behind() as uow:
+            Entry.objects.create(id=1, title=u'a')
+            Entry.objects.create(id=2, title=u'b', body=LONG)
+            self.assertEqual(len(uow), 2)
+            self.assertFalse(connection.get_bucket('tests').get(docid(1), quiet=True).success)
+
+        self.assertEqual(Entry.objects.get(pk=2).body, LONG)
+        self.assertEqual(Entry.objects.count(), 2)
+
+    def test_queries_flush_pending_writes(self):
+        with write_behind() as uow:
+            Entry.objects.create(id=1, title=u'a')
+            self.assertEqual(Entry.objects.filter(title=u'a').count(), 1)
+            self.assertEqual(len(uow), 0)
+
+    def test_discarded_on_error(self):
+        with self.assertRaises(ValueError):
+            with write_behind():
+                Entry.objects.create(id=1, title=u'a')
+                raise ValueError
+        self.assertEqual(Entry.objects.count(), 0)
+
+    def test_insert_conflicts(self):
+        Entry.objects.create(id=1, title=u'a', body=LONG)
+        Entry.objects.create(id=2, title=u'b', body=u'short')
+
+        with self.assertRaises(BatchWriteError) as cm:
+            with write_behind():
+                Entry.objects.create(id=1, title=u'c', body=OTHER)
+                Entry.objects.create(id=2, title=u'd', body=OTHER)
+                Entry.objects.create(id=3, title=u'e', body=LONG)
+
+        failures = cm.exception.failures
+        self.assertEqual(set(failures), {docid(1), docid(2)})
+        for kind, exc in failures.values():
+            self.assertEqual(kind, INSERT)
+            self.assertIsInstance(exc, KeyExistsError)
+
+        # Existing documents keep their values, including offloaded ones
+        self.assertEqual(Entry.objects.get(pk=1).body, LONG)
+        self.assertEqual(Entry.objects.get(pk=2).body, u'short')
+        side_key, = connection.offload.side_keys(Entry, [docid(2)])
+        self.assertFalse(connection.get_bucket('tests').get(side_key, quiet=True).success)
+        # Other documents of the batch are written
+        self.assertEqual(Entry.objects.get(pk=3).body, LONG)
+
+    def test_save_removes_side_documents_of_inlined_values(self):
+        Entry.objects.create(id=1, title=u'a', body=LONG)
+        entry = Entry.objects.get(pk=1)
+        with write_behind():
+            entry.body = u'short'
+            entry.save()
+
+        self.assertEqual(Entry.objects.get(pk=1).body, u'short')
+        side_key, = connection.offload.side_keys(Entry, [docid(1)])
+        self.assertFalse(connection.get_bucket('tests').get(side_key, quiet=True).success)
+
+    def test_save_of_loaded_instance_keeps_counter(self):
+        Entry.objects.create(id=1, title=u'a')
+        Entry.objects.create(id=2, title=u'b')
+        self.assertEqual(Entry.objects.count(), 2)
+
+        entry = Entry.objects.get(pk=1)
+        with write_behind():
+            entry.title = u'c'
+            entry.save()
+
+        self.assertEqual(Entry.objects.get(pk=1).title, u'c')
+        counter = counter_key(connection.table_name(Entry))
+        self.assertEqual(connection.get_bucket('tests').get(counter).value, 2)
+
+    def test_save_of_loaded_instance_does_not_recreate(self):
+        entry = Entry.objects.create(id=1, title=u'a')
+        self.assertEqual(Entry.objects.count(), 1)
+        connection.get_bucket('tests').remove(docid(1))
+
+        with self.assertRaises(BatchWriteError) as cm:
+            with write_behind():
+                entry.title = u'b'
+                entry.save()
+
+        kind, exc = cm.exception.failures[docid(1)]
+        self.assertEqual(kind, REPLACE)
+        self.assertIsInstance(exc, NotFoundError)
+        counter = counter_key(connection.table_name(Entry))
+        self.assertTrue(connection.get_bucket('tests').get(counter, quiet=True).success)
@@ -0,0 +1,20 @@
+from uuid import UUID
+
+from django.test import SimpleTestCase
+
+from cbdjango.db.backends.couchbase.utils import DocID
+
+
+class DocIDTests(SimpleTestCase):
+    def test_int_round_trip(self):
+        # 47 and 95 differ by byte 0x2F ('/') vs 0x5F ('_')
+        keys = [DocID.encode('t', x) for x in (47, 95)]
+        self.assertNotEqual(keys[0], keys[1])
+        self.assertEqual([DocID.decode(x).to_int() for x in keys], [47, 95])
+
+    def test_uuid_round_trip(self):
+        value = UUID(bytes='/' * 16)
+        self.assertEqual(DocID.decode(DocID.encode('t', value)).to_int(), int(value))
+
+    def test_string(self):
+        self.assertEqual(DocID.decode(DocID.encode('t', u'a/b')).to_string(), u'a/b')